@@ -1,7 +1,7 @@
-from datetime import date, timedelta
-from sqlalchemy import func
+from sqlalchemy import select
+from energy_balance import KCAL_PER_KG_FAT, total_deficit
 from extensions import db
-from models import User, MealLog, TrainingSignup, Activity, UserAchievement
+from models import MealLog, TrainingSignup, UserAchievement, AchievementProgress
 
 # --- КОНФИГУРАЦИЯ АЧИВОК ---
 ACHIEVEMENTS_METADATA = {
@@ -38,91 +38,78 @@ ACHIEVEMENTS_METADATA = {
 }
 
 
-# --- ДВИЖОК ПРОВЕРКИ ---
-def check_all_achievements(user):
-    """Запускает проверку всех условий и выдает новые ачивки."""
-    new_unlocks = []
-
-    # 1. Первый прием пищи
-    if _check_first_meal(user):
-        if _grant(user, "first_meal"): new_unlocks.append("first_meal")
-
-    # 2. Первая тренировка
-    if _check_first_training(user):
-        if _grant(user, "first_training"): new_unlocks.append("first_training")
-
-    # 3. Стрики
-    streak = user.current_streak
-    if streak >= 5:
-        if _grant(user, "streak_5"): new_unlocks.append("streak_5")
-    if streak >= 10:
-        if _grant(user, "streak_10"): new_unlocks.append("streak_10")
+# --- ПРАВИЛА ---
+# slug → (события, на которые правило реагирует; условие).
+# Условие получает (user, progress) и читает только поддерживаемые агрегаты
+# (стрик в User, daily_energy_balance), а не историю логов.
+MEAL_LOGGED = "meal_logged"
+TRAINING_SIGNUP = "training_signup"
+STREAK_CHANGED = "streak_changed"
+
+RULES = {
+    "first_meal": ({MEAL_LOGGED}, lambda user, progress: True),
+    "first_training": ({TRAINING_SIGNUP}, lambda user, progress: True),
+    "streak_5": ({STREAK_CHANGED}, lambda user, progress: (user.current_streak or 0) >= 5),
+    "streak_10": ({STREAK_CHANGED}, lambda user, progress: (user.current_streak or 0) >= 10),
+    "fat_loss_5kg": ({MEAL_LOGGED}, lambda user, progress: _total_fat_loss_kg(user, progress) >= 5.0),
+}
 
-    # 4. Дефицит -5 кг жира
-    if _calculate_total_fat_loss_kg(user) >= 5.0:
-        if _grant(user, "fat_loss_5kg"): new_unlocks.append("fat_loss_5kg")
 
+# --- ДВИЖОК ПРОВЕРКИ ---
+def on_achievement_event(user, *events):
+    """
+    Проверяет только правила, подписанные на events и ещё не открытые у пользователя.
+    Открытые slug'и лежат в AchievementProgress.unlocked: если всё уже выдано — ни одного лишнего запроса.
+    Возвращает список новых slug'ов. Коммит — на вызывающем.
+    """
+    progress = _get_progress(user)
+    unlocked = progress.unlocked_slugs
+    events = set(events)
+
+    new_unlocks = [
+        slug for slug, (rule_events, condition) in RULES.items()
+        if slug not in unlocked and rule_events & events and condition(user, progress)
+    ]
+    for slug in new_unlocks:
+        db.session.add(UserAchievement(user_id=user.id, slug=slug, seen=False))
     if new_unlocks:
-        try:
-            db.session.commit()
-        except Exception:
-            db.session.rollback()
-
+        progress.unlocked = ",".join(sorted(unlocked | set(new_unlocks)))
     return new_unlocks
 
 
-# --- ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ---
-
-def _grant(user, slug):
-    """Выдает ачивку, если её еще нет. Возвращает True, если выдал."""
-    exists = UserAchievement.query.filter_by(user_id=user.id, slug=slug).first()
-    if not exists:
-        new_ach = UserAchievement(user_id=user.id, slug=slug, seen=False)
-        db.session.add(new_ach)
-        return True
-    return False
-
-
-def _check_first_meal(user):
-    # Проверяем, есть ли хотя бы один лог еды
-    return MealLog.query.filter_by(user_id=user.id).first() is not None
-
-
-def _check_first_training(user):
-    return TrainingSignup.query.filter_by(user_id=user.id).first() is not None
-
-
-def _calculate_total_fat_loss_kg(user):
+def check_all_achievements(user):
     """
-    Считает накопленный дефицит за всё время.
-    1 кг жира ≈ 7700 ккал.
+    Полная проверка (ремонт / бэкфилл): определяет по данным, какие события уже были,
+    и прогоняет их через on_achievement_event. Коммитит сам.
     """
-    # Получаем данные за все дни, когда были записи
-    logs = db.session.query(
-        MealLog.date, func.sum(MealLog.calories)
-    ).filter_by(user_id=user.id).group_by(MealLog.date).all()
-
-    if not logs:
-        return 0.0
-
-    # Кэшируем активность и BMR
-    activities = Activity.query.filter_by(user_id=user.id).all()
-    act_map = {a.date: a.active_kcal for a in activities}
-
-    # Берем BMR из последнего анализа (упрощение, но рабочее)
-    bmr = user.metabolism or 2000
-
-    total_deficit = 0
-    for day_date, consumed_kcal in logs:
-        active = act_map.get(day_date, 0)
-        burned = bmr + active
+    events = {STREAK_CHANGED}
+    if MealLog.query.filter_by(user_id=user.id).first() is not None:
+        events.add(MEAL_LOGGED)
+    if TrainingSignup.query.filter_by(user_id=user.id).first() is not None:
+        events.add(TRAINING_SIGNUP)
+
+    new_unlocks = on_achievement_event(user, *events)
+    try:
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+    return new_unlocks
 
-        daily_diff = burned - consumed_kcal
 
-        # Считаем только дефицит (если профицит - жир копится?
-        # Обычно в ачивках считают "чистый сожженный".
-        # Если хотите честный баланс, уберите max(0, ...))
-        if daily_diff > 0:
-            total_deficit += daily_diff
+# --- ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ---
 
-    return total_deficit / 7700.0
\ No newline at end of file
+def _get_progress(user):
+    """Строка агрегатов пользователя; при первом обращении кэш заполняется из user_achievements."""
+    progress = db.session.get(AchievementProgress, user.id)
+    if progress is None:
+        slugs = db.session.execute(
+            select(UserAchievement.slug).where(UserAchievement.user_id == user.id)
+        ).scalars().all()
+        progress = AchievementProgress(user_id=user.id, unlocked=",".join(sorted(slugs)))
+        db.session.add(progress)
+    return progress
+
+
+def _total_fat_loss_kg(user, progress):
+    """Накопленный дефицит за всё время в кг жира — из daily_energy_balance, один запрос."""
+    return total_deficit(user.id) / KCAL_PER_KG_FAT
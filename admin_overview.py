@@ -0,0 +1,292 @@
+# Список пользователей для админ-панели (admin_dashboard) и сводки по ним.
+# Главная админки рендерит пустую оболочку за постоянное время; строки приходят из /api/admin/users:
+#   - keyset-пагинация по (ключ сортировки, id) — страница стоит одинаково на любой глубине,
+#   - поиск по префиксу email / имени (индексы по lower(email) / lower(name), см. миграцию в app.py) или по ID,
+#   - фильтры: подписка, тренер, статус отряда, есть / нет еды и активности за сегодня — в SQL,
+#   - статусы «сегодня» — коррелированными EXISTS в том же запросе.
+# Сводка (еда и активность за сегодня, два последних замера с дельтами) грузится лениво по раскрытию строки;
+# для пачки пользователей — фиксированным числом сгруппированных запросов, замеры через
+# ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY timestamp DESC) <= 2.
+import base64
+import json
+from datetime import date
+
+from sqlalchemy import and_, exists, false, func, or_, select
+from sqlalchemy.orm import contains_eager
+
+from extensions import db
+from models import Activity, BodyAnalysis, MealLog, Subscription, User
+
+DEFAULT_PER_PAGE = 50
+MAX_PER_PAGE = 200
+SQUAD_STATUSES = ('none', 'pending', 'active')
+
+# Метрики карточки «Сводка» — как в profile.html: (подпись, поле, иконка, единица, рост — хорошо)
+METRICS_DEF = [
+    ('Рост', 'height', '📏', 'см', True),
+    ('Вес', 'weight', '⚖️', 'кг', False),
+    ('Мышцы', 'muscle_mass', '💪', 'кг', True),
+    ('Жир', 'fat_mass', '🧈', 'кг', False),
+    ('Вода', 'body_water', '💧', '%', True),
+    ('Метаболизм', 'metabolism', '⚡', 'ккал', True),
+    ('Белок', 'protein_percentage', '🥚', '%', True),
+    ('Висц. жир', 'visceral_fat_rating', '🔥', '', False),
+    ('ИМТ', 'bmi', '📐', '', False),
+]
+
+
+def subscription_active_expr(today=None):
+    """
+    SQL-версия User.has_subscription (тренер или активная подписка); требует outer join Subscription.
+    Без строки подписки сравнения дают NULL — coalesce до false, чтобы отрицание (sub=none) их не теряло.
+    """
+    today = today or date.today()
+    return func.coalesce(or_(
+        User.is_trainer.is_(True),
+        and_(
+            Subscription.status == 'active',
+            Subscription.start_date <= today,
+            or_(Subscription.end_date.is_(None), Subscription.end_date >= today),
+        ),
+    ), false())
+
+
+# Ключи keyset-сортировки: значение ключа NOT NULL, второй ключ — id
+SORT_COLUMNS = {
+    'id': User.id,
+    'name': func.lower(User.name),
+    'email': func.lower(User.email),
+}
+
+
+def _escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def encode_cursor(sort_value, user_id):
+    raw = json.dumps([sort_value, user_id], ensure_ascii=False).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """(значение ключа, id) из курсора или None, если курсор битый."""
+    try:
+        sort_value, user_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return sort_value, int(user_id)
+    except Exception:
+        return None
+
+
+# ==============================
+#   СПИСОК ПОЛЬЗОВАТЕЛЕЙ
+# ==============================
+
+def user_page(q=None, sub='any', trainer='any', squad='any', meal='any', activity='any',
+              sort='id', direction='asc', cursor=None, limit=DEFAULT_PER_PAGE, today=None):
+    """
+    Страница списка одним запросом: dict(users=[строки], next_cursor, has_more, sort, direction).
+    q — префикс email / имени или точный ID; sub: active|none; trainer: yes|no; squad: none|pending|active;
+    meal / activity: ok|no — есть / нет записей за сегодня («не отметились сегодня» — meal=no).
+    cursor — next_cursor предыдущей страницы.
+    """
+    today = today or date.today()
+    limit = max(1, min(limit or DEFAULT_PER_PAGE, MAX_PER_PAGE))
+    if sort not in SORT_COLUMNS:
+        sort = 'id'
+    direction = 'desc' if direction == 'desc' else 'asc'
+    sort_col = SORT_COLUMNS[sort]
+
+    meal_today = exists().where(MealLog.user_id == User.id, MealLog.date == today)
+    activity_today = exists().where(Activity.user_id == User.id, Activity.date == today)
+    sub_active = subscription_active_expr(today)
+
+    stmt = select(User, sort_col.label('sort_value'), meal_today.label('meal_today'),
+                  activity_today.label('activity_today')) \
+        .outerjoin(Subscription, Subscription.user_id == User.id) \
+        .options(contains_eager(User.subscription))
+
+    q = (q or '').strip().lower()
+    if q:
+        prefix = _escape_like(q) + '%'
+        conds = [
+            func.lower(User.email).like(prefix, escape='\\'),
+            func.lower(User.name).like(prefix, escape='\\'),
+        ]
+        if q.isdigit():
+            conds.append(User.id == int(q))
+        stmt = stmt.where(or_(*conds))
+    if sub in ('active', 'none'):
+        stmt = stmt.where(sub_active if sub == 'active' else ~sub_active)
+    if trainer in ('yes', 'no'):
+        stmt = stmt.where(User.is_trainer.is_(trainer == 'yes'))
+    if squad in SQUAD_STATUSES:
+        stmt = stmt.where(func.coalesce(User.squad_status, 'none') == squad)
+    if meal in ('ok', 'no'):
+        stmt = stmt.where(meal_today if meal == 'ok' else ~meal_today)
+    if activity in ('ok', 'no'):
+        stmt = stmt.where(activity_today if activity == 'ok' else ~activity_today)
+
+    after = decode_cursor(cursor) if cursor else None
+    if after is not None:
+        value, last_id = after
+        if direction == 'asc':
+            stmt = stmt.where(or_(sort_col > value, and_(sort_col == value, User.id > last_id)))
+        else:
+            stmt = stmt.where(or_(sort_col < value, and_(sort_col == value, User.id < last_id)))
+
+    if direction == 'asc':
+        stmt = stmt.order_by(sort_col.asc(), User.id.asc())
+    else:
+        stmt = stmt.order_by(sort_col.desc(), User.id.desc())
+
+    rows = db.session.execute(stmt.limit(limit + 1)).unique().all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    users = [{
+        'id': u.id,
+        'name': u.name,
+        'email': u.email,
+        'is_trainer': bool(u.is_trainer),
+        'has_subscription': bool(u.has_subscription),
+        'squad_status': u.squad_status or 'none',
+        'meal_today': bool(has_meal),
+        'activity_today': bool(has_activity),
+    } for u, _, has_meal, has_activity in rows]
+
+    next_cursor = None
+    if has_more:
+        last_user, last_value = rows[-1][0], rows[-1][1]
+        next_cursor = encode_cursor(last_value, last_user.id)
+    return {
+        'users': users,
+        'next_cursor': next_cursor,
+        'has_more': has_more,
+        'sort': sort,
+        'direction': direction,
+    }
+
+
+# ==============================
+#   СВОДКИ
+# ==============================
+
+def user_summary(user_id, today=None):
+    """Сводка одного пользователя для раскрытой строки: dict(meals, activity, metrics) или None."""
+    user = db.session.get(User, user_id)
+    if user is None:
+        return None
+    _, details = overview_for([user], today)
+    return details[user.id]
+
+
+def overview_for(users, today=None):
+    """Статусы и сводки для списка пользователей тремя запросами → (statuses, details) по user_id."""
+    today = today or date.today()
+    user_ids = [u.id for u in users]
+    if not user_ids:
+        return {}, {}
+
+    meals_by_user = {}
+    for m in db.session.execute(
+        select(MealLog).where(MealLog.user_id.in_(user_ids), MealLog.date == today).order_by(MealLog.id)
+    ).scalars():
+        meals_by_user.setdefault(m.user_id, []).append(m)
+
+    activity_by_user = {}
+    for a in db.session.execute(
+        select(Activity).where(Activity.user_id.in_(user_ids), Activity.date == today).order_by(Activity.id)
+    ).scalars():
+        activity_by_user.setdefault(a.user_id, a)
+
+    analyses_by_user = latest_two_analyses(user_ids)
+
+    statuses, details = {}, {}
+    for u in users:
+        meals = meals_by_user.get(u.id, [])
+        act = activity_by_user.get(u.id)
+        last, prev = analyses_by_user.get(u.id, (None, None))
+        statuses[u.id] = {
+            'meal': bool(meals),
+            'activity': act is not None,
+            'subscription_active': u.has_subscription  # Проверяем наличие активной подписки
+        }
+        details[u.id] = {
+            'meals': [{
+                'type': m.meal_type,
+                'cal': m.calories,
+                'prot': m.protein,
+                'fat': m.fat,
+                'carbs': m.carbs
+            } for m in meals],
+            'activity': _activity_data(act),
+            'metrics': metrics_with_deltas(last, prev),
+        }
+    return statuses, details
+
+
+def latest_two_analyses(user_ids):
+    """Последний и предпоследний замер каждого пользователя одним запросом → {user_id: (last, prev)}."""
+    if not user_ids:
+        return {}
+    rn = func.row_number().over(
+        partition_by=BodyAnalysis.user_id,
+        order_by=(BodyAnalysis.timestamp.desc(), BodyAnalysis.id.desc()),
+    ).label("rn")
+    ranked = select(BodyAnalysis.id, rn).where(BodyAnalysis.user_id.in_(user_ids)).subquery()
+    q = select(BodyAnalysis, ranked.c.rn) \
+        .join(ranked, ranked.c.id == BodyAnalysis.id) \
+        .where(ranked.c.rn <= 2)
+
+    result = {}
+    for analysis, pos in db.session.execute(q):
+        last, prev = result.get(analysis.user_id, (None, None))
+        if pos == 1:
+            last = analysis
+        else:
+            prev = analysis
+        result[analysis.user_id] = (last, prev)
+    return result
+
+
+def _activity_data(act):
+    if not act:
+        return None
+    return {
+        'steps': act.steps,
+        'active_kcal': act.active_kcal,
+        'resting_kcal': act.resting_kcal,
+        'distance_km': act.distance_km,
+        'hr_avg': act.heart_rate_avg
+    }
+
+
+def metrics_with_deltas(last, prev):
+    """Метрики последнего замера с изменением относительно предыдущего."""
+    metrics = []
+    for label, field, icon, unit, good_up in METRICS_DEF:
+        cur = getattr(last, field, None)
+        pr = getattr(prev, field, None)
+        diff = pct = arrow = None
+        is_good = None
+        if cur is not None and pr is not None:
+            diff = cur - pr
+            if pr != 0:
+                pct = diff / pr * 100
+            arrow = '↑' if diff > 0 else '↓' if diff < 0 else ''
+            if diff == 0:
+                arrow = ''  # No arrow for no change
+                is_good = True  # Can consider no change as good/neutral
+            else:
+                is_good = (diff > 0 and good_up) or (diff < 0 and not good_up)
+        metrics.append({
+            'label': label,
+            'icon': icon,
+            'unit': unit,
+            'cur': cur,
+            'diff': diff,
+            'pct': pct,
+            'arrow': arrow,
+            'is_good': is_good
+        })
+    return metrics
@@ -0,0 +1,314 @@
+# Фоновая отправка событий в Amplitude (HTTP API v2) пачками.
+# enqueue только кладёт событие в ограниченную очередь процесса; поток-отправитель копит пачку
+# до AMPLITUDE_BATCH_SIZE событий или AMPLITUDE_FLUSH_SEC секунд и шлёт её одним POST с повторами
+# (429 / 5xx / сеть — экспоненциальная пауза). Не отправилось после повторов, очередь переполнена
+# или процесс останавливается → события дописываются в локальный спул (JSONL), который поток
+# периодически переотправляет. У каждого события свой insert_id — Amplitude отбрасывает дубли,
+# поэтому повторная отправка пачки (спул, остановка посреди POST) безопасна.
+import atexit
+import glob
+import json
+import os
+import queue
+import random
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from telegram_client import make_session
+
+API_KEY = os.getenv("AMPLITUDE_API_KEY", "c9572b73ece4f73786a764fa197c2161")
+API_URL = os.getenv("AMPLITUDE_API_URL", "https://api2.amplitude.com/2/httpapi")
+MAX_QUEUE = int(os.getenv("AMPLITUDE_QUEUE_MAX", "10000"))
+BATCH_SIZE = int(os.getenv("AMPLITUDE_BATCH_SIZE", "100"))
+FLUSH_SEC = float(os.getenv("AMPLITUDE_FLUSH_SEC", "10"))
+SEND_ATTEMPTS = int(os.getenv("AMPLITUDE_SEND_ATTEMPTS", "4"))
+BACKOFF_SEC = float(os.getenv("AMPLITUDE_BACKOFF_SEC", "2"))
+TIMEOUT_SEC = (3, 10)  # (connect, read)
+SPOOL_PATH = os.getenv("AMPLITUDE_SPOOL_PATH", os.path.join("instance", "amplitude_spool.jsonl"))
+SPOOL_MAX_BYTES = int(os.getenv("AMPLITUDE_SPOOL_MAX_MB", "50")) * 1024 * 1024
+SPOOL_REPLAY_SEC = int(os.getenv("AMPLITUDE_SPOOL_REPLAY_SEC", "60"))
+# Захваченный на переотправку файл спула, который не удалили за это время, — от упавшего процесса
+STALE_CLAIM_SEC = 600
+SHUTDOWN_TIMEOUT_SEC = 3
+
+_queue = queue.Queue(maxsize=MAX_QUEUE)
+_stop = threading.Event()
+_start_lock = threading.Lock()
+_spool_lock = threading.Lock()
+_thread = None
+_pid = None
+_inflight = []  # пачка, которую поток сейчас отправляет (дописывается в спул, если процесс остановят)
+_session = make_session(1)
+
+_stats_lock = threading.Lock()
+_stats = {"enqueued": 0, "sent": 0, "batches": 0, "retries": 0, "spooled": 0, "replayed": 0,
+          "dropped": 0, "last_sent_at": None, "last_error": None}
+
+
+def _bump(**deltas):
+    with _stats_lock:
+        for key, value in deltas.items():
+            _stats[key] += value
+
+
+def _mark_sent(count, replayed=False):
+    _bump(sent=count, batches=1, replayed=count if replayed else 0)
+    with _stats_lock:
+        _stats["last_sent_at"] = datetime.utcnow().isoformat(timespec="seconds")
+
+
+def _set_error(error):
+    with _stats_lock:
+        _stats["last_error"] = str(error)[:300]
+
+
+def is_enabled():
+    return bool(API_KEY)
+
+
+# ==============================
+#   ПРИЁМ СОБЫТИЙ
+# ==============================
+
+def enqueue(event_type, user_id, properties=None):
+    """
+    Поставить событие в очередь на отправку (без сети и без ожидания).
+    Очередь переполнена → событие сразу уходит в спул. False — Amplitude выключен или событие потеряно.
+    """
+    if not is_enabled() or user_id is None:
+        return False
+    _ensure_started()
+    event = {
+        "event_type": event_type,
+        "user_id": str(user_id),
+        "time": int(time.time() * 1000),  # время события, а не время отправки пачки
+        "insert_id": uuid.uuid4().hex,
+        "event_properties": properties or {},
+    }
+    try:
+        _queue.put_nowait(event)
+    except queue.Full:
+        return _spool([event]) > 0
+    _bump(enqueued=1)
+    return True
+
+
+def get_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["enabled"] = is_enabled()
+    stats["queued"] = _queue.qsize()
+    stats["capacity"] = MAX_QUEUE
+    stats["spool_bytes"] = _spool_size()
+    return stats
+
+
+# ==============================
+#   ОТПРАВКА
+# ==============================
+
+def _ensure_started():
+    """Поток-отправитель — один на процесс; после fork (gunicorn) поднимается заново."""
+    global _thread, _pid
+    if _thread is not None and _thread.is_alive() and _pid == os.getpid():
+        return
+    with _start_lock:
+        if _thread is not None and _thread.is_alive() and _pid == os.getpid():
+            return
+        _stop.clear()
+        _pid = os.getpid()
+        _thread = threading.Thread(target=_send_loop, name="amplitude-uploader", daemon=True)
+        _thread.start()
+
+
+def _take_batch():
+    """Пачка до BATCH_SIZE событий: ждём первое, добираем остальные не дольше FLUSH_SEC."""
+    try:
+        first = _queue.get(timeout=FLUSH_SEC)
+    except queue.Empty:
+        return []
+    batch = [first]
+    deadline = time.monotonic() + FLUSH_SEC
+    while len(batch) < BATCH_SIZE and not _stop.is_set():
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(_queue.get(timeout=remaining))
+        except queue.Empty:
+            break
+    return batch
+
+
+def _post(events):
+    """
+    Один POST пачки. Возвращает (ok, retry, error):
+    retry=False — повторять бессмысленно (неверный ключ или формат события), пачка отбрасывается.
+    """
+    try:
+        r = _session.post(API_URL, json={"api_key": API_KEY, "events": events, "options": {"min_id_length": 1}},
+                          timeout=TIMEOUT_SEC)
+    except Exception as e:
+        return False, True, str(e)
+    if r.ok:
+        return True, False, None
+    retry = r.status_code in (408, 429) or r.status_code >= 500
+    return False, retry, f"{r.status_code} {r.text[:200]}"
+
+
+def _send(batch, attempts=SEND_ATTEMPTS):
+    """Отправить пачку с повторами; не вышло → спул. False — пачка не доставлена (в спуле или потеряна)."""
+    for attempt in range(1, attempts + 1):
+        ok, retry, error = _post(batch)
+        if ok:
+            _mark_sent(len(batch))
+            return True
+        _set_error(error)
+        print(f"[amplitude] upload of {len(batch)} events failed (attempt {attempt}): {error}")
+        if not retry:
+            _bump(dropped=len(batch))
+            return False
+        if attempt == attempts or _stop.is_set():
+            break
+        _bump(retries=1)
+        _stop.wait(BACKOFF_SEC * (2 ** (attempt - 1)) + random.uniform(0, BACKOFF_SEC))
+    _spool(batch)
+    return False
+
+
+def _send_loop():
+    global _inflight
+    last_replay = None
+    while not _stop.is_set():
+        if last_replay is None or time.monotonic() - last_replay >= SPOOL_REPLAY_SEC:
+            last_replay = time.monotonic()
+            replay_spool()
+        batch = _take_batch()
+        if batch:
+            _inflight = batch
+            _send(batch)
+            _inflight = []
+
+
+# ==============================
+#   СПУЛ
+# ==============================
+
+def _spool_size():
+    try:
+        return os.path.getsize(SPOOL_PATH)
+    except OSError:
+        return 0
+
+
+def _spool(events, returned=False):
+    """
+    Дописать события в спул (по строке JSON на событие). Спул больше SPOOL_MAX_BYTES → события теряются.
+    returned=True — остаток неудачной переотправки, в счётчик spooled повторно не идёт.
+    """
+    if not events:
+        return 0
+    try:
+        with _spool_lock:
+            if _spool_size() >= SPOOL_MAX_BYTES:
+                raise OSError(f"spool is full ({SPOOL_MAX_BYTES} bytes)")
+            os.makedirs(os.path.dirname(SPOOL_PATH) or ".", exist_ok=True)
+            with open(SPOOL_PATH, "a", encoding="utf-8") as f:
+                f.write("".join(json.dumps(e, ensure_ascii=False) + "\n" for e in events))
+    except Exception as e:
+        _set_error(e)
+        _bump(dropped=len(events))
+        print(f"[amplitude] spool of {len(events)} events failed: {e}")
+        return 0
+    if not returned:
+        _bump(spooled=len(events))
+    return len(events)
+
+
+def _claim_spool_files():
+    """
+    Забрать спул на переотправку: файл атомарно переименовывается (его забирает один процесс),
+    новые события тем временем пишутся в свежий спул. Заодно подбираются брошенные захваты упавших процессов.
+    """
+    claimed = []
+    own = f"{SPOOL_PATH}.{os.getpid()}.replay"
+    with _spool_lock:
+        try:
+            os.replace(SPOOL_PATH, own)
+            claimed.append(own)
+        except FileNotFoundError:
+            pass
+    for path in glob.glob(f"{glob.escape(SPOOL_PATH)}.*.replay"):
+        if path == own:
+            continue
+        try:
+            if time.time() - os.path.getmtime(path) < STALE_CLAIM_SEC:
+                continue
+            stolen = f"{path}.{os.getpid()}.replay"
+            os.replace(path, stolen)
+            claimed.append(stolen)
+        except OSError:
+            continue
+    return claimed
+
+
+def replay_spool():
+    """Переотправить спул пачками по одной попытке; при первой ошибке остаток возвращается в спул."""
+    if not is_enabled():
+        return 0
+    replayed = 0
+    for path in _claim_spool_files():
+        events = []
+        try:
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        events.append(json.loads(line))
+                    except ValueError:
+                        continue  # оборванная строка (процесс упал посреди записи)
+        except OSError as e:
+            _set_error(e)
+            continue
+
+        pos = 0
+        while pos < len(events) and not _stop.is_set():
+            batch = events[pos:pos + BATCH_SIZE]
+            ok, retry, error = _post(batch)
+            if not ok and retry:
+                _set_error(error)
+                break
+            if ok:
+                _mark_sent(len(batch), replayed=True)
+                replayed += len(batch)
+            else:
+                _set_error(error)
+                _bump(dropped=len(batch))
+            pos += len(batch)
+
+        rest = events[pos:]
+        with _spool_lock:
+            os.remove(path)
+        _spool(rest, returned=True)
+    if replayed:
+        print(f"[amplitude] replayed {replayed} spooled events")
+    return replayed
+
+
+@atexit.register
+def shutdown():
+    """Остановить поток; недоотправленное и всё, что в очереди, — в спул (без сети на выходе)."""
+    _stop.set()
+    if _thread is not None and _thread.is_alive() and _pid == os.getpid():
+        _thread.join(timeout=SHUTDOWN_TIMEOUT_SEC)
+        if _thread.is_alive():
+            _spool(list(_inflight))  # POST ещё идёт: если дойдёт, дубль отбросит Amplitude по insert_id
+    rest = []
+    while True:
+        try:
+            rest.append(_queue.get_nowait())
+        except queue.Empty:
+            break
+    if rest and _spool(rest):
+        print(f"[amplitude] spooled {len(rest)} events on shutdown")
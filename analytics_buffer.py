@@ -0,0 +1,166 @@
+# Буфер записи analytics_events.
+# track_event только кладёт событие в ограниченную очередь процесса (без БД и без общей сессии запроса),
+# а фоновый поток сбрасывает её пачками — по размеру (ANALYTICS_BATCH_SIZE) или по времени
+# (ANALYTICS_FLUSH_SEC) — одним INSERT в отдельном соединении. Очередь переполнена → событие
+# отбрасывается (счётчик overflow), пачку не удалось записать после повторов → dropped.
+# При остановке процесса остаток сбрасывается (atexit).
+import atexit
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import insert
+
+from extensions import db
+from models import AnalyticsEvent
+
+MAX_QUEUE = int(os.getenv("ANALYTICS_BUFFER_MAX", "10000"))
+BATCH_SIZE = int(os.getenv("ANALYTICS_BATCH_SIZE", "200"))
+FLUSH_SEC = float(os.getenv("ANALYTICS_FLUSH_SEC", "2"))
+WRITE_ATTEMPTS = 3
+SHUTDOWN_TIMEOUT_SEC = 5
+
+_app = None
+_queue = queue.Queue(maxsize=MAX_QUEUE)
+_stop = threading.Event()
+_start_lock = threading.Lock()
+_thread = None
+_pid = None
+
+_stats_lock = threading.Lock()
+_stats = {"enqueued": 0, "written": 0, "overflow": 0, "dropped": 0, "batches": 0,
+          "last_flush_at": None, "last_error": None}
+
+T = AnalyticsEvent.__table__
+
+
+def _bump(**deltas):
+    with _stats_lock:
+        for key, value in deltas.items():
+            _stats[key] += value
+
+
+# ==============================
+#   ПРИЁМ СОБЫТИЙ
+# ==============================
+
+def init_analytics_buffer(app):
+    """Запомнить приложение (нужен app context для db.engine в потоке сброса)."""
+    global _app
+    _app = app
+
+
+def enqueue(event_type, user_id=None, data=None):
+    """Положить событие в очередь; False — очередь переполнена, событие отброшено."""
+    _ensure_started()
+    row = {
+        "user_id": user_id,
+        "event_type": event_type,
+        "event_data": data or {},
+        "created_at": datetime.utcnow(),  # время события, а не время записи пачки
+    }
+    try:
+        _queue.put_nowait(row)
+    except queue.Full:
+        _bump(overflow=1)
+        return False
+    _bump(enqueued=1)
+    return True
+
+
+def get_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["queued"] = _queue.qsize()
+    stats["capacity"] = MAX_QUEUE
+    return stats
+
+
+# ==============================
+#   СБРОС В БД
+# ==============================
+
+def _ensure_started():
+    """Поток сброса — один на процесс; после fork (gunicorn) поднимается заново."""
+    global _thread, _pid
+    if _thread is not None and _thread.is_alive() and _pid == os.getpid():
+        return
+    with _start_lock:
+        if _thread is not None and _thread.is_alive() and _pid == os.getpid():
+            return
+        _stop.clear()
+        _pid = os.getpid()
+        _thread = threading.Thread(target=_flush_loop, name="analytics-buffer", daemon=True)
+        _thread.start()
+
+
+def _take_batch(block=True):
+    """Пачка до BATCH_SIZE событий: ждём первое, добираем остальные не дольше FLUSH_SEC."""
+    try:
+        first = _queue.get(timeout=FLUSH_SEC) if block else _queue.get_nowait()
+    except queue.Empty:
+        return []
+    batch = [first]
+    deadline = time.monotonic() + FLUSH_SEC
+    while len(batch) < BATCH_SIZE:
+        remaining = deadline - time.monotonic()
+        try:
+            batch.append(_queue.get(timeout=remaining) if block and remaining > 0 else _queue.get_nowait())
+        except queue.Empty:
+            break
+    return batch
+
+
+def _write(batch):
+    for attempt in range(1, WRITE_ATTEMPTS + 1):
+        try:
+            with _app.app_context():
+                with db.engine.begin() as conn:
+                    conn.execute(insert(T), batch)
+            _bump(written=len(batch), batches=1)
+            with _stats_lock:
+                _stats["last_flush_at"] = datetime.utcnow().isoformat(timespec="seconds")
+            return True
+        except Exception as e:
+            with _stats_lock:
+                _stats["last_error"] = str(e)[:300]
+            print(f"[analytics_buffer] write of {len(batch)} events failed (attempt {attempt}): {e}")
+            if attempt < WRITE_ATTEMPTS and not _stop.is_set():
+                time.sleep(0.5 * attempt)
+    _bump(dropped=len(batch))
+    return False
+
+
+def _flush_loop():
+    while not _stop.is_set():
+        batch = _take_batch()
+        if batch and _app is not None:
+            _write(batch)
+        elif batch:
+            _bump(dropped=len(batch))
+
+
+def flush():
+    """Синхронно записать всё, что сейчас в очереди (остановка процесса, ручной сброс)."""
+    if _app is None:
+        return 0
+    written = 0
+    while True:
+        batch = _take_batch(block=False)
+        if not batch:
+            return written
+        if _write(batch):
+            written += len(batch)
+
+
+@atexit.register
+def shutdown():
+    """Остановить поток и сбросить остаток очереди."""
+    _stop.set()
+    if _thread is not None and _thread.is_alive() and _pid == os.getpid():
+        _thread.join(timeout=SHUTDOWN_TIMEOUT_SEC)
+    written = flush()
+    if written:
+        print(f"[analytics_buffer] flushed {written} events on shutdown")
@@ -0,0 +1,163 @@
+# Дневные агрегаты аналитики (analytics_daily_rollup, analytics_first_event).
+# Компактор раз в ANALYTICS_ROLLUP_EVERY_MIN минут пересчитывает «горячее» окно — от последнего
+# агрегированного дня (включая предыдущий, для поздних вставок) до сегодня — двумя INSERT ... SELECT
+# по analytics_events с фильтром по индексу created_at. Полный проход — только при пустой таблице.
+# Админская аналитика (воронка, графики по дням, KPI) читает только агрегаты за любой диапазон дат.
+# Шедулер поднимается через job_runner, поэтому компактор работает только на лидере.
+import os
+from datetime import datetime, timedelta
+
+from apscheduler.schedulers.background import BackgroundScheduler
+from sqlalchemy import Date, and_, delete, exists, func, insert, literal, select
+
+from extensions import db
+from models import AnalyticsDailyRollup, AnalyticsEvent, AnalyticsFirstEvent
+
+EVERY_MIN = int(os.getenv("ANALYTICS_ROLLUP_EVERY_MIN", "5"))
+# Сколько последних агрегированных дней пересчитывать заново (события, пришедшие с опозданием)
+REWIND_DAYS = 1
+
+_scheduler = None
+
+R = AnalyticsDailyRollup.__table__
+F = AnalyticsFirstEvent.__table__
+
+
+# ==============================
+#   КОМПАКТОР
+# ==============================
+
+def _event_day():
+    return func.date(AnalyticsEvent.created_at, type_=Date)
+
+
+def compact(full=False):
+    """
+    Пересчитать агрегаты за горячее окно (full=True или пустая таблица — за всю историю).
+    Одна транзакция: строки окна удаляются и вставляются заново, читатели видят старые до коммита.
+    Возвращает первый пересчитанный день (None — вся история).
+    """
+    start = None
+    if not full:
+        last_day = db.session.execute(select(func.max(R.c.day))).scalar()
+        if last_day is not None:
+            start = last_day - timedelta(days=REWIND_DAYS)
+
+    day = _event_day()
+    events = select(AnalyticsEvent.event_type, day.label("day"), AnalyticsEvent.user_id, AnalyticsEvent.id)
+    if start is not None:
+        events = events.where(AnalyticsEvent.created_at >= datetime.combine(start, datetime.min.time()))
+    events = events.subquery()
+
+    # --- 1. Дневные счётчики ---
+    purge = delete(R)
+    if start is not None:
+        purge = purge.where(R.c.day >= start)
+    db.session.execute(purge)
+    db.session.execute(
+        insert(R).from_select(
+            ["event_type", "day", "event_count", "distinct_users", "updated_at"],
+            select(
+                events.c.event_type, events.c.day,
+                func.count(events.c.id), func.count(func.distinct(events.c.user_id)),
+                literal(datetime.utcnow()),
+            ).group_by(events.c.event_type, events.c.day)
+        )
+    )
+
+    # --- 2. Первые события пользователей (только новые пары тип + пользователь) ---
+    firsts = select(events.c.event_type, events.c.user_id, func.min(events.c.day).label("first_day")) \
+        .where(events.c.user_id.is_not(None)) \
+        .group_by(events.c.event_type, events.c.user_id) \
+        .subquery()
+    db.session.execute(
+        insert(F).from_select(
+            ["event_type", "user_id", "first_day"],
+            select(firsts.c.event_type, firsts.c.user_id, firsts.c.first_day).where(
+                ~exists().where(and_(F.c.event_type == firsts.c.event_type, F.c.user_id == firsts.c.user_id))
+            )
+        )
+    )
+    db.session.commit()
+    return start
+
+
+# ==============================
+#   ЧТЕНИЕ
+# ==============================
+
+def _in_range(column, start, end):
+    conds = []
+    if start is not None:
+        conds.append(column >= start)
+    if end is not None:
+        conds.append(column <= end)
+    return conds
+
+
+def daily_counts(event_type, start, end):
+    """Число событий по дням за [start, end] (дни без событий — 0) → [(date, count)]."""
+    rows = dict(db.session.execute(
+        select(R.c.day, R.c.event_count)
+        .where(R.c.event_type == event_type, *_in_range(R.c.day, start, end))
+    ).all())
+    return [(start + timedelta(days=i), rows.get(start + timedelta(days=i), 0))
+            for i in range((end - start).days + 1)]
+
+
+def totals(event_types, start=None, end=None):
+    """Сумма событий по типам за диапазон (None — без границы) → {event_type: count}."""
+    rows = dict(db.session.execute(
+        select(R.c.event_type, func.sum(R.c.event_count))
+        .where(R.c.event_type.in_(event_types), *_in_range(R.c.day, start, end))
+        .group_by(R.c.event_type)
+    ).all())
+    return {t: int(rows.get(t) or 0) for t in event_types}
+
+
+def funnel(steps, start=None, end=None):
+    """
+    Уникальные пользователи по шагам воронки → [count] в порядке steps.
+    Пользователь попадает в диапазон по дню своего первого события этого типа.
+    """
+    rows = dict(db.session.execute(
+        select(F.c.event_type, func.count())
+        .where(F.c.event_type.in_(steps), *_in_range(F.c.first_day, start, end))
+        .group_by(F.c.event_type)
+    ).all())
+    return [int(rows.get(step) or 0) for step in steps]
+
+
+def last_compacted_at():
+    return db.session.execute(select(func.max(R.c.updated_at))).scalar()
+
+
+# ==============================
+#   ШЕДУЛЕР
+# ==============================
+
+def get_scheduler():
+    return _scheduler
+
+
+def start_analytics_rollup_scheduler(app, paused=False):
+    global _scheduler
+    if _scheduler:
+        return _scheduler
+
+    def _compact():
+        with app.app_context():
+            try:
+                compact()
+            except Exception as e:
+                db.session.rollback()
+                print(f"[analytics_rollup] compact failed: {e}")
+            finally:
+                db.session.remove()
+
+    _scheduler = BackgroundScheduler(timezone="UTC")
+    _scheduler.add_job(_compact, "interval", minutes=EVERY_MIN, id="analytics-rollup",
+                       next_run_time=datetime.utcnow(), misfire_grace_time=None, max_instances=1, coalesce=True)
+    _scheduler.start(paused=paused)
+    print(f"[analytics_rollup] compactor started: every {EVERY_MIN} min")
+    return _scheduler
@@ -0,0 +1,50 @@
+# Единая точка записи событий аналитики (track_event в app.py).
+# track раскладывает событие по синкам, не дожидаясь ни БД, ни сети:
+#   - локальная таблица analytics_events — через analytics_buffer (фоновая запись пачками),
+#   - Amplitude — через amplitude_uploader (фоновая отправка пачками с повторами и спулом);
+#     туда уходят только серверные события из AMPLITUDE_EVENTS, под именами, принятыми в Amplitude.
+# Ошибка любого синка только логируется — обработчик запроса аналитика уронить не может.
+from analytics_buffer import enqueue as enqueue_db, get_stats as get_db_stats, init_analytics_buffer
+from amplitude_uploader import enqueue as enqueue_amplitude, get_stats as get_amplitude_stats
+
+EVENT_TYPE_MAX_LEN = 50  # AnalyticsEvent.event_type
+
+# Наше имя события → имя в Amplitude (имена в Amplitude менять нельзя — на них построены дашборды)
+AMPLITUDE_EVENTS = {
+    'meal_logged': 'Meal Logged',
+    'signup_completed': 'Sign Up Completed',
+    'analysis_confirmed': 'Body Analysis Confirmed',
+    'diet_generated': 'Diet Generated',
+    'visualization_generated': 'Body Visualization Generated',
+    'squad_join_requested': 'Squad Join Requested',
+    'squad_post_created': 'Squad Post Created',
+}
+
+
+def init_analytics_sink(app):
+    init_analytics_buffer(app)
+
+
+def track(event_type, user_id=None, data=None, forward=True):
+    """
+    Записать событие во все синки. forward=False — только в нашу БД
+    (события фронтенда: в Amplitude их шлёт сам клиент).
+    """
+    if not event_type:
+        return
+    event_type = str(event_type)[:EVENT_TYPE_MAX_LEN]
+    try:
+        enqueue_db(event_type, user_id, data)
+    except Exception as e:
+        print(f"[analytics_sink] db sink failed for {event_type}: {e}")
+
+    amplitude_name = AMPLITUDE_EVENTS.get(event_type)
+    if forward and amplitude_name:
+        try:
+            enqueue_amplitude(amplitude_name, user_id, data)
+        except Exception as e:
+            print(f"[analytics_sink] amplitude sink failed for {event_type}: {e}")
+
+
+def get_stats():
+    return {"db": get_db_stats(), "amplitude": get_amplitude_stats()}
@@ -17,7 +17,7 @@ from itsdangerous import BadSignature, SignatureExpired, URLSafeTimedSerializer
 from PIL import Image
 from openai import OpenAI
 from sqlalchemy import func, inspect, text
-from sqlalchemy.orm import subqueryload
+from sqlalchemy.orm import joinedload, selectinload, subqueryload
 from sqlalchemy.exc import IntegrityError
 
 from flask import (
@@ -35,7 +35,6 @@ from flask import (
 from flask_bcrypt import Bcrypt
 from flask_login import current_user
 from werkzeug.utils import secure_filename
-from amplitude import Amplitude, BaseEvent  # <-- Amplitude
 
 # --- Импорты для Google Sign-In ---
 from google.oauth2 import id_token
@@ -43,27 +42,37 @@ from google.auth.transport import requests as google_requests
 # ----------------------------------
 
 from assistant_bp import assistant_bp
-from streak_bp import streak_bp, start_streak_scheduler, recalculate_streak # <-- Добавлено
+from streak_bp import streak_bp, start_streak_scheduler, on_meal_logged, on_meal_deleted, repair_streaks
 from diet_autogen import start_diet_autogen_scheduler
 from gemini_visualizer import create_record, generate_for_user, _compute_pct
 from meal_reminders import (
+    MEAL_SCHEDULE,
     get_scheduler,
+    normalize_hhmm,
+    on_settings_changed as on_meal_settings_changed,
+    parse_meal_times,
     pause_job,
     resume_job,
     run_tick_now,
     start_meal_scheduler,
 )
 from shopping_bp import shopping_bp
+from training_notifier import schedule_training_notifications, unschedule_training_notifications
+from job_runner import get_runner_status, start_job_runner
+from outbox import get_outbox_stats
+from broadcast import count_recipients
 from user_bp import user_bp
 # Добавляем этот импорт, чтобы отправка работала в админке
-from notification_service import send_user_notification
-from models import BodyVisualization, SubscriptionApplication, EmailVerification, SquadScoreLog
+from notification_service import (
+    get_token_health, queue_user_notifications, record_push_results, send_fcm_batch, send_user_notification
+)
+from models import BodyVisualization, SubscriptionApplication, EmailVerification, SquadScoreLog, BroadcastJob
 from flask import send_file
 from io import BytesIO
 from progress_analyzer import generate_progress_commentary
 from flask import make_response
 import firebase_admin
-from firebase_admin import credentials, messaging
+from firebase_admin import credentials
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
@@ -82,9 +91,6 @@ else:
 
 load_dotenv()
 
-# Инициализация Amplitude
-amplitude = Amplitude(api_key=os.getenv("AMPLITUDE_API_KEY", "c9572b73ece4f73786a764fa197c2161"))
-
 app = Flask(__name__)
 app.secret_key = os.getenv("SECRET_KEY", "supersecret")
 app.jinja_env.globals.update(getattr=getattr)
@@ -100,10 +106,23 @@ from models import (
     User, Subscription, Order, Group, GroupMember, GroupMessage, MessageReaction,
     GroupTask, MealLog, Activity, Diet, Training, TrainingSignup, BodyAnalysis,
     UserSettings, MealReminderLog, AuditLog, PromptTemplate, UploadedFile,
-    UserAchievement, MessageReport, AnalyticsEvent)
+    UserAchievement, AchievementProgress, DailyEnergyBalance, MessageReport, AnalyticsEvent, AnalyticsFirstEvent)
 
 # <-- Добавьте это ниже импортов models
-from achievements_engine import check_all_achievements, ACHIEVEMENTS_METADATA
+from energy_balance import KCAL_PER_KG_FAT, backfill_if_empty as backfill_energy_balance, deficit_since_analysis
+from profile_snapshot import build_profile_snapshot
+from admin_overview import DEFAULT_PER_PAGE as ADMIN_USERS_PER_PAGE, user_page as admin_user_page, \
+    user_summary as admin_user_summary
+from analytics_sink import get_stats as get_analytics_sink_stats, init_analytics_sink, track as track_analytics
+from analytics_rollup import daily_counts as analytics_daily_counts, funnel as analytics_funnel, \
+    last_compacted_at as analytics_last_compacted_at, totals as analytics_totals
+from group_stats import group_member_stats as load_group_member_stats
+from snapshot_cache import snapshot_response
+from achievements_engine import (
+    on_achievement_event, ACHIEVEMENTS_METADATA, MEAL_LOGGED, STREAK_CHANGED, TRAINING_SIGNUP)
+
+# События аналитики пишутся в БД и отправляются в Amplitude фоновыми потоками (track_event → analytics_sink)
+init_analytics_sink(app)
 
 
 # --- Image Resizing Configuration ---
@@ -213,15 +232,16 @@ def trigger_ai_feed_post(user, event_text):
             if user.id in recipients:
                 recipients.remove(user.id)
 
-            for rid in recipients:
-                from notification_service import send_user_notification
-                send_user_notification(
-                    user_id=rid,
-                    title=f"Новости отряда {group.name} ⚡️",
-                    body=content,
-                    type='info',
-                    data={"route": "/squad"}
-                )
+            queue_user_notifications([
+                {
+                    "user_id": rid,
+                    "title": f"Новости отряда {group.name} ⚡️",
+                    "body": content,
+                    "type": 'info',
+                    "data": {"route": "/squad"},
+                }
+                for rid in recipients
+            ])
 
     except Exception as e:
         print(f"Error triggering AI feed post: {e}")
@@ -252,23 +272,18 @@ def log_audit(action: str, entity: str, entity_id: str, old=None, new=None):
     except Exception:
         db.session.rollback()
 
-def track_event(event_type, user_id=None, data=None):
-        """Сохраняет событие аналитики в БД."""
+def track_event(event_type, user_id=None, data=None, forward=True):
+        """
+        Ставит событие аналитики в analytics_sink: буфер БД и (для событий из AMPLITUDE_EVENTS) Amplitude —
+        без записи в БД и без сетевых вызовов внутри запроса. forward=False — только в нашу БД.
+        """
         try:
             if not user_id and session.get('user_id'):
                 user_id = session.get('user_id')
-
-            event = AnalyticsEvent(
-                user_id=user_id,
-                event_type=event_type,
-                event_data=data or {}
-            )
-            db.session.add(event)
-            db.session.commit()
+            track_analytics(event_type, user_id, data, forward=forward)
         except Exception as e:
-            print(f"Analytics Error: {e}")
             # Не роняем основной поток из-за ошибки аналитики
-            db.session.rollback()
+            print(f"Analytics Error: {e}")
 
 def login_required(f):
     @wraps(f)
@@ -335,7 +350,7 @@ app.config["TELEGRAM_BOT_TOKEN"] = TELEGRAM_BOT_TOKEN
 app.config["PUBLIC_BASE_URL"]    = os.getenv("APP_BASE_URL", "").rstrip("/")
 
 
-import os, threading, time as time_mod, requests
+import os, requests
 
 def _dt(date_obj, time_obj):
     return datetime.combine(date_obj, time_obj)
@@ -355,30 +370,19 @@ def _send_telegram(chat_id: str, text: str):
 def _send_mobile_push(fcm_token: str, title: str, body: str, data: dict = None):
     """
     Отправляет PUSH-уведомление через FCM.
+    Результат уходит в учёт здоровья токенов: мёртвый токен обнуляется у пользователя.
     """
     # Проверяем, что токен есть и Firebase Admin SDK инициализирован
     if not fcm_token or not firebase_admin._apps:
         return False
 
-    message = messaging.Message(
-        notification=messaging.Notification(
-            title=title,
-            body=body,
-        ),
-        data=data or {},
-        token=fcm_token,
-    )
-
-    try:
-        response = messaging.send(message)
-        print(f"Successfully sent push notification: {response}")
+    results = send_fcm_batch([{"token": fcm_token, "title": title, "body": body, "data": data}])
+    record_push_results(results)
+    if results[0]["ok"]:
+        print(f"Successfully sent push notification: {results[0]['message_id']}")
         return True
-    except Exception as e:
-        print(f"Error sending push notification: {e}")
-        # ВАЖНО: Если ошибка 'InvalidRegistrationToken',
-        # токен протух, и его нужно удалить из БД (user.fcm_device_token = None).
-        # (Эту логику можно добавить позже)
-        return False
+    print(f"Error sending push notification: {results[0]['error']}")
+    return False
 
 @app.before_request
 def set_tz():
@@ -410,304 +414,6 @@ def activity_today(chat_id):
         return jsonify({"present": False})
     return jsonify({"present": True, "steps": a.steps or 0, "active_kcal": a.active_kcal or 0})
 
-_notifier_started = False
-def _notification_worker():
-    # ВАЖНО: весь цикл работает внутри контекста приложения
-    with app.app_context():
-        while True:
-            try:
-                # --- ВРЕМЯ АЛМАТЫ ---
-                # Используем явную таймзону, чтобы не зависеть от времени сервера
-                now = datetime.now(ZoneInfo("Asia/Almaty"))
-                now_d = now.date()
-                target = now + timedelta(hours=1)
-
-                # ⛔️ Деактивируем просроченные подписки (end_date < today)
-                try:
-                    db.session.query(Subscription).filter(
-                        Subscription.status == 'active',
-                        Subscription.end_date.isnot(None),
-                        Subscription.end_date < now_d
-                    ).update({"status": "inactive"}, synchronize_session=False)
-                    db.session.commit()
-                except Exception:
-                    db.session.rollback()
-
-                # 1) Напоминания за 1 час (как было)
-                trainings = Training.query.filter(
-                    Training.date == target.date(),
-                    func.extract('hour', Training.start_time) == target.hour,
-                    func.extract('minute', Training.start_time) == target.minute
-                ).all()
-
-                for t in trainings:
-                    # СЦЕНАРИЙ 1: Групповая тренировка (уведомляем ВСЕХ участников)
-                    if t.group_id is not None:
-                        if not t.group_notified_1h:
-                            # Берем всех участников группы
-                            members = GroupMember.query.filter_by(group_id=t.group_id).all()
-
-                            # Также добавляем тренера, если он не участник, чтобы он тоже знал
-                            recipients_ids = {m.user_id for m in members}
-                            if t.trainer_id:
-                                recipients_ids.add(t.trainer_id)
-
-                            for uid in recipients_ids:
-                                u = db.session.get(User, uid)
-                                if not u: continue
-
-                                # Проверка настроек юзера (общая)
-                                settings = get_effective_user_settings(u)
-                                if not settings.notify_trainings: continue
-
-                                from notification_service import send_user_notification
-                                send_user_notification(
-                                    user_id=u.id,
-                                    title="⏰ Скоро тренировка!",
-                                    body=f"Команда собирается через час: «{t.title}». Не опаздывайте!",
-                                    type='reminder',
-                                    data={"training_id": str(t.id), "route": "/squad"}  # Ведем в сквад
-                                )
-
-                            # Помечаем тренировку как "оповещенную"
-                            t.group_notified_1h = True
-
-                    # СЦЕНАРИЙ 2: Публичная тренировка (по старой логике Signups)
-                    else:
-                        rows = TrainingSignup.query.filter_by(training_id=t.id, notified_1h=False).all()
-                        for s in rows:
-                            u = db.session.get(User, s.user_id)
-
-                            # --- 1. Проверяем ОБЩИЕ настройки ---
-                            if (not u or not getattr(u, "telegram_notify_enabled", True)  # (Оставляем старую настройку)
-                                    or not getattr(u, "notify_trainings", True)):
-                                s.notified_1h = True  # Помечаем, чтобы не спамить
-                                continue
-
-                            # --- 2. Формируем контент для PUSH ---
-                            when = t.start_time.strftime("%H:%M")
-                            date_s = t.date.strftime("%d.%m.%Y")
-                            title = "⏰ Напоминание о тренировке!"
-                            body = (
-                                f"Через 1 час: «{t.title or 'Онлайн-тренировка'}» с "
-                                f"{(t.trainer.name if t.trainer and getattr(t.trainer, 'name', None) else 'тренером')} в {when}."
-                            )
-
-                            # --- 3. Отправляем уведомление (БД + PUSH) ---
-                            # Импорт внутри функции для избежания циклических ссылок
-                            from notification_service import send_user_notification
-
-                            sent_mobile = send_user_notification(
-                                user_id=u.id,
-                                title=title,
-                                body=body,
-                                type='reminder',
-                                data={"training_id": str(t.id), "route": "/calendar"}
-                            )
-                            # Fallback на Telegram ПОЛНОСТЬЮ УБРАН
-
-                            # --- 4. Помечаем как "уведомлено" ---
-                            if sent_mobile:
-                                s.notified_1h = True
-                startings = Training.query.filter(
-                    Training.date == now.date(),
-                    func.extract('hour', Training.start_time) == now.hour,
-                    func.extract('minute', Training.start_time) == now.minute
-                ).all()
-
-                for t in startings:
-                    # СЦЕНАРИЙ 1: Групповая
-                    if t.group_id is not None:
-                        if not t.group_notified_start:
-                            members = GroupMember.query.filter_by(group_id=t.group_id).all()
-                            recipients_ids = {m.user_id for m in members}
-                            if t.trainer_id: recipients_ids.add(t.trainer_id)
-
-                            for uid in recipients_ids:
-                                u = db.session.get(User, uid)
-                                if not u: continue
-                                settings = get_effective_user_settings(u)
-                                if not settings.notify_trainings: continue
-
-                                from notification_service import send_user_notification
-                                send_user_notification(
-                                    user_id=u.id,
-                                    title="🚀 Тренировка началась!",
-                                    body=f"Заходите в видео-чат: «{t.title}».",
-                                    type='info',
-                                    data={"training_id": str(t.id), "route": "/squad"}
-                                )
-                            t.group_notified_start = True
-
-                    # СЦЕНАРИЙ 2: Публичная
-                    else:
-                        rows = TrainingSignup.query.filter_by(training_id=t.id).all()
-                        for s in rows:
-                            # пропускаем, если уже отмечали старт
-                            if getattr(s, "notified_start", False):
-                                continue
-                            u = db.session.get(User, s.user_id)
-
-                            # --- 1. Проверяем ОБЩИЕ настройки ---
-                            if (not u or not getattr(u, "telegram_notify_enabled", True)
-                                    or not getattr(u, "notify_trainings", True)):
-                                s.notified_start = True  # Помечаем, чтобы не спамить
-                                continue
-
-                            # --- 2. Формируем контент для PUSH ---
-                            when = t.start_time.strftime("%H:%M")
-                            date_s = t.date.strftime("%d.%m.%Y")
-                            title = "🏁 Тренировка начинается!"
-                            body = f"«{t.title or 'Онлайн-тренировка'}» началась. Тренер: {(t.trainer.name if t.trainer and getattr(t.trainer, 'name', None) else 'тренер')}."
-
-                            # --- 3. Отправляем уведомление (БД + PUSH) ---
-                            from notification_service import send_user_notification
-
-                            sent_mobile = send_user_notification(
-                                user_id=u.id,
-                                title=title,
-                                body=body,
-                                type='info',
-                                data={"training_id": str(t.id), "route": "/calendar"}
-                            )
-
-                            # Fallback на Telegram ПОЛНОСТЬЮ УБРАН
-
-                            # --- 4. Помечаем как "уведомлено" ---
-                            if sent_mobile:
-                                s.notified_start = True
-
-                users = User.query.all()
-                for u in users:
-                    sub = getattr(u, "subscription", None)
-                    if not sub or sub.status != 'active' or not sub.end_date:
-                        continue
-                    days_left = (sub.end_date - now_d).days
-
-                    # --- ИЗМЕНЕНИЕ: Проверяем fcm_token и настройки ---
-                    fcm_token = getattr(u, "fcm_device_token", None)
-                    settings = get_effective_user_settings(u)
-
-                    if days_left == 5 and not u.renewal_telegram_sent and fcm_token and settings.notify_subscription:
-                        try:
-                            # ссылка на продление
-                            base = os.getenv("APP_BASE_URL", "").rstrip("/")
-                            purchase_path = url_for("purchase_page") if app and app.app_context else "/purchase"
-                            link = f"{base}{purchase_path}" if base else purchase_path
-
-                            title = "⏳ Подписка истекает"
-                            body = "Осталось 5 дней. Не теряйте доступ к тренировкам — продлите сейчас."
-
-                            # --- ИЗМЕНЕНИЕ: Отправляем уведомление (БД + PUSH) ---
-                            from notification_service import send_user_notification
-
-                            if send_user_notification(
-                                    user_id=u.id,
-                                    title=title,
-                                    body=body,
-                                    type='warning',
-                                    data={"route": "/purchase"}
-                            ):
-                                u.renewal_telegram_sent = True
-                        except Exception:
-                            pass
-
-                if now.minute == 0 and now.hour == 10:
-                    two_weeks_ago = now_d - timedelta(days=14)
-
-                    # --- ИЗМЕНЕНИЕ: Ищем пользователей с FCM токеном ---
-                    users_to_remind = User.query.filter(User.fcm_device_token.isnot(None)).all()
-
-                    for u in users_to_remind:
-                        # Проверяем настройки уведомлений пользователя
-                        settings = get_effective_user_settings(u)
-
-                        # --- ИЗМЕНЕНИЕ: Проверяем общие PUSH-настройки (можно заменить на спец. настройку) ---
-                        if not settings.notify_meals:  # (Используем notify_meals как общий флаг для ЗОЖ)
-                            continue
-
-                        # Найти последний замер пользователя
-                        latest_analysis = BodyAnalysis.query.filter_by(user_id=u.id).order_by(
-                            BodyAnalysis.timestamp.desc()).first()
-
-                        if latest_analysis:
-                            # Проверяем, прошло ли 14 дней с последнего замера
-                            if latest_analysis.timestamp.date() <= two_weeks_ago:
-                                # Проверяем, не отправляли ли мы уже напоминание в последние 13 дней
-                                if u.last_measurement_reminder_sent_at is None or \
-                                        (now - u.last_measurement_reminder_sent_at).days >= 14:
-
-                                    # --- ИЗМЕНЕНИЕ: Отправляем уведомление (БД + PUSH) ---
-                                    from notification_service import send_user_notification
-
-                                    title = "⏰ Пора сделать замер!"
-                                    body = f"Привет, {u.name}! Прошло 2 недели с последнего замера. Пора обновить данные."
-
-                                    if send_user_notification(
-                                            user_id=u.id,
-                                            title=title,
-                                            body=body,
-                                            type='info',
-                                            data={"route": "/profile"}  # Открываем профиль для замера
-                                    ):
-                                        u.last_measurement_reminder_sent_at = now
-                                        db.session.commit()
-
-                                        # --- ЕЖЕНЕДЕЛЬНЫЕ ИТОГИ (Понедельник 09:00 Алматы) ---
-                                    if now.weekday() == 0 and now.hour == 9 and now.minute == 0:
-                                        # 1. Определяем даты прошлой недели (Пн-Вс)
-                                        today_date = now.date()
-                                        start_of_last_week = today_date - timedelta(days=7)
-                                        end_of_last_week = today_date - timedelta(days=1)
-
-                                        # 2. Проходим по всем группам
-                                        groups = Group.query.all()
-                                        for group in groups:
-                                            # Считаем очки за прошлую неделю
-                                            scores = db.session.query(
-                                                SquadScoreLog.user_id,
-                                                func.sum(SquadScoreLog.points).label('total')
-                                            ).filter(
-                                                SquadScoreLog.group_id == group.id,
-                                                func.date(SquadScoreLog.created_at) >= start_of_last_week,
-                                                func.date(SquadScoreLog.created_at) <= end_of_last_week
-                                            ).group_by(SquadScoreLog.user_id).order_by(text('total DESC')).all()
-
-                                            # 3. Рассылаем уведомления Топ-3
-                                            for rank, (uid, score) in enumerate(scores[:3]):
-                                                place = rank + 1
-                                                medals = {1: "🥇", 2: "🥈", 3: "🥉"}
-
-                                                title_msg = f"Итоги недели: {place} место! {medals.get(place, '')}"
-                                                body_msg = f"Так держать! Вы набрали {score} баллов и заняли {place} место в отряде {group.name}."
-
-                                                from notification_service import send_user_notification
-                                                send_user_notification(
-                                                    user_id=uid,
-                                                    title=title_msg,
-                                                    body=body_msg,
-                                                    type='success',
-                                                    data={"route": "/squad", "args": "stories"}  # Откроет сторис
-                                                )
-
-                                            # Уведомление для остальных (чтобы зашли посмотреть сторис)
-                                            for uid, score in scores[3:]:
-                                                from notification_service import send_user_notification
-                                                send_user_notification(
-                                                    user_id=uid,
-                                                    title="Итоги недели подведены 📊",
-                                                    body=f"Посмотрите результаты битвы в отряде {group.name}!",
-                                                    type='info',
-                                                    data={"route": "/squad", "args": "stories"}
-                                                )
-
-                db.session.commit()
-            except Exception:
-                db.session.rollback()
-            finally:
-                db.session.remove()
-                time_mod.sleep(60)
-
 def create_app():
     app = Flask(__name__)
 
@@ -738,14 +444,6 @@ def get_effective_user_settings(u):
         db.session.add(s)
         db.session.commit()
     return s
-def start_training_notifier():
-    global _notifier_started
-    if _notifier_started:
-        return
-    _notifier_started = True
-    if os.getenv("ENABLE_TRAINING_NOTIFIER", "1") == "1":
-        th = threading.Thread(target=_notification_worker, daemon=True)
-        th.start()
 
 def _ensure_column(table, column, ddl):
     # инспектору передаём «сырое» имя (без кавычек), он сам разберётся
@@ -760,6 +458,15 @@ def _ensure_column(table, column, ddl):
             con.execute(text(f'ALTER TABLE {table_q} ADD COLUMN {column_q} {ddl}'))
 
 
+def _ensure_index(name, table, columns_sql):
+    table_q = db.engine.dialect.identifier_preparer.quote(table)
+    try:
+        with db.engine.begin() as con:
+            con.execute(text(f'CREATE INDEX IF NOT EXISTS {name} ON {table_q} ({columns_sql})'))
+    except Exception as e:
+        print(f"[auto-migrate] index {name} failed: {e}")
+
+
 def _auto_migrate_diet_schema():
     insp = inspect(db.engine)
     # Создадим недостающие таблицы по моделям
@@ -800,8 +507,27 @@ def _auto_migrate_onboarding_schema():
 
     # --- НОВАЯ СТРОКА ---
     _ensure_column("user", "fcm_device_token", "TEXT")  # Добавляем колонку для FCM
+    _ensure_column("user", "fcm_failure_count", "INTEGER NOT NULL DEFAULT 0")
+    _ensure_column("user_settings", "meal_times", "TEXT")
+    _ensure_column("user", "fcm_last_failure_at", "TIMESTAMP")
     # ---
 
+    # === Инкрементальный стрик ===
+    _ensure_column("user", "longest_streak", "INTEGER NOT NULL DEFAULT 0")
+    _ensure_column("user", "last_logged_date", "DATE")
+    _ensure_column("user", "snapshot_version", "INTEGER NOT NULL DEFAULT 0")
+    # У старых записей есть только current_streak — достраиваем дату последней еды
+    try:
+        with db.engine.begin() as con:
+            con.execute(text(
+                'UPDATE "user" SET '
+                'last_logged_date = (SELECT MAX(m.date) FROM meal_logs m WHERE m.user_id = "user".id), '
+                'longest_streak = CASE WHEN longest_streak < current_streak THEN current_streak ELSE longest_streak END '
+                'WHERE last_logged_date IS NULL AND current_streak > 0'
+            ))
+    except Exception as e:
+        print(f"[auto-migrate] backfill streak state failed: {e}")
+
     # === Поля для верификации почты ===
     _ensure_column("user", "verification_code", "TEXT")
     _ensure_column("user", "verification_code_expires_at", "TIMESTAMP")
@@ -810,34 +536,27 @@ def _auto_migrate_onboarding_schema():
     # === ВАЖНО: meal_logs нужные поля ===
     _ensure_column("meal_logs", "image_path", "TEXT")
 
+    # === Поиск по префиксу в админке (admin_overview.user_page) ===
+    # В Postgres LIKE 'abc%' по индексу работает только с text_pattern_ops (при не-C collation)
+    ops = " text_pattern_ops" if db.engine.dialect.name == "postgresql" else ""
+    _ensure_index("ix_user_email_lower", "user", f"lower(email){ops}")
+    _ensure_index("ix_user_name_lower", "user", f"lower(name){ops}")
+
 with app.app_context():
     # Мини-миграции для новых полей в user
     _auto_migrate_diet_schema()
     _auto_migrate_onboarding_schema()
+    try:
+        backfill_energy_balance()
+    except Exception as e:
+        db.session.rollback()
+        print(f"[auto-migrate] energy balance backfill failed: {e}")
 
-    # Запускаем фоновые задачи ТОЛЬКО после инициализации БД
-
-    # (Мы убрали try/except отсюда и перенесли вызов ниже)
-
-    # Запускаем автогенерацию диет один раз (не в мастер-процессе reloader’a)
-    import os as _os
-
-    if _os.environ.get("WERKZEUG_RUN_MAIN") == "true":
-
-        # --- ИЗМЕНЕНИЕ: ПЕРЕМЕСТИЛИ ПЛАНИРОВЩИК ЕДЫ СЮДА ---
-        try:
-            start_meal_scheduler(app)
-            # (Логгирование будет в самой функции)
-        except Exception as e:
-            print(f"[meal_scheduler] scheduler error: {e}")  # <-- Добавили лог ошибки
-
-        try:
-            start_diet_autogen_scheduler(app)
-            print("[diet_autogen] scheduler started")
-        except Exception as e:
-            print(f"[diet_autogen] scheduler error: {e}")
-
-    start_training_notifier()
+    # Запускаем фоновые задачи ТОЛЬКО после инициализации БД.
+    # Шедулеры поднимаются в каждом процессе на паузе, выполняет задачи только лидер (см. job_runner).
+    # В мастер-процессе reloader'а (python app.py с debug) не стартуем — он не обслуживает код.
+    if __name__ != "__main__" or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_job_runner(app)
 
 
 
@@ -1049,6 +768,7 @@ def create_training():
         # страхуемся на случай гонок по trainer_id uniq
         abort(409, description="На это время уже есть тренировка")
 
+    schedule_training_notifications(t)
     return jsonify({"ok": True, "data": t.to_dict(u.id)})
 
 @app.route('/api/trainings/<int:tid>', methods=['PUT'])
@@ -1065,6 +785,7 @@ def update_training(tid):
     if 'meeting_link' in data:
         t.meeting_link = _validate_meeting_link(data.get('meeting_link') or '')
 
+    old_start = (t.date, t.start_time)
     if 'date' in data:
         t.date = _parse_date_yyyy_mm_dd(data.get('date') or '')
     if 'start_time' in data:
@@ -1099,12 +820,23 @@ def update_training(tid):
     if conflict:
         abort(409, description="На это время уже есть тренировка")
 
+    # Перенесли тренировку — уведомления должны уйти заново к новому времени
+    time_changed = (t.date, t.start_time) != old_start
+    if time_changed:
+        t.group_notified_1h = False
+        t.group_notified_start = False
+        for s in t.signups:
+            s.notified_1h = False
+            s.notified_start = False
+
     try:
         db.session.commit()
     except IntegrityError:
         db.session.rollback()
         abort(409, description="На это время уже есть тренировка")
 
+    if time_changed:
+        schedule_training_notifications(t)
     return jsonify({"ok": True, "data": t.to_dict(u.id)})
 
 @app.route('/api/trainings/<int:tid>', methods=['DELETE'])
@@ -1117,6 +849,7 @@ def delete_training(tid):
         abort(403)
     db.session.delete(t)
     db.session.commit()
+    unschedule_training_notifications(tid)
     return jsonify({"ok": True})
 
 # ------------------ UTILS ------------------
@@ -1275,224 +1008,22 @@ def instructions_page():
 def app_profile_data():
     """
     Отдает один большой JSON со всеми данными,
-    нужными для главной страницы профиля в приложении.
+    нужными для главной страницы профиля в приложении (см. profile_snapshot).
     """
     user = get_current_user()
-
-    # --- 1. ИНИЦИАЛИЗАЦИЯ ВСЕХ ПЕРЕМЕННЫХ ---
-    diet_data = None
-    fat_loss_progress_data = None
-    progress_checkpoints = []
-    latest_analysis_data = None
-
-    # Рассчитываем статус за последние 7 дней для визуализации сердечек
-    today = date.today()
-    last_7_days_status = []
-    # Идем от 6 дней назад до сегодня (слева направо: [День-6, ..., Сегодня])
-    for i in range(6, -1, -1):
-        d = today - timedelta(days=i)
-        # Проверяем наличие записи еды за этот день
-        has_log = db.session.query(MealLog.id).filter_by(user_id=user.id, date=d).first() is not None
-        last_7_days_status.append(has_log)
-
-    # --- СБОР ДАННЫХ ПОЛЬЗОВАТЕЛЯ ---
-    # Мы используем .get(), чтобы не было ошибок, если в базе null
-    show_popup = bool(getattr(user, 'show_welcome_popup', False))
-
-    user_data = {
-        "id": user.id,
-        "name": user.name,
-        "email": user.email,
-        "has_subscription": bool(getattr(user, 'has_subscription', False)),
-        "is_trainer": bool(getattr(user, 'is_trainer', False)),
-        "avatar_filename": user.avatar.filename if user.avatar else None,
-        "current_streak": getattr(user, "current_streak", 0),
-        "last_7_days_status": last_7_days_status,
-        "show_welcome_popup": show_popup
-    }
-
-    # --- 3. Данные о диете ---
-    diet_obj = Diet.query.filter_by(user_id=user.id).order_by(Diet.date.desc()).first()
-    if diet_obj:
-        try:
-            diet_data = {
-                "id": diet_obj.id,
-                "total_kcal": diet_obj.total_kcal,
-                "protein": diet_obj.protein,
-                "fat": diet_obj.fat,
-                "carbs": diet_obj.carbs,
-                "meals": {
-                    "breakfast": json.loads(diet_obj.breakfast or "[]"),
-                    "lunch": json.loads(diet_obj.lunch or "[]"),
-                    "dinner": json.loads(diet_obj.dinner or "[]"),
-                    "snack": json.loads(diet_obj.snack or "[]"),
-                }
-            }
-        except Exception:
-            diet_data = None  # Ошибка парсинга JSON
-
-    # --- 4. Данные о прогрессе ---
-    latest_analysis = BodyAnalysis.query.filter_by(user_id=user.id).order_by(BodyAnalysis.timestamp.desc()).first()
-    if latest_analysis:
-        calculated_fat_percentage = 0.0
-        try:
-            if latest_analysis.weight and latest_analysis.weight > 0 and latest_analysis.fat_mass:
-                calculated_fat_percentage = (latest_analysis.fat_mass / latest_analysis.weight) * 100
-        except Exception:
-            pass
-
-        latest_analysis_data = {
-            'timestamp': latest_analysis.timestamp.isoformat() if latest_analysis.timestamp else None,  # <--- ДОБАВЛЕНО
-            'height': latest_analysis.height,
-            'weight_kg': latest_analysis.weight,
-            'muscle_mass_kg': latest_analysis.muscle_mass,
-            'body_fat_percentage': calculated_fat_percentage,
-            'body_water': latest_analysis.body_water,
-            'protein_percentage': latest_analysis.protein_percentage,
-            'skeletal_muscle_mass': latest_analysis.skeletal_muscle_mass,
-            'visceral_fat_level': latest_analysis.visceral_fat_rating,
-            'metabolism': latest_analysis.metabolism,
-            'waist_hip_ratio': latest_analysis.waist_hip_ratio,
-            'body_age': latest_analysis.body_age,
-            'fat_mass_kg': latest_analysis.fat_mass,
-            'bmi': latest_analysis.bmi,
-            'fat_free_body_weight': latest_analysis.fat_free_body_weight
-        }
-
-    initial_analysis = db.session.get(BodyAnalysis,
-                                      user.initial_body_analysis_id) if user.initial_body_analysis_id else None
-
-    # (Логика расчета прогресса)
-    if initial_analysis and latest_analysis and latest_analysis.fat_mass and user.fat_mass_goal and initial_analysis.fat_mass is not None and user.fat_mass_goal is not None and initial_analysis.fat_mass > user.fat_mass_goal:
-        try:
-            initial_fat_mass = float(initial_analysis.fat_mass)
-            # current_fat_mass берем пока из последнего анализа, но ниже скорректируем его прогнозом
-            current_fat_mass = latest_analysis.fat_mass
-            goal_fat_mass = user.fat_mass_goal
-
-            # --- НАЧАЛО ВНЕДРЕНИЯ ПРОГНОЗА (из web-версии) ---
-            KCAL_PER_KG_FAT = 7700
-            start_datetime = latest_analysis.timestamp
-            today_date = date.today()
-
-            # 1. Забираем логи еды и активности ПОСЛЕ последнего замера
-            meal_logs_since = MealLog.query.filter(
-                MealLog.user_id == user.id,
-                MealLog.date >= start_datetime.date()
-            ).all()
-
-            activity_logs_since = Activity.query.filter(
-                Activity.user_id == user.id,
-                Activity.date >= start_datetime.date()
-            ).all()
-
-            # 2. Группируем в словари для быстрого доступа
-            meals_map = {}
-            for log in meal_logs_since:
-                meals_map.setdefault(log.date, 0)
-                meals_map[log.date] += log.calories
-
-            activity_map = {log.date: log.active_kcal for log in activity_logs_since}
-
-            total_accumulated_deficit = 0
-            metabolism = latest_analysis.metabolism or 0
-            delta_days = (today_date - start_datetime.date()).days
-
-            if delta_days >= 0:
-                for i in range(delta_days + 1):
-                    current_day = start_datetime.date() + timedelta(days=i)
-                    consumed = meals_map.get(current_day, 0)
-                    burned_active = activity_map.get(current_day, 0)
-
-                    # В день замера: учитываем только то, что съедено ПОСЛЕ времени замера
-                    if i == 0:
-                        calories_before_analysis = db.session.query(func.sum(MealLog.calories)).filter(
-                            MealLog.user_id == user.id,
-                            MealLog.date == current_day,
-                            MealLog.created_at < start_datetime
-                        ).scalar() or 0
-                        consumed -= calories_before_analysis
-                        # Активность в день замера игнорируем для "безопасности" (как в веб-версии)
-                        burned_active = 0
-
-                    daily_deficit = (metabolism + burned_active) - consumed
-                    if daily_deficit > 0:
-                        total_accumulated_deficit += daily_deficit
-
-            # 3. Рассчитываем, сколько жира "должно было" уйти
-            estimated_burned_kg = total_accumulated_deficit / KCAL_PER_KG_FAT
-
-            # 4. Обновляем текущий вес жира (прогноз)
-            current_fat_mass = current_fat_mass - estimated_burned_kg
-
-            # --- КОНЕЦ ВНЕДРЕНИЯ ---
-
-            total_fat_to_lose_kg = initial_fat_mass - goal_fat_mass
-            fat_lost_so_far_kg = initial_fat_mass - current_fat_mass  # Используем обновленный current
-
-            percentage = 0
-            if total_fat_to_lose_kg > 0:
-                percentage = (fat_lost_so_far_kg / total_fat_to_lose_kg) * 100
-
-            fat_loss_progress_data = {
-                'percentage': min(100, max(0, percentage)),
-                'burned_kg': fat_lost_so_far_kg,
-                'total_to_lose_kg': total_fat_to_lose_kg,
-                'initial_kg': initial_fat_mass,
-                'goal_kg': goal_fat_mass,
-                'current_kg': current_fat_mass  # Прогнозируемое значение
-            }
-        except Exception as e:
-            print(f"Error calculating fat loss: {e}")
-            fat_loss_progress_data = None
-
-        all_analyses_for_progress_data = []
-        if user.initial_body_analysis_id:
-            initial_analysis_for_chart = db.session.get(BodyAnalysis, user.initial_body_analysis_id)
-            if initial_analysis_for_chart:
-                analyses_objects = BodyAnalysis.query.filter(
-                    BodyAnalysis.user_id == user.id,
-                    BodyAnalysis.timestamp >= initial_analysis_for_chart.timestamp
-                ).order_by(BodyAnalysis.timestamp.asc()).all()
-
-                all_analyses_for_progress_data = [
-                    {
-                        "timestamp": analysis.timestamp.isoformat(),
-                        "fat_mass": analysis.fat_mass
-                    }
-                    for analysis in analyses_objects
-                ]
-
-        if fat_loss_progress_data and all_analyses_for_progress_data and fat_loss_progress_data['total_to_lose_kg'] > 0:
-            initial_fat = fat_loss_progress_data['initial_kg']
-            total_to_lose = fat_loss_progress_data['total_to_lose_kg']
-
-            for i, analysis_data in enumerate(all_analyses_for_progress_data):
-                current_fat_at_point = analysis_data.get('fat_mass') or initial_fat
-                fat_lost_at_point = initial_fat - current_fat_at_point
-                percentage_at_point = (fat_lost_at_point / total_to_lose) * 100
-
-                progress_checkpoints.append({
-                    "number": i + 1,
-                    "percentage": min(100, max(0, percentage_at_point))
-                })
-
-    return jsonify({
-        "ok": True,
-        "data": {
-            "user": user_data,
-            "diet": diet_data,
-            "fat_loss_progress": fat_loss_progress_data,
-            "progress_checkpoints": progress_checkpoints,
-            "latest_analysis": latest_analysis_data
-        }
-    })
+    if user is None:
+        return jsonify({"ok": False, "error": "user not found"}), 404
+    return snapshot_response("profile", user, lambda: {"ok": True, "data": build_profile_snapshot(user.id)})
 
 @app.route('/api/app/meals/today')
 @login_required
 def app_get_today_meals():
-    """ API-версия /api/meals/today/<chat_id> , но использующая сессию """
+    """ API-версия /api/meals/today/<chat_id> , но использующая сессию (с ETag, см. snapshot_cache) """
     user = get_current_user()
+    return snapshot_response("meals_today", user, lambda: _today_meals_payload(user))
+
+
+def _today_meals_payload(user):
     logs = MealLog.query.filter_by(user_id=user.id, date=date.today()).order_by(MealLog.created_at).all()
     total_calories = sum(m.calories for m in logs)
 
@@ -1520,12 +1051,12 @@ def app_get_today_meals():
             "carbs": diet.carbs or 0
         }
 
-    return jsonify({
+    return {
         "meals": meal_data,
         "total_calories": total_calories,
         "diet_total_calories": diet_calories,
         "diet_macros": diet_macros
-    }), 200
+    }
 
 
 @app.route('/api/app/log_meal', methods=['POST'])
@@ -1560,12 +1091,12 @@ def app_log_meal():
     try:
         db.session.add(meal)
 
-        # 1. Пересчитываем стрик
-        recalculate_streak(user)
+        # 1. Обновляем стрик (O(1), без пересканирования MealLog)
+        streak_grew = on_meal_logged(user)
 
         # --- AI FEED: STREAK MILESTONES ---
         s = getattr(user, 'current_streak', 0)
-        if s > 0 and (s == 3 or s % 7 == 0):
+        if streak_grew and (s == 3 or s % 7 == 0):
             trigger_ai_feed_post(user, f"Участник держит стрик питания уже {s} дней подряд!")
         # ----------------------------------
 
@@ -1587,22 +1118,17 @@ def app_log_meal():
                 award_squad_points(user, 'food_log', 10, "Дневной рацион выполнен")
         # ----------------------------------------
 
-        # --- ПРОВЕРКА АЧИВОК ---
-        check_all_achievements(user)
+        # --- ПРОВЕРКА АЧИВОК (только правила, подписанные на эти события) ---
+        events = (MEAL_LOGGED, STREAK_CHANGED) if streak_grew else (MEAL_LOGGED,)
+        new_achievements = on_achievement_event(user, *events)
 
-        # Проверяем новые ачивки для поста в ленту
+        # Новые ачивки — пост в ленту
         try:
-            if hasattr(UserAchievement, 'created_at'):
-                recent_achievements = UserAchievement.query.filter(
-                    UserAchievement.user_id == user.id,
-                    UserAchievement.created_at >= datetime.now(UTC) - timedelta(seconds=15)
-                ).all()
-
-                for ach in recent_achievements:
-                    meta = ACHIEVEMENTS_METADATA.get(ach.slug)
-                    if meta:
-                        title = meta['title']
-                        trigger_ai_feed_post(user, f"Получено новое достижение: «{title}»!")
+            for slug in new_achievements:
+                meta = ACHIEVEMENTS_METADATA.get(slug)
+                if meta:
+                    title = meta['title']
+                    trigger_ai_feed_post(user, f"Получено новое достижение: «{title}»!")
         except Exception as e:
             print(f"Error posting achievement feed: {e}")
 
@@ -1611,18 +1137,11 @@ def app_log_meal():
         db.session.commit()
 
         # ANALYTICS: Meal Logged (Backend backup)
-        try:
-            amplitude.track(BaseEvent(
-                event_type="Meal Logged",
-                user_id=str(user.id),
-                event_properties={
-                    "meal_type": data['meal_type'],
-                    "calories": int(data.get('calories', 0)),
-                    "has_analysis": bool(data.get('analysis'))
-                }
-            ))
-        except Exception as e:
-            print(f"Amplitude error: {e}")
+        track_event('meal_logged', user.id, {
+            "meal_type": data['meal_type'],
+            "calories": int(data.get('calories', 0)),
+            "has_analysis": bool(data.get('analysis'))
+        })
 
         return jsonify({"status": "ok"}), 200
 
@@ -1923,20 +1442,7 @@ def api_register_v2():
         session['user_id'] = user.id
 
         # ANALYTICS: Sign Up Completed
-        try:
-            amplitude.track(BaseEvent(
-                event_type="Sign Up Completed",
-                user_id=str(user.id),
-                event_properties={
-                    "method": "email",
-                    "has_avatar": True,
-                    "sex": sex
-                }
-            ))
-            # INTERNAL ANALYTICS
-            track_event('signup_completed', user.id, {"method": "email", "sex": sex})
-        except Exception as e:
-            print(f"Amplitude error: {e}")
+        track_event('signup_completed', user.id, {"method": "email", "has_avatar": True, "sex": sex})
 
         return jsonify({
             "ok": True,
@@ -2148,7 +1654,7 @@ def api_analytics_track():
     # track_event сам разберется с user_id из сессии (cookie)
     # Если сессии нет (юзер еще не вошел), событие запишется как анонимное (user_id=None),
     # но мы все равно увидим общее количество таких событий в воронке.
-    track_event(event_name, data=props)
+    track_event(event_name, data=props, forward=False)
 
     return jsonify({"ok": True})
 
@@ -2483,7 +1989,6 @@ def profile():
     # --- Прогресс жиросжигания (УЛУЧШЕННАЯ ЛОГИКА С ПРОГНОЗОМ) ---
     fat_loss_progress = None
     progress_checkpoints = []  # <-- добавили дефолт
-    KCAL_PER_KG_FAT = 7700  # Энергетическая ценность 1 кг жира
 
     # Получаем стартовый и последний анализы
     initial_analysis = db.session.get(BodyAnalysis,
@@ -2499,48 +2004,7 @@ def profile():
         fact_lost_so_far_kg = initial_fat_mass - last_measured_fat_mass
 
         # --- 2. Расчет прогнозируемого прогресса на основе дефицита калорий ПОСЛЕ последнего замера ---
-        start_datetime = latest_analysis.timestamp
-        today_date = date.today()
-
-        meal_logs_since_last_analysis = MealLog.query.filter(
-            MealLog.user_id == user.id,
-            MealLog.date >= start_datetime.date()
-        ).all()
-        activity_logs_since_last_analysis = Activity.query.filter(
-            Activity.user_id == user.id,
-            Activity.date >= start_datetime.date()
-        ).all()
-
-        meals_map = {}
-        for log in meal_logs_since_last_analysis:
-            meals_map.setdefault(log.date, 0)
-            meals_map[log.date] += log.calories
-
-        activity_map = {log.date: log.active_kcal for log in activity_logs_since_last_analysis}
-
-        total_accumulated_deficit = 0
-        metabolism = latest_analysis.metabolism or 0
-
-        delta_days = (today_date - start_datetime.date()).days
-
-        if delta_days >= 0:
-            for i in range(delta_days + 1):
-                current_day = start_datetime.date() + timedelta(days=i)
-                consumed = meals_map.get(current_day, 0)
-                burned_active = activity_map.get(current_day, 0)
-
-                if i == 0:
-                    calories_before_analysis = db.session.query(func.sum(MealLog.calories)).filter(
-                        MealLog.user_id == user.id,
-                        MealLog.date == current_day,
-                        MealLog.created_at < start_datetime
-                    ).scalar() or 0
-                    consumed -= calories_before_analysis
-                    burned_active = 0
-
-                daily_deficit = (metabolism + burned_active) - consumed
-                if daily_deficit > 0:
-                    total_accumulated_deficit += daily_deficit
+        total_accumulated_deficit, _ = deficit_since_analysis(user.id, latest_analysis)
 
         estimated_burned_since_last_measurement_kg = total_accumulated_deficit / KCAL_PER_KG_FAT
 
@@ -2775,8 +2239,7 @@ def meals():
                 db.session.add(new_meal)
                 flash(f"Приём пищи '{meal_type.capitalize()}' успешно добавлен!", "success")
 
-                # Честный пересчет
-            recalculate_streak(user)  # <-- Добавлено
+            on_meal_logged(user)
 
             db.session.commit()
 
@@ -2942,26 +2405,19 @@ def confirm_analysis():
                             # 8. Сохраняем все
                         db.session.commit()
 
+                # Сохраняем анализ при любом исходе скоринга выше
+                db.session.commit()
+
                 # 9. Возвращаем JSON с AI-комментарием
 
                 # ANALYTICS: Body Analysis Confirmed
-                try:
-                    amplitude.track(BaseEvent(
-                        event_type="Body Analysis Confirmed",
-                        user_id=str(user.id),
-                        event_properties={
-                            "weight": new_analysis_entry.weight,
-                            "fat_mass": new_analysis_entry.fat_mass,
-                            "muscle_mass": new_analysis_entry.muscle_mass,
-                            "has_ai_comment": bool(ai_comment_text),
-                            "is_initial": (user.initial_body_analysis_id == new_analysis_entry.id)
-                        }
-                    ))
-                except Exception as e:
-                    print(f"Amplitude error: {e}")
-
-                track_event('analysis_confirmed', user.id,
-                            {"is_initial": (user.initial_body_analysis_id == new_analysis_entry.id)})
+                track_event('analysis_confirmed', user.id, {
+                    "weight": new_analysis_entry.weight,
+                    "fat_mass": new_analysis_entry.fat_mass,
+                    "muscle_mass": new_analysis_entry.muscle_mass,
+                    "has_ai_comment": bool(ai_comment_text),
+                    "is_initial": (user.initial_body_analysis_id == new_analysis_entry.id)
+                })
                 return jsonify({"success": True, "ai_comment": ai_comment_text})
 
             # --- ЛОГИКА GET-ЗАПРОСА (Для Веб-версии) ---
@@ -3112,18 +2568,11 @@ def generate_diet():
         )
 
         # ANALYTICS: Diet Generated
-        try:
-            amplitude.track(BaseEvent(
-                event_type="Diet Generated",
-                user_id=str(user.id),
-                event_properties={
-                    "goal": goal,
-                    "total_kcal": diet_data.get('total_kcal'),
-                    "has_preferences": bool(preferences)
-                }
-            ))
-        except Exception as e:
-            print(f"Amplitude error: {e}")
+        track_event('diet_generated', user.id, {
+            "goal": goal,
+            "total_kcal": diet_data.get('total_kcal'),
+            "has_preferences": bool(preferences)
+        })
 
         return jsonify({"redirect": "/diet"})
 
@@ -3465,6 +2914,7 @@ def add_meal():
             db.session.add(new_meal)
             flash(f"Приём пищи '{meal_type.capitalize()}' успешно добавлен!", "success")
 
+        on_meal_logged(get_current_user(), today)
         db.session.commit()
 
     except (ValueError, TypeError) as e:
@@ -3608,6 +3058,7 @@ def log_meal():
             meal_type=data['meal_type']
         ).first_or_404()
         db.session.delete(meal)
+        on_meal_deleted(user)
         db.session.commit()
         return '', 200
 
@@ -3648,7 +3099,7 @@ def log_meal():
 
     try:
         db.session.add(meal)
-        recalculate_streak(user)  # <-- Добавлено
+        on_meal_logged(user)
         db.session.commit()
         return jsonify({"status": "ok"}), 200
     except IntegrityError:
@@ -3965,104 +3416,42 @@ def registered_chats():
 @app.route("/admin")
 @admin_required  # Защита маршрута для админа
 def admin_dashboard():
-    users = User.query.order_by(User.id).all()  # Order by ID for stable display
-    today = date.today()
-
-    statuses = {}
-    details = {}
-
-    # Define metrics consistent with profile.html
-    metrics_def = [
-        ('Рост', 'height', '📏', 'см', True),
-        ('Вес', 'weight', '⚖️', 'кг', False),
-        ('Мышцы', 'muscle_mass', '💪', 'кг', True),
-        ('Жир', 'fat_mass', '🧈', 'кг', False),
-        ('Вода', 'body_water', '💧', '%', True),
-        ('Метаболизм', 'metabolism', '⚡', 'ккал', True),
-        ('Белок', 'protein_percentage', '🥚', '%', True),
-        ('Висц. жир', 'visceral_fat_rating', '🔥', '', False),
-        ('ИМТ', 'bmi', '📐', '', False),
-    ]
+    # Оболочка страницы — постоянное время; строки и сводки подгружаются из /api/admin/users
+    return render_template(
+        "admin_dashboard.html",
+        today=date.today(),
+        per_page=ADMIN_USERS_PER_PAGE
+    )
 
-    for u in users:
-        # statuses
-        has_meal = MealLog.query.filter_by(user_id=u.id, date=today).count() > 0
-        has_activity = Activity.query.filter_by(user_id=u.id, date=today).count() > 0
-        statuses[u.id] = {
-            'meal': has_meal,
-            'activity': has_activity,
-            'subscription_active': u.has_subscription  # Проверяем наличие активной подписки
-        }
-        # meals
-        meals = MealLog.query.filter_by(user_id=u.id, date=today).all()
-        meals_data = [{
-            'type': m.meal_type,
-            'cal': m.calories,
-            'prot': m.protein,
-            'fat': m.fat,
-            'carbs': m.carbs
-        } for m in meals]
-
-        # activity
-        act = Activity.query.filter_by(user_id=u.id, date=today).first()
-        activity_data = None
-        if act:
-            activity_data = {
-                'steps': act.steps,
-                'active_kcal': act.active_kcal,
-                'resting_kcal': act.resting_kcal,
-                'distance_km': act.distance_km,
-                'hr_avg': act.heart_rate_avg
-            }
 
-        # body analysis
-        last = BodyAnalysis.query.filter_by(user_id=u.id) \
-            .order_by(BodyAnalysis.timestamp.desc()).first()
-        prev = BodyAnalysis.query.filter_by(user_id=u.id) \
-            .order_by(BodyAnalysis.timestamp.desc()).offset(1).first()
-
-        # metrics with deltas
-        metrics = []
-        for label, field, icon, unit, good_up in metrics_def:
-            cur = getattr(last, field, None)
-            pr = getattr(prev, field, None)
-            diff = pct = arrow = None
-            is_good = None
-            if cur is not None and pr is not None:
-                diff = cur - pr
-                if pr != 0:
-                    pct = diff / pr * 100
-                arrow = '↑' if diff > 0 else '↓' if diff < 0 else ''
-                # Handle cases where diff is 0 for arrow display
-                if diff == 0:
-                    arrow = ''  # No arrow for no change
-                    is_good = True  # Can consider no change as good/neutral
-                else:
-                    is_good = (diff > 0 and good_up) or (diff < 0 and not good_up)
-            metrics.append({
-                'label': label,
-                'icon': icon,
-                'unit': unit,
-                'cur': cur,
-                'diff': diff,
-                'pct': pct,
-                'arrow': arrow,
-                'is_good': is_good
-            })
+@app.route("/api/admin/users")
+@admin_required
+def admin_users_api():
+    """Keyset-страница пользователей: ?q=&sub=&trainer=&squad=&meal=&activity=&sort=&dir=&cursor=&limit="""
+    args = request.args
+    page = admin_user_page(
+        q=args.get('q'),
+        sub=args.get('sub', 'any'),
+        trainer=args.get('trainer', 'any'),
+        squad=args.get('squad', 'any'),
+        meal=args.get('meal', 'any'),
+        activity=args.get('activity', 'any'),
+        sort=args.get('sort', 'id'),
+        direction=args.get('dir', 'asc'),
+        cursor=args.get('cursor'),
+        limit=args.get('limit', ADMIN_USERS_PER_PAGE, type=int),
+    )
+    return jsonify({"ok": True, **page})
 
-        details[u.id] = {
-            'meals': meals_data,
-            'activity': activity_data,
-            'metrics': metrics
-        }
 
-    return render_template(
-        "admin_dashboard.html",
-        users=users,
-        statuses=statuses,
-        details=details,
-        today=today
-    )
+@app.route("/api/admin/users/<int:user_id>/summary")
+@admin_required
+def admin_user_summary_api(user_id):
+    """Сводка для раскрытой строки: еда и активность за сегодня, последние замеры с дельтами."""
+    summary = admin_user_summary(user_id)
+    if summary is None:
+        return jsonify({"ok": False, "error": "not_found"}), 404
+    return jsonify({"ok": True, "summary": summary})
 
 
 # ===== ADMIN: Заявки на подписку =====
@@ -4320,6 +3709,10 @@ def admin_delete_user(user_id):
 
         # === 6) Пищевые логи / активность / анализы / диеты / логи напоминаний
         MealReminderLog.query.filter_by(user_id=user.id).delete(synchronize_session=False)
+        UserAchievement.query.filter_by(user_id=user.id).delete(synchronize_session=False)
+        AchievementProgress.query.filter_by(user_id=user.id).delete(synchronize_session=False)
+        DailyEnergyBalance.query.filter_by(user_id=user.id).delete(synchronize_session=False)
+        AnalyticsFirstEvent.query.filter_by(user_id=user.id).delete(synchronize_session=False)
         MealLog.query.filter_by(user_id=user.id).delete(synchronize_session=False)
         Activity.query.filter_by(user_id=user.id).delete(synchronize_session=False)
         BodyAnalysis.query.filter_by(user_id=user.id).delete(synchronize_session=False)
@@ -4395,123 +3788,14 @@ def group_detail(group_id):
     user = get_current_user()
     is_member = any(m.user_id == user.id for m in group.members)
 
-    raw_messages = GroupMessage.query.filter_by(group_id=group.id).order_by(GroupMessage.timestamp.desc()).all()
-    processed_messages = []
-    last_sender_id = None
-    for message in raw_messages:
-        show_avatar = (message.user_id != last_sender_id)
-        processed_messages.append({
-            'id': message.id, 'group_id': message.group_id, 'user_id': message.user_id, 'user': message.user,
-            'text': message.text, 'timestamp': message.timestamp, 'image_file': message.image_file,
-            'reactions': message.reactions, 'show_avatar': show_avatar, 'is_current_user': (message.user_id == user.id)
-        })
-        last_sender_id = message.user_id
+    # Сообщения шаблон не выводит (чат отдаёт /api/groups/<id>/messages) — здесь их не выбираем
     all_posts = GroupTask.query.filter_by(group_id=group.id).order_by(GroupTask.created_at.desc()).all()
 
     group_member_stats = []
+    upcoming_trainings = []
     if user.is_trainer and group.trainer_id == user.id:
-        today = date.today()
-        all_relevant_members = [m.user for m in group.members]
-        if group.trainer not in all_relevant_members and group.trainer.email != ADMIN_EMAIL:
-            all_relevant_members.append(group.trainer)
-
-        for member_user in all_relevant_members:
-            if member_user.email == ADMIN_EMAIL and not any(m.user_id == member_user.id for m in group.members):
-                continue
-
-            latest_analysis = BodyAnalysis.query.filter_by(user_id=member_user.id).order_by(
-                BodyAnalysis.timestamp.desc()).first()
-
-            fat_loss_progress = None
-            if latest_analysis and member_user.fat_mass_goal and latest_analysis.fat_mass > member_user.fat_mass_goal:
-                start_datetime = latest_analysis.timestamp
-
-                meal_data = db.session.query(MealLog.date, func.sum(MealLog.calories)).filter(
-                    MealLog.user_id == member_user.id, MealLog.date >= start_datetime.date()
-                ).group_by(MealLog.date).all()
-                meal_map = dict(meal_data)
-
-                activity_data = db.session.query(Activity.date, Activity.active_kcal).filter(
-                    Activity.user_id == member_user.id, Activity.date >= start_datetime.date()
-                ).all()
-                activity_map = dict(activity_data)
-
-                member_metabolism = latest_analysis.metabolism or 0
-                total_accumulated_deficit = 0
-                delta_days = (today - start_datetime.date()).days
-
-                if delta_days >= 0:
-                    for i in range(delta_days + 1):
-                        current_day = start_datetime.date() + timedelta(days=i)
-                        consumed = meal_map.get(current_day, 0)
-                        burned_active = activity_map.get(current_day, 0)
-
-                        # --- ИЗМЕНЕНИЯ ЗДЕСЬ ---
-                        if i == 0:  # Это день анализа
-                            # Убираем калории, съеденные ДО замера
-                            calories_before_analysis = db.session.query(func.sum(MealLog.calories)).filter(
-                                MealLog.user_id == member_user.id,
-                                MealLog.date == current_day,
-                                MealLog.created_at < start_datetime
-                            ).scalar() or 0
-                            consumed -= calories_before_analysis
-                            # Игнорируем активность за день замера, т.к. нет точного времени
-                            burned_active = 0
-                        # --- КОНЕЦ ИЗМЕНЕНИЙ ---
-
-                        daily_deficit = (member_metabolism + burned_active) - consumed
-                        if daily_deficit > 0:
-                            total_accumulated_deficit += daily_deficit
-
-                KCAL_PER_KG_FAT = 7700
-                total_fat_to_lose_kg = latest_analysis.fat_mass - member_user.fat_mass_goal
-
-                estimated_fat_burned_kg = min(total_accumulated_deficit / KCAL_PER_KG_FAT, total_fat_to_lose_kg)
-
-                percentage = 0
-                if total_fat_to_lose_kg > 0:
-                    percentage = (estimated_fat_burned_kg / total_fat_to_lose_kg) * 100
-
-                fat_loss_progress = {
-                    'percentage': min(100, max(0, percentage)),
-                    'initial_kg': latest_analysis.fat_mass,
-                    'goal_kg': member_user.fat_mass_goal,
-                    'current_kg': latest_analysis.fat_mass - estimated_fat_burned_kg
-                }
-
-                # --- ПРОВЕРКА АКТИВНОСТИ (НОВОЕ) ---
-                # Ищем последнюю запись еды или активности
-                last_meal = MealLog.query.filter_by(user_id=member_user.id).order_by(MealLog.date.desc()).first()
-                last_act = Activity.query.filter_by(user_id=member_user.id).order_by(Activity.date.desc()).first()
-
-                last_active_date = None
-                if last_meal: last_active_date = last_meal.date
-                if last_act and (not last_active_date or last_act.date > last_active_date):
-                    last_active_date = last_act.date
-
-                is_inactive = False
-                days_inactive = 0
-
-                if last_active_date:
-                    days_inactive = (date.today() - last_active_date).days
-                    if days_inactive >= 3:  # Если не было активности 3 дня
-                        is_inactive = True
-                elif not member_user.is_trainer:  # Если вообще нет записей и это не тренер
-                    is_inactive = True
-                    days_inactive = 999
-                    # -----------------------------------
-
-                group_member_stats.append({
-                    'user': member_user,
-                    'fat_loss_progress': fat_loss_progress,
-                    'is_trainer_in_group': (member_user.id == group.trainer_id),
-                    'is_inactive': is_inactive,  # Флаг для шаблона
-                    'days_inactive': days_inactive
-                })
-
-                # Сортировка: Тренер -> Неактивные (чтобы были на виду в списке) -> Активные
-            group_member_stats.sort(
-                key=lambda x: (not x['is_trainer_in_group'], not x['is_inactive'], x['user'].name.lower()))
+        # Прогресс и неактивность всех участников — фиксированным числом сгруппированных запросов
+        group_member_stats = load_group_member_stats(group, admin_email=ADMIN_EMAIL)
 
         # Получаем будущие тренировки группы
         upcoming_trainings = Training.query.filter(
@@ -4522,7 +3806,6 @@ def group_detail(group_id):
     return render_template('group_detail.html',
                                group=group,
                                is_member=is_member,
-                               processed_messages=processed_messages,
                                group_member_stats=group_member_stats,
                                all_posts=all_posts,
                                upcoming_trainings=upcoming_trainings)  # Передаем тренировки
@@ -4557,6 +3840,10 @@ def react_to_message(message_id):
     })
 
 
+# Сколько сообщений группы отдаётся за один запрос
+MESSAGES_PER_PAGE = 50
+
+
 @app.route('/api/groups/<int:group_id>/messages')
 @login_required
 def get_group_messages(group_id):
@@ -4564,7 +3851,15 @@ def get_group_messages(group_id):
     Group.query.get_or_404(group_id)
     user_id = get_current_user().id
 
-    messages = GroupMessage.query.filter_by(group_id=group_id).order_by(GroupMessage.timestamp.asc()).all()
+    # Последние MESSAGES_PER_PAGE сообщений; ?before_id=<id> — страница старше указанного сообщения
+    q = GroupMessage.query.filter_by(group_id=group_id) \
+        .options(joinedload(GroupMessage.user).joinedload(User.avatar), selectinload(GroupMessage.reactions))
+    before_id = request.args.get('before_id', type=int)
+    if before_id:
+        q = q.filter(GroupMessage.id < before_id)
+    limit = min(request.args.get('limit', MESSAGES_PER_PAGE, type=int), MESSAGES_PER_PAGE)
+    messages = q.order_by(GroupMessage.id.desc()).limit(limit).all()
+    messages.reverse()  # клиенту — по возрастанию, как раньше
 
     # Собираем данные в нужный формат
     results = []
@@ -5388,67 +4683,28 @@ def deficit_history():
         return jsonify({"error": "Недостаточно данных для расчета истории дефицита."}), 404
 
     start_datetime = latest_analysis.timestamp
-    today = date.today()
+    _, days = deficit_since_analysis(user.id, latest_analysis)
 
-    # Запрашиваем все нужные данные за период одним разом
-    meal_logs = MealLog.query.filter(
-        MealLog.user_id == user.id,
-        MealLog.date >= start_datetime.date()
-    ).all()
-    activity_logs = Activity.query.filter(
-        Activity.user_id == user.id,
-        Activity.date >= start_datetime.date()
-    ).all()
-
-    # --- НАЧАЛО ИЗМЕНЕНИЙ ---
-    # Получаем все замеры тела за этот период
-    body_analyses = BodyAnalysis.query.filter(
-        BodyAnalysis.user_id == user.id,
-        func.date(BodyAnalysis.timestamp) >= start_datetime.date()
-    ).all()
-    # Создаем set для быстрой проверки дат
-    measurement_dates = {b.timestamp.date() for b in body_analyses}
-    # --- КОНЕЦ ИЗМЕНЕНИЙ ---
-
-    # Создаем словари для быстрого доступа
-    meals_map = {}
-    for log in meal_logs:
-        if log.date not in meals_map:
-            meals_map[log.date] = 0
-        meals_map[log.date] += log.calories
-
-    activity_map = {log.date: log.active_kcal for log in activity_logs}
-
-    history_data = []
-    metabolism = latest_analysis.metabolism or 0
-    delta_days = (today - start_datetime.date()).days
-
-    for i in range(delta_days + 1):
-        current_day = start_datetime.date() + timedelta(days=i)
-        consumed = meals_map.get(current_day, 0)
-        burned_active = activity_map.get(current_day, 0)
-
-        if i == 0:
-            calories_before_analysis = db.session.query(func.sum(MealLog.calories)).filter(
-                MealLog.user_id == user.id,
-                MealLog.date == current_day,
-                MealLog.created_at < start_datetime
-            ).scalar() or 0
-            consumed -= calories_before_analysis
-            burned_active = 0
-
-        total_burned = metabolism + burned_active
-        daily_deficit = total_burned - consumed
-
-        history_data.append({
-            "date": current_day.strftime('%d.%m.%Y'),
-            "consumed": consumed,
-            "base_metabolism": metabolism,
-            "burned_active": burned_active,
-            "total_burned": total_burned,
-            "deficit": daily_deficit if daily_deficit > 0 else 0,
-            "is_measurement_day": current_day in measurement_dates  # <-- НОВЫЙ ФЛАГ
-        })
+    # Даты замеров за этот период
+    measurement_dates = {
+        ts.date() for (ts,) in db.session.query(BodyAnalysis.timestamp).filter(
+            BodyAnalysis.user_id == user.id,
+            func.date(BodyAnalysis.timestamp) >= start_datetime.date()
+        )
+    }
+
+    history_data = [
+        {
+            "date": d["date"].strftime('%d.%m.%Y'),
+            "consumed": d["consumed"],
+            "base_metabolism": d["base_metabolism"],
+            "burned_active": d["burned_active"],
+            "total_burned": d["total_burned"],
+            "deficit": d["deficit"],
+            "is_measurement_day": d["date"] in measurement_dates
+        }
+        for d in days
+    ]
 
     return jsonify(history_data)
 
@@ -5496,7 +4752,7 @@ def signup_training(tid):
     db.session.add(s)
     try:
         # --- ПРОВЕРКА АЧИВОК ---
-        check_all_achievements(u)
+        on_achievement_event(u, TRAINING_SIGNUP)
         # -----------------------
         db.session.commit()
 
@@ -5568,6 +4824,7 @@ def get_tg_settings():
         # алиас для старого фронта
         "notify_promos":           bool(s.notify_subscription),
     "meal_timezone":           s.meal_timezone or "Asia/Almaty",  # ← дефолт Алматы
+        "meal_times":              parse_meal_times(s.meal_times),
 
     }
     resp = jsonify(payload)
@@ -5600,6 +4857,7 @@ def get_tg_settings():
         # НОВОЕ
         "notify_meals":            bool(s.notify_meals),
         "meal_timezone": s.meal_timezone or "Asia/Almaty",
+        "meal_times": parse_meal_times(s.meal_times),
     })
 
 
@@ -5643,9 +4901,40 @@ def patch_tg_settings():
         s.meal_timezone = tz
         touched["meal_timezone"] = tz
 
+    if "meal_times" in data:
+        # {"breakfast": "08:30", "lunch": null, ...}: null — вернуть время по умолчанию
+        raw = data.get("meal_times")
+        if isinstance(raw, str):
+            try:
+                raw = json.loads(raw)
+            except ValueError:
+                raw = None
+        if not isinstance(raw, dict):
+            return jsonify({"ok": False, "error": "invalid_meal_times"}), 400
+        custom = {}
+        for key, hhmm in raw.items():
+            if key not in MEAL_SCHEDULE:
+                return jsonify({"ok": False, "error": "invalid_meal_times"}), 400
+            if hhmm is None:
+                continue
+            hhmm = normalize_hhmm(hhmm)
+            if hhmm is None:
+                return jsonify({"ok": False, "error": "invalid_meal_times"}), 400
+            custom[key] = hhmm
+        s.meal_times = json.dumps(custom) if custom else None
+        touched["meal_times"] = parse_meal_times(s.meal_times)
+
     db.session.add_all([s, u])
     db.session.commit()
 
+    # Индекс расписания напоминаний пересчитываем только если что-то из него поменялось
+    if {"meal_timezone", "meal_times", "notify_meals"} & touched.keys():
+        try:
+            on_meal_settings_changed([u.id])
+        except Exception as e:
+            db.session.rollback()
+            print(f"[meal_scheduler] reindex failed for user {u.id}: {e}")
+
     resp = jsonify({
         "ok": True,
         "saved": touched,
@@ -5654,6 +4943,8 @@ def patch_tg_settings():
         "notify_subscription":     bool(s.notify_subscription),
         "notify_meals":            bool(s.notify_meals),
         "notify_promos":           bool(s.notify_subscription),
+        "meal_timezone":           s.meal_timezone or "Asia/Almaty",
+        "meal_times":              parse_meal_times(s.meal_times),
     })
     resp.headers["Cache-Control"] = "no-store"
     return resp
@@ -5790,7 +5081,8 @@ def admin_jobs():
                 "next_run_time": j.next_run_time.isoformat() if j.next_run_time else None,
                 "paused": getattr(j, "paused", False)
             })
-    return render_template("admin_jobs.html", jobs=jobs)
+    return render_template("admin_jobs.html", jobs=jobs, runner=get_runner_status(), push_health=get_token_health(),
+                           outbox=get_outbox_stats(), analytics=get_analytics_sink_stats())
 
 @app.route("/admin/jobs/<job_id>/pause", methods=["POST"])
 @admin_required
@@ -5816,6 +5108,14 @@ def admin_jobs_run_tick_now():
     flash("Тик запущен", "success")
     return redirect(url_for("admin_jobs"))
 
+@app.route("/admin/jobs/repair_streaks", methods=["POST"])
+@admin_required
+def admin_jobs_repair_streaks():
+    count = repair_streaks()
+    log_audit("job_run", "Streaks", "repair")
+    flash(f"Стрики пересчитаны по MealLog: {count} пользователей", "success")
+    return redirect(url_for("admin_jobs"))
+
 
 # ===== ADMIN: Промпты =====
 
@@ -5861,25 +5161,43 @@ def admin_broadcast():
     if request.method == "POST":
         text = request.form["text"].strip()
         only_active = bool(request.form.get("only_active"))
-        q = db.session.query(User.telegram_chat_id, User.id).filter(User.telegram_chat_id.isnot(None))
-        if only_active:
-            q = q.join(Subscription, Subscription.user_id == User.id).filter(Subscription.status == 'active')
-        rows = q.all()
-        sent = 0
-        for chat_id, uid in rows:
-            try:
-                requests.post(
-                    f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage",
-                    json={"chat_id": chat_id, "text": text},
-                    timeout=10
-                )
-                sent += 1
-            except Exception:
-                pass
-        log_audit("broadcast_send", "Telegram", "bulk", new={"text": text, "only_active": only_active, "sent": sent})
-        flash(f"Отправлено: {sent}", "success")
+        # Сама отправка — в фоне (broadcast.py): запрос только ставит задачу
+        job = BroadcastJob(
+            text=text,
+            only_active=only_active,
+            total=count_recipients(only_active),
+            created_by=session.get("user_id"),
+        )
+        db.session.add(job)
+        db.session.commit()
+        log_audit("broadcast_send", "Telegram", str(job.id), new={"text": text, "only_active": only_active, "total": job.total})
+        flash(f"Рассылка поставлена в очередь: {job.total} получателей", "success")
         return redirect(url_for("admin_broadcast"))
-    return render_template("admin_broadcast.html")
+    jobs = BroadcastJob.query.order_by(BroadcastJob.id.desc()).limit(10).all()
+    return render_template("admin_broadcast.html", jobs=jobs)
+
+
+@app.get("/admin/broadcast/status")
+@admin_required
+def admin_broadcast_status():
+    jobs = BroadcastJob.query.order_by(BroadcastJob.id.desc()).limit(10).all()
+    return jsonify({"jobs": [
+        {"id": j.id, "status": j.status, "total": j.total, "sent": j.sent, "failed": j.failed}
+        for j in jobs
+    ]})
+
+
+@app.post("/admin/broadcast/<int:job_id>/cancel")
+@admin_required
+def admin_broadcast_cancel(job_id):
+    job = db.session.get(BroadcastJob, job_id) or abort(404)
+    if job.status in ("queued", "running"):
+        job.status = "cancelled"
+        job.finished_at = datetime.utcnow()
+        db.session.commit()
+        log_audit("broadcast_cancel", "Telegram", str(job.id))
+        flash("Рассылка остановлена", "success")
+    return redirect(url_for("admin_broadcast"))
 
 
 
@@ -6273,19 +5591,12 @@ def visualize_run():
 
         # Используем новый маршрут 'serve_file'
 
-        # ANALYTICS: Body Visualization Generated
-        try:
-            amplitude.track(BaseEvent(
-                event_type="Body Visualization Generated",
-                user_id=str(u.id),  # <--- ИСПРАВЛЕНО: user -> u
-                event_properties={
-                    "current_weight": metrics_current.get("weight_kg"),
-                    "target_weight": metrics_target.get("weight_kg"),
-                    "sex": metrics_current.get("sex")
-                }
-            ))
-        except Exception as e:
-            print(f"Amplitude error: {e}")
+        # ANALYTICS: Body Visualization Generated (и шаг «Визуализация» воронки онбординга)
+        track_event('visualization_generated', u.id, {
+            "current_weight": metrics_current.get("weight_kg"),
+            "target_weight": metrics_target.get("weight_kg"),
+            "sex": metrics_current.get("sex")
+        })
 
         return jsonify({
             "success": True,
@@ -6381,6 +5692,22 @@ def admin_report_resolve(rid):
 @app.route("/admin/analytics")
 @admin_required
 def admin_analytics_page():
+    # Всё читается из дневных агрегатов (analytics_rollup), а не из analytics_events.
+    # ?start=YYYY-MM-DD&end=YYYY-MM-DD — период; без start воронка и KPI за всё время, график — 14 дней.
+    today = date.today()
+
+    def _parse_day(value):
+        try:
+            return datetime.strptime(value, "%Y-%m-%d").date() if value else None
+        except ValueError:
+            return None
+
+    start = _parse_day(request.args.get('start'))
+    end = _parse_day(request.args.get('end')) or today
+    if start and start > end:
+        start, end = end, start
+    chart_start = start or end - timedelta(days=13)
+
     # 1. Воронка Онбординга (Конверсия в уникальных пользователях)
     # Этапы: Регистрация -> Анализ весов -> Подтверждение анализа -> Визуализация -> Финиш
     funnel_steps_keys = [
@@ -6397,41 +5724,15 @@ def admin_analytics_page():
         'Визуализация (AI)',
         'Завершение тура'
     ]
+    funnel_counts = analytics_funnel(funnel_steps_keys, start, end if start else None)
 
-    funnel_counts = []
-    for step in funnel_steps_keys:
-        # Считаем уникальных юзеров, совершивших это действие
-        count = db.session.query(func.count(func.distinct(AnalyticsEvent.user_id))) \
-            .filter(AnalyticsEvent.event_type == step).scalar()
-        funnel_counts.append(count or 0)
+    # 2. Динамика регистраций по дням
+    series = analytics_daily_counts('signup_completed', chart_start, end)
+    dates_labels = [d.strftime("%d.%m") for d, _ in series]
+    reg_values = [cnt for _, cnt in series]
 
-    # 2. Динамика регистраций (за последние 14 дней)
-    today = date.today()
-    dates_labels = []
-    reg_values = []
-
-    for i in range(13, -1, -1):
-        d = today - timedelta(days=i)
-        d_next = d + timedelta(days=1)
-
-        # Считаем события 'signup_completed' за этот день
-        cnt = db.session.query(func.count(AnalyticsEvent.id)).filter(
-            AnalyticsEvent.event_type == 'signup_completed',
-            AnalyticsEvent.created_at >= d,
-            AnalyticsEvent.created_at < d_next
-        ).scalar()
-
-        dates_labels.append(d.strftime("%d.%m"))
-        reg_values.append(cnt or 0)
-
-    # 3. Общая статистика (KPI)
-    # Просмотры пейволла
-    paywall_hits = db.session.query(func.count(AnalyticsEvent.id)) \
-                       .filter(AnalyticsEvent.event_type == 'paywall_viewed').scalar() or 0
-
-    # Созданные заявки
-    apps_created = db.session.query(func.count(AnalyticsEvent.id)) \
-                       .filter(AnalyticsEvent.event_type == 'application_created').scalar() or 0
+    # 3. Общая статистика (KPI): просмотры пейволла и созданные заявки
+    kpi = analytics_totals(['paywall_viewed', 'application_created'], start, end if start else None)
 
     return render_template(
         "admin_analytics.html",
@@ -6440,8 +5741,12 @@ def admin_analytics_page():
         funnel_data=json.dumps(funnel_counts),
         dates_labels=json.dumps(dates_labels),
         reg_data=json.dumps(reg_values),
-        paywall_hits=paywall_hits,
-        apps_created=apps_created
+        paywall_hits=kpi['paywall_viewed'],
+        apps_created=kpi['application_created'],
+        period_start=start,
+        period_end=end,
+        chart_start=chart_start,
+        rollup_updated_at=analytics_last_compacted_at()
     )
 
 
@@ -6616,6 +5921,8 @@ def register_device_token():
     # Опционально: отвязываем этот токен от других юзеров, если он у них был
     User.query.filter(User.fcm_device_token == token, User.id != user.id).update({"fcm_device_token": None})
 
+    if user.fcm_device_token != token:
+        user.fcm_failure_count = 0
     user.fcm_device_token = token
     db.session.commit()
     return jsonify({"ok": True})
@@ -6816,7 +6123,9 @@ def api_app_fcm_token():
             other.fcm_device_token = None
             other.updated_at = datetime.now(UTC)
 
-        # Сохраняем текущему
+        # Сохраняем текущему (новый токен — счётчик ошибок с нуля)
+        if user.fcm_device_token != token:
+            user.fcm_failure_count = 0
         user.fcm_device_token = token
         user.updated_at = datetime.now(UTC)
 
@@ -6877,17 +6186,10 @@ def join_squad_request():
         db.session.commit()
 
         # ANALYTICS: Squad Join Requested
-        try:
-            amplitude.track(BaseEvent(
-                event_type="Squad Join Requested",
-                user_id=str(user.id),
-                event_properties={
-                    "preferred_time": pref_time,
-                    "fitness_level": fit_level
-                }
-            ))
-        except Exception as e:
-            print(f"Amplitude error: {e}")
+        track_event('squad_join_requested', user.id, {
+            "preferred_time": pref_time,
+            "fitness_level": fit_level
+        })
 
         return jsonify({"ok": True, "message": "Заявка в Squad принята"})
     except Exception as e:
@@ -7022,34 +6324,29 @@ def create_squad_post(group_id):
         if group.trainer_id != u.id and group.trainer_id not in recipients_ids:
             recipients_ids.append(group.trainer_id)
 
-        # 3. Рассылаем
-        for rid in recipients_ids:
-            send_user_notification(
-                user_id=rid,
-                title=notif_title,
-                body=notif_body,
-                type="info",
-                data={"route": "/squad"}  # При клике открываем вкладку Squads
-            )
+        # 3. Ставим в outbox (одним INSERT, доставят воркеры outbox)
+        queue_user_notifications([
+            {
+                "user_id": rid,
+                "title": notif_title,
+                "body": notif_body,
+                "type": "info",
+                "data": {"route": "/squad"},  # При клике открываем вкладку Squads
+            }
+            for rid in recipients_ids
+        ])
 
 
     except Exception as e:
         print(f"[PUSH ERROR] Failed to notify group: {e}")
         # ------------------------------
 
-        # ANALYTICS: Squad Post Created
-        try:
-            amplitude.track(BaseEvent(
-                event_type="Squad Post Created",
-                user_id=str(u.id),
-                event_properties={
-                    "group_id": group.id,
-                    "has_image": bool(image_filename),
-                    "post_type": msg_type
-                }
-            ))
-        except Exception as e:
-            print(f"Amplitude error: {e}")
+    # ANALYTICS: Squad Post Created
+    track_event('squad_post_created', u.id, {
+        "group_id": group.id,
+        "has_image": bool(image_filename),
+        "post_type": msg_type
+    })
 
     return jsonify({"ok": True, "message": "Пост опубликован"})
 
@@ -7143,7 +6440,8 @@ def create_group_training(group_id):
         db.session.add(t)
         db.session.commit()
 
-        # Можно отправить уведомление (код уведомления опущен для краткости)
+        # Напоминания участникам отряда за час и в момент старта
+        schedule_training_notifications(t)
 
         return jsonify({"ok": True})
     except Exception as e:
@@ -0,0 +1,96 @@
+# Бенчмарк статистики участников группы (group_stats.member_stats) на большой группе:
+# тренер + --size участников с замерами, едой и активностью за --days дней; проверка,
+# что статистика считается не больше чем за GROUP_STATS_QUERY_BUDGET запросов при любом размере группы.
+#   python bench_group_stats.py [--size 300] [--days 60] [--runs 5] [--database-url ...]
+import random
+import time
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import insert
+
+from energy_balance import rebuild
+from extensions import db
+from group_stats import GROUP_STATS_QUERY_BUDGET, member_stats
+from models import Activity, BodyAnalysis, Group, GroupMember, MealLog, User
+from query_budget import bench_app, bench_parser, check_budget, count_queries
+
+
+def seed_squad(size=300, days=60, rng_seed=42):
+    """
+    Тренер + группа из size участников с замерами, едой и активностью за days дней.
+    Логи вставляются пачками мимо ORM, энергобаланс строится одним rebuild. Возвращает (group_id, trainer_id).
+    """
+    rng = random.Random(rng_seed)
+    stamp = datetime.utcnow().strftime("%Y%m%d%H%M%S")
+    password = "!"  # не bcrypt-хэш — под бенчмарк-пользователями войти нельзя
+    today = date.today()
+
+    trainer = User(email=f"bench-trainer-{stamp}@bench.local", password=password,
+                   name="Bench Trainer", is_trainer=True)
+    db.session.add(trainer)
+    db.session.flush()
+    group = Group(name=f"Benchmark squad {stamp}", trainer_id=trainer.id)
+    db.session.add(group)
+
+    members = [
+        User(email=f"bench-{stamp}-{i}@bench.local", password=password, name=f"Bench {i:04d}",
+             fat_mass_goal=rng.uniform(8, 15))
+        for i in range(size)
+    ]
+    db.session.add_all(members)
+    db.session.flush()
+    db.session.add_all(GroupMember(group_id=group.id, user_id=u.id) for u in members)
+
+    analyses, meals, acts = [], [], []
+    for u in members:
+        analyses.append({
+            "user_id": u.id, "timestamp": datetime.utcnow() - timedelta(days=rng.randint(1, days)),
+            "weight": rng.uniform(60, 110), "fat_mass": rng.uniform(16, 35), "metabolism": rng.randint(1400, 2200),
+        })
+        # У части участников записи обрываются — они попадут в «неактивные»
+        last_day = rng.choice([0, 0, 0, 1, 2, 5, 10])
+        for d in range(last_day, days):
+            day = today - timedelta(days=d)
+            for meal_type in ("breakfast", "lunch", "dinner"):
+                meals.append({
+                    "user_id": u.id, "date": day, "meal_type": meal_type, "name": "bench",
+                    "calories": rng.randint(300, 800), "protein": 20.0, "fat": 15.0, "carbs": 50.0,
+                    "analysis": "", "created_at": datetime.combine(day, datetime.min.time()),
+                    "is_flagged": False,
+                })
+            acts.append({"user_id": u.id, "date": day, "active_kcal": rng.randint(100, 700), "source": "bench"})
+
+    db.session.execute(insert(BodyAnalysis), analyses)
+    db.session.execute(insert(MealLog), meals)
+    db.session.execute(insert(Activity), acts)
+    db.session.commit()
+    rebuild([u.id for u in members])
+    print(f"[bench_group_stats] seeded squad {group.id}: {size} members, {len(meals)} meals")
+    return group.id, trainer.id
+
+
+def main():
+    parser = bench_parser("Бенчмарк статистики участников группы (число запросов и время)")
+    parser.add_argument("--size", type=int, default=300)
+    parser.add_argument("--days", type=int, default=60)
+    args = parser.parse_args()
+
+    app = bench_app(args.database_url)
+    with app.app_context():
+        group_id, trainer_id = seed_squad(args.size, args.days)
+        timings, queries = [], 0
+        for _ in range(args.runs):
+            db.session.expire_all()
+            started = time.perf_counter()
+            with count_queries() as q:
+                stats = member_stats(group_id, trainer_id)
+            timings.append((time.perf_counter() - started) * 1000)
+            queries = max(queries, q["count"])
+        inactive = sum(1 for s in stats if s["is_inactive"])
+        print(f"[bench_group_stats] {len(stats)} members ({inactive} inactive): "
+              f"best {min(timings):.1f} ms, avg {sum(timings) / len(timings):.1f} ms")
+        check_budget("group stats", queries, GROUP_STATS_QUERY_BUDGET)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+# Регрессионный бенчмарк снимка главного экрана (profile_snapshot.build_profile_snapshot):
+# пользователь с длинной историей (замеры, еда и активность за --days дней, диета) и проверка,
+# что снимок собирается не больше чем за PROFILE_SNAPSHOT_QUERY_BUDGET запросов.
+#   python bench_profile_snapshot.py [--days 180] [--runs 5] [--database-url ...]
+import random
+import time
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import insert
+
+from energy_balance import rebuild
+from extensions import db
+from models import Activity, BodyAnalysis, Diet, MealLog, User
+from profile_snapshot import PROFILE_SNAPSHOT_QUERY_BUDGET, build_profile_snapshot
+from query_budget import bench_app, bench_parser, check_budget, count_queries
+
+
+def seed_user(days=180, rng_seed=42):
+    """Пользователь с целью по жиру, замером раз в неделю, тремя приёмами пищи и активностью каждый день."""
+    rng = random.Random(rng_seed)
+    stamp = datetime.utcnow().strftime("%Y%m%d%H%M%S")
+    today = date.today()
+
+    user = User(email=f"bench-profile-{stamp}@bench.local", password="!", name="Bench Profile",
+                fat_mass_goal=15.0)
+    db.session.add(user)
+    db.session.flush()
+
+    analyses, meals, acts = [], [], []
+    for d in range(days, -1, -7):
+        analyses.append({
+            "user_id": user.id, "timestamp": datetime.combine(today - timedelta(days=d), datetime.min.time()),
+            "weight": 95 - (days - d) * 0.05, "fat_mass": 30 - (days - d) * 0.03, "metabolism": 1900,
+        })
+    for d in range(days):
+        day = today - timedelta(days=d)
+        for meal_type in ("breakfast", "lunch", "dinner"):
+            meals.append({
+                "user_id": user.id, "date": day, "meal_type": meal_type, "name": "bench",
+                "calories": rng.randint(300, 700), "protein": 20.0, "fat": 15.0, "carbs": 50.0,
+                "analysis": "", "created_at": datetime.combine(day, datetime.min.time()), "is_flagged": False,
+            })
+        acts.append({"user_id": user.id, "date": day, "active_kcal": rng.randint(100, 700), "source": "bench"})
+
+    db.session.execute(insert(BodyAnalysis), analyses)
+    db.session.execute(insert(MealLog), meals)
+    db.session.execute(insert(Activity), acts)
+    db.session.add(Diet(user_id=user.id, date=today, breakfast="[]", lunch="[]", dinner="[]", snack="[]",
+                        total_kcal=1800, protein=120, fat=60, carbs=180))
+    db.session.flush()
+    user.initial_body_analysis_id = db.session.execute(
+        db.select(BodyAnalysis.id).where(BodyAnalysis.user_id == user.id)
+        .order_by(BodyAnalysis.timestamp.asc()).limit(1)
+    ).scalar()
+    db.session.commit()
+    rebuild([user.id])
+    print(f"[bench_profile_snapshot] seeded user {user.id}: {len(analyses)} analyses, {len(meals)} meals")
+    return user.id
+
+
+def main():
+    parser = bench_parser("Бенчмарк снимка главного экрана (число запросов и время)")
+    parser.add_argument("--days", type=int, default=180)
+    args = parser.parse_args()
+
+    app = bench_app(args.database_url)
+    with app.app_context():
+        user_id = seed_user(args.days)
+        timings, queries = [], 0
+        for _ in range(args.runs):
+            db.session.expire_all()
+            started = time.perf_counter()
+            with count_queries() as q:
+                data = build_profile_snapshot(user_id)
+            timings.append((time.perf_counter() - started) * 1000)
+            queries = max(queries, q["count"])
+        has_progress = data is not None and data["fat_loss_progress"] is not None
+        print(f"[bench_profile_snapshot] best {min(timings):.1f} ms, avg {sum(timings) / len(timings):.1f} ms, "
+              f"progress computed: {has_progress}")
+        check_budget("profile snapshot", queries, PROFILE_SNAPSHOT_QUERY_BUDGET)
+
+
+if __name__ == "__main__":
+    main()
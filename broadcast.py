@@ -0,0 +1,161 @@
+# Фоновая Telegram-рассылка из админки.
+# admin_broadcast только создаёт BroadcastJob; задача шедулера (через job_runner — только у лидера)
+# забирает её и шлёт пачками по User.id с общим лимитом скорости и повторами на 429/5xx.
+# После каждой пачки в БД сохраняются счётчики и курсор, поэтому после рестарта рассылка продолжается.
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from apscheduler.schedulers.background import BackgroundScheduler
+from sqlalchemy import and_, or_, select, update
+
+from extensions import db
+from models import BroadcastJob, Subscription, User
+from telegram_client import make_session, send_message
+
+CHUNK = int(os.getenv("BROADCAST_CHUNK", "200"))
+CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "10"))
+ATTEMPTS = int(os.getenv("BROADCAST_RETRIES", "3"))
+# Задача без heartbeat дольше этого считается брошенной и подхватывается заново
+STALE_SEC = int(os.getenv("BROADCAST_STALE_SEC", "120"))
+
+_scheduler = None
+_session = make_session(CONCURRENCY)
+
+
+def _recipients_query(only_active: bool):
+    q = select(User.id, User.telegram_chat_id).where(User.telegram_chat_id.isnot(None))
+    if only_active:
+        active = select(Subscription.user_id).where(Subscription.status == 'active')
+        q = q.where(User.id.in_(active))
+    return q
+
+
+def count_recipients(only_active: bool) -> int:
+    return db.session.execute(
+        select(db.func.count()).select_from(_recipients_query(only_active).subquery())
+    ).scalar_one()
+
+
+def _send_one(chat_id, text: str) -> bool:
+    for attempt in range(ATTEMPTS):
+        ok, retry_after, _ = send_message(_session, chat_id, text)
+        if ok:
+            return True
+        if retry_after is None or attempt == ATTEMPTS - 1:
+            return False
+        time.sleep(max(retry_after, 2 ** attempt))
+    return False
+
+
+def _claim_job():
+    """Берёт следующую queued-рассылку или брошенную running. Возвращает id или None."""
+    stale = datetime.utcnow() - timedelta(seconds=STALE_SEC)
+    claimable = or_(
+        BroadcastJob.status == 'queued',
+        and_(BroadcastJob.status == 'running', BroadcastJob.heartbeat_at < stale),
+    )
+    job_id = db.session.execute(
+        select(BroadcastJob.id).where(claimable).order_by(BroadcastJob.id).limit(1)
+    ).scalar()
+    if job_id is None:
+        db.session.rollback()
+        return None
+
+    now = datetime.utcnow()
+    res = db.session.execute(
+        update(BroadcastJob)
+        .where(BroadcastJob.id == job_id, claimable)
+        .values(status='running', heartbeat_at=now,
+                started_at=db.func.coalesce(BroadcastJob.started_at, now)),
+        execution_options={"synchronize_session": False},
+    )
+    db.session.commit()
+    return job_id if res.rowcount else None
+
+
+def run_broadcast(job_id: int):
+    """Досылает рассылку с сохранённого курсора. Останавливается, если статус сменили (отмена)."""
+    with ThreadPoolExecutor(max_workers=CONCURRENCY, thread_name_prefix="broadcast") as pool:
+        while True:
+            job = db.session.get(BroadcastJob, job_id, populate_existing=True)
+            if not job or job.status != 'running':
+                print(f"[broadcast] job {job_id} stopped ({job.status if job else 'deleted'})")
+                return
+
+            rows = db.session.execute(
+                _recipients_query(job.only_active)
+                .where(User.id > job.cursor_user_id)
+                .order_by(User.id)
+                .limit(CHUNK)
+            ).all()
+            if not rows:
+                job.status = 'done'
+                job.finished_at = datetime.utcnow()
+                db.session.commit()
+                print(f"[broadcast] job {job_id} done: sent={job.sent} failed={job.failed} of {job.total}")
+                return
+
+            results = list(pool.map(lambda r: _send_one(r[1], job.text), rows))
+            sent = sum(results)
+
+            # Счётчики и курсор — атомарно, и только если рассылку не отменили за это время
+            res = db.session.execute(
+                update(BroadcastJob)
+                .where(BroadcastJob.id == job_id, BroadcastJob.status == 'running')
+                .values(
+                    sent=BroadcastJob.sent + sent,
+                    failed=BroadcastJob.failed + (len(rows) - sent),
+                    cursor_user_id=rows[-1][0],
+                    heartbeat_at=datetime.utcnow(),
+                ),
+                execution_options={"synchronize_session": False},
+            )
+            db.session.commit()
+            if not res.rowcount:
+                print(f"[broadcast] job {job_id} stopped while sending a chunk (cancelled or deleted)")
+                return
+
+
+def process_broadcasts():
+    """Задача шедулера: выполняет все ожидающие рассылки по очереди."""
+    while True:
+        job_id = _claim_job()
+        if job_id is None:
+            return
+        print(f"[broadcast] job {job_id} started")
+        try:
+            run_broadcast(job_id)
+        except Exception as e:
+            db.session.rollback()
+            db.session.execute(
+                update(BroadcastJob).where(BroadcastJob.id == job_id).values(last_error=str(e)[:1000])
+            )
+            db.session.commit()
+            print(f"[broadcast] job {job_id} failed: {e} (will resume from cursor)")
+            return
+
+
+def get_scheduler():
+    return _scheduler
+
+
+def start_broadcast_worker(app, paused=False):
+    global _scheduler
+    if _scheduler:
+        return _scheduler
+
+    def _run():
+        with app.app_context():
+            try:
+                process_broadcasts()
+            finally:
+                db.session.remove()
+
+    _scheduler = BackgroundScheduler(timezone="Asia/Almaty")
+    _scheduler.add_job(_run, "interval", seconds=int(os.getenv("BROADCAST_POLL_SEC", "5")),
+                       id="broadcast-runner", max_instances=1, coalesce=True)
+    _scheduler.start(paused=paused)
+    print("[broadcast] worker started")
+    return _scheduler
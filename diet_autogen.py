@@ -1,13 +1,21 @@
 import os
 import json
+import random
+import threading
 import time
-from datetime import datetime, timedelta, date
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, date, time as dt_time
 from zoneinfo import ZoneInfo
 
 from apscheduler.schedulers.background import BackgroundScheduler
 from flask import current_app
+from sqlalchemy import delete, insert, select, update
+from openai import APIConnectionError, APIStatusError, APITimeoutError, RateLimitError
 
 from extensions import db
+from rate_limit import TokenBucket
+from snapshot_cache import bump_versions as bump_snapshot_versions
+from telegram_client import bot_token, make_session, send_message
 from models import (
     User, Subscription, Diet, StagedDiet, DietPreference, BodyAnalysis, UserSettings
 )
@@ -16,6 +24,17 @@ from models import (
 ALMATY = ZoneInfo("Asia/Almaty")
 _SCHED = None
 
+# Прогресс генерации и флаг «stage не выполняется» (finalize ждёт его)
+_progress = {}
+_stage_idle = threading.Event()
+_stage_idle.set()
+
+# Уведомления finalize: общий пул соединений (лимит скорости — общий на бота, telegram_client.bot_bucket)
+_TG_CONCURRENCY = int(os.getenv("DIET_AUTOGEN_TG_CONCURRENCY", "8"))
+_TG_ATTEMPTS = int(os.getenv("DIET_AUTOGEN_RETRIES", "4"))
+_TG_TIMEOUT_SEC = float(os.getenv("DIET_AUTOGEN_TG_TIMEOUT_SEC", "10"))
+_tg_session = make_session(_TG_CONCURRENCY)
+
 
 # ==============================
 #   УТИЛИТЫ
@@ -24,17 +43,20 @@ _SCHED = None
 def _today_local() -> date:
     return datetime.now(ALMATY).date()
 
+def _active_subscription_filter(today: date):
+    return (
+        Subscription.status == 'active',
+        Subscription.start_date <= today,
+        (Subscription.end_date.is_(None)) | (Subscription.end_date >= today),
+    )
+
 def _active_subscribers():
     """Пользователи с активной подпиской на сегодня."""
     today = _today_local()
     q = (
         db.session.query(User)
         .join(Subscription, Subscription.user_id == User.id)
-        .filter(
-            Subscription.status == 'active',
-            Subscription.start_date <= today,
-            (Subscription.end_date.is_(None)) | (Subscription.end_date >= today),
-        )
+        .filter(*_active_subscription_filter(today))
     )
     return q.all()
 
@@ -83,11 +105,27 @@ def _analysis_json(ba: BodyAnalysis | None):
         "waist_hip_ratio": ba.waist_hip_ratio
     }
 
-def _generate_diet_with_gpt(user: User, pref: DietPreference | None, target_date: date) -> dict:
-    """
-    Генерация в ТОМ ЖЕ формате, что и /generate_diet:
-    breakfast/lunch/dinner/snack — СПИСКИ блюд вида {"name","grams","kcal","recipe"} + total_kcal/protein/fat/carbs.
-    """
+_DIET_PROMPT = (
+    "Сгенерируй рацион на 1 день (завтрак, обед, ужин, перекус) на основе метрик тела и предпочтений.\n"
+    "ДЛЯ КАЖДОГО приёма верни МАССИВ объектов с ключами:\n"
+    "  {\"name\":\"...\",\"grams\":0,\"kcal\":0,\"recipe\":\"...\"}\n"
+    "Итог сверху:\n"
+    "{\n"
+    "  \"breakfast\": [ ... ],\n"
+    "  \"lunch\": [ ... ],\n"
+    "  \"dinner\": [ ... ],\n"
+    "  \"snack\": [ ... ],\n"
+    "  \"total_kcal\": 0,\n"
+    "  \"protein\": 0,\n"
+    "  \"fat\": 0,\n"
+    "  \"carbs\": 0\n"
+    "}\n"
+    "Верни ЧИСТЫЙ JSON (без префиксов/бэктиков)."
+)
+
+
+def _diet_request(user: User, pref: DietPreference | None, target_date: date) -> dict:
+    """Тело запроса chat.completions для пользователя (читает БД — вызывать в потоке с app_context)."""
     latest = BodyAnalysis.query.filter_by(user_id=user.id).order_by(BodyAnalysis.timestamp.desc()).first()
     payload = {
         "user": {"id": user.id, "name": user.name},
@@ -105,37 +143,21 @@ def _generate_diet_with_gpt(user: User, pref: DietPreference | None, target_date
         "body_analysis": _analysis_json(latest)
     }
 
-    client = _gpt_client()
-    prompt = (
-        "Сгенерируй рацион на 1 день (завтрак, обед, ужин, перекус) на основе метрик тела и предпочтений.\n"
-        "ДЛЯ КАЖДОГО приёма верни МАССИВ объектов с ключами:\n"
-        "  {\"name\":\"...\",\"grams\":0,\"kcal\":0,\"recipe\":\"...\"}\n"
-        "Итог сверху:\n"
-        "{\n"
-        "  \"breakfast\": [ ... ],\n"
-        "  \"lunch\": [ ... ],\n"
-        "  \"dinner\": [ ... ],\n"
-        "  \"snack\": [ ... ],\n"
-        "  \"total_kcal\": 0,\n"
-        "  \"protein\": 0,\n"
-        "  \"fat\": 0,\n"
-        "  \"carbs\": 0\n"
-        "}\n"
-        "Верни ЧИСТЫЙ JSON (без префиксов/бэктиков)."
-    )
-
     msg = [
         {"role": "system", "content": "Ты профессиональный диетолог. Отвечай строго в формате JSON."},
-        {"role": "user", "content": f"Входные данные JSON:\n{json.dumps(payload, ensure_ascii=False)}\n\n{prompt}"}
+        {"role": "user", "content": f"Входные данные JSON:\n{json.dumps(payload, ensure_ascii=False)}\n\n{_DIET_PROMPT}"}
     ]
-    resp = client.chat.completions.create(
-        model=os.getenv("OPENAI_MODEL", "gpt-4o-mini"),
-        messages=msg,
-        temperature=0.2,
-        response_format={"type": "json_object"},
-    )
+    return {
+        "model": os.getenv("OPENAI_MODEL", "gpt-4o-mini"),
+        "messages": msg,
+        "temperature": 0.2,
+        "response_format": {"type": "json_object"},
+    }
+
 
-    txt = resp.choices[0].message.content.strip()
+def _parse_diet_response(txt: str) -> dict:
+    """Разбор и нормализация ответа модели в формат staged_diet."""
+    txt = (txt or "").strip()
     # На всякий случай уберём возможные ```json ... ``` (хотя response_format должен вернуть чистый JSON)
     if txt.startswith("```"):
         try:
@@ -172,6 +194,16 @@ def _generate_diet_with_gpt(user: User, pref: DietPreference | None, target_date
     return data
 
 
+def _generate_diet_with_gpt(user: User, pref: DietPreference | None, target_date: date, client=None) -> dict:
+    """
+    Генерация в ТОМ ЖЕ формате, что и /generate_diet:
+    breakfast/lunch/dinner/snack — СПИСКИ блюд вида {"name","grams","kcal","recipe"} + total_kcal/protein/fat/carbs.
+    """
+    client = client or _gpt_client()
+    resp = client.chat.completions.create(**_diet_request(user, pref, target_date))
+    return _parse_diet_response(resp.choices[0].message.content)
+
+
 def _upsert_staged(user: User, d: dict, day: date):
     sd = StagedDiet.query.filter_by(user_id=user.id, date=day).first()
     if not sd:
@@ -188,144 +220,409 @@ def _upsert_staged(user: User, d: dict, day: date):
     db.session.add(sd)
 
 
-def _promote_staged_to_final(user: User, day: date):
-    sd = StagedDiet.query.filter_by(user_id=user.id, date=day).first()
-    if not sd:
-        return False
-    fin = Diet.query.filter_by(user_id=user.id, date=day).first()
-    if not fin:
-        fin = Diet(user_id=user.id, date=day)
-    fin.breakfast, fin.lunch, fin.dinner, fin.snack = sd.breakfast, sd.lunch, sd.dinner, sd.snack
-    fin.total_kcal, fin.protein, fin.fat, fin.carbs = sd.total_kcal, sd.protein, sd.fat, sd.carbs
-    db.session.add(fin)
-    db.session.delete(sd)
-    return True
-
-def _send_tg(token: str, chat_id: str | int, text: str, url_button: str | None = None):
-    import requests
-    body = {
-        "chat_id": chat_id,
-        "text": text,
-        "parse_mode": "HTML",
-        "disable_web_page_preview": True
-    }
-    if url_button:
-        body["reply_markup"] = {"inline_keyboard": [[{"text": "Открыть диету", "url": url_button}]]}
-    try:
-        r = requests.post(f"https://api.telegram.org/bot{token}/sendMessage", json=body, timeout=12)
-        return r.ok
-    except Exception:
-        return False
+_DIET_COLUMNS = ("breakfast", "lunch", "dinner", "snack", "total_kcal", "protein", "fat", "carbs")
+
+
+def _promote_all_staged(day: date) -> list[int]:
+    """
+    Переносит staged_diet → diet за день для всех активных подписчиков несколькими запросами:
+    UPDATE уже существующих строк diet, INSERT ... SELECT недостающих, DELETE из staged.
+    Коммит — на вызывающем. Возвращает id пользователей, чья диета обновилась.
+    """
+    active_ids = select(Subscription.user_id).where(*_active_subscription_filter(day))
+    user_ids = [
+        uid for (uid,) in db.session.execute(
+            select(StagedDiet.user_id).where(StagedDiet.date == day, StagedDiet.user_id.in_(active_ids))
+        )
+    ]
+    if not user_ids:
+        return []
+
+    def _staged_value(col):
+        return (
+            select(getattr(StagedDiet, col))
+            .where(StagedDiet.user_id == Diet.user_id, StagedDiet.date == day)
+            .scalar_subquery()
+        )
+
+    db.session.execute(
+        update(Diet)
+        .where(Diet.date == day, Diet.user_id.in_(user_ids))
+        .values({col: _staged_value(col) for col in _DIET_COLUMNS}),
+        execution_options={"synchronize_session": False},
+    )
+
+    has_final = select(Diet.id).where(Diet.user_id == StagedDiet.user_id, Diet.date == day).exists()
+    db.session.execute(
+        insert(Diet).from_select(
+            ["user_id", "date", *_DIET_COLUMNS],
+            select(StagedDiet.user_id, StagedDiet.date, *[getattr(StagedDiet, c) for c in _DIET_COLUMNS])
+            .where(StagedDiet.date == day, StagedDiet.user_id.in_(user_ids), ~has_final),
+        )
+    )
+
+    db.session.execute(
+        delete(StagedDiet).where(StagedDiet.date == day, StagedDiet.user_id.in_(user_ids)),
+        execution_options={"synchronize_session": False},
+    )
+    # Массовые запросы мимо ORM — события маппера не сработают, сбрасываем снимки явно
+    bump_snapshot_versions(user_ids)
+    return user_ids
+
+
+def _format_diet_message(fin: Diet) -> str:
+    """Текст точно как в /generate_diet."""
+    b = json.loads(fin.breakfast or "[]")
+    l = json.loads(fin.lunch or "[]")
+    d = json.loads(fin.dinner or "[]")
+    s_ = json.loads(fin.snack or "[]")
+
+    def fmt(title, items):
+        lines = [f"🍱 {title}:"]
+        for it in items:
+            name  = it.get("name","Блюдо")
+            grams = it.get("grams",0)
+            kcal  = it.get("kcal",0)
+            lines.append(f"- {name} ({grams} г, {kcal} ккал)")
+        return "\n".join(lines)
+
+    msg = "🍽️ Ваша диета на сегодня:\n\n"
+    msg += fmt("Завтрак", b) + "\n\n"
+    msg += fmt("Обед",     l) + "\n\n"
+    msg += fmt("Ужин",     d) + "\n\n"
+    msg += fmt("Перекус",  s_) + "\n\n"
+    if fin.total_kcal is not None: msg += f"🔥 Калории: {int(fin.total_kcal)} ккал\n"
+    if fin.protein    is not None: msg += f"🍗 Белки: {float(fin.protein)} г\n"
+    if fin.fat        is not None: msg += f"🥑 Жиры: {float(fin.fat)} г\n"
+    if fin.carbs      is not None: msg += f"🥔 Углеводы: {float(fin.carbs)} г"
+    return msg
+
+
+def _send_tg_one(chat_id, text: str, link: str | None) -> bool:
+    fields = {"parse_mode": "HTML"}
+    if link:
+        fields["reply_markup"] = {"inline_keyboard": [[{"text": "Открыть диету", "url": link}]]}
+    for attempt in range(_TG_ATTEMPTS):
+        ok, retry_after, _ = send_message(_tg_session, chat_id, text, timeout=_TG_TIMEOUT_SEC, **fields)
+        if ok:
+            return True
+        if retry_after is None or attempt == _TG_ATTEMPTS - 1:
+            return False
+        # на 429 send_message уже поставил общий bucket на паузу — ждём вместе со всеми
+        time.sleep(max(retry_after, 2 ** attempt + random.uniform(0, 1)))
+    return False
+
+
+def _send_tg_many(messages: list) -> int:
+    """
+    messages — [(chat_id, text, link)]. Шлём параллельно (DIET_AUTOGEN_TG_CONCURRENCY) через общий
+    telegram_client, не быстрее лимита бота (TELEGRAM_BOT_RPS), с повтором на 429/5xx. Возвращает число доставленных.
+    """
+    with ThreadPoolExecutor(max_workers=_TG_CONCURRENCY, thread_name_prefix="diet-autogen-tg") as pool:
+        return sum(pool.map(lambda m: _send_tg_one(*m), messages))
 
 
 # ==============================
 #   ДЖОБЫ
 # ==============================
 
+def _is_retryable(e: Exception) -> bool:
+    if isinstance(e, (RateLimitError, APIConnectionError, APITimeoutError)):
+        return True
+    return isinstance(e, APIStatusError) and e.status_code >= 500
+
+
+def _call_with_retry(fn, attempts: int, base_delay: float):
+    """Повтор с экспоненциальной задержкой на 429/5xx; уважаем Retry-After, если он пришёл."""
+    for attempt in range(attempts):
+        try:
+            return fn()
+        except Exception as e:
+            if attempt == attempts - 1 or not _is_retryable(e):
+                raise
+            delay = base_delay * (2 ** attempt) + random.uniform(0, base_delay)
+            retry_after = getattr(getattr(e, "response", None), "headers", {}).get("retry-after")
+            if retry_after:
+                try:
+                    delay = max(delay, float(retry_after))
+                except ValueError:
+                    pass
+            time.sleep(delay)
+
+
+def _local_time(day: date, env: str, default: str) -> datetime:
+    hh, mm = map(int, os.getenv(env, default).split(":"))
+    return datetime.combine(day, dt_time(hh, mm), tzinfo=ALMATY)
+
+
+def _stage_deadline(day: date) -> datetime:
+    return _local_time(day, "DIET_AUTOGEN_DEADLINE", "05:55")
+
+
+def _batch_deadline(day: date) -> datetime:
+    """До этого времени ждём батч; остаток до _stage_deadline — на синхронную догенерацию того, что не пришло."""
+    return min(_local_time(day, "DIET_AUTOGEN_BATCH_DEADLINE", "05:30"), _stage_deadline(day))
+
+
+_BATCH_DONE = ("completed", "failed", "expired", "cancelled")
+
+
+def _find_batch(client, day: date):
+    """Уже отправленный батч за этот день (после рестарта не отправляем второй раз)."""
+    for b in client.batches.list(limit=20).data:
+        meta = b.metadata or {}
+        if meta.get("job") == "diet_autogen" and meta.get("date") == str(day) and b.status != "cancelled":
+            return b
+    return None
+
+
+def _stage_via_batch(client, requests_by_user: dict, day: date, deadline: datetime) -> set:
+    """
+    Отправляет все запросы одним JSONL в OpenAI Batch API, ждёт результат до deadline (_batch_deadline)
+    и складывает ответы в staged_diet через _upsert_staged. Возвращает id пользователей, у кого всё ок.
+    Не успел — батч отменяется; отмену ждём не дольше DIET_AUTOGEN_BATCH_CANCEL_WAIT_SEC.
+    """
+    batch = _find_batch(client, day)
+    if batch:
+        print(f"[diet_autogen] batch: resuming {batch.id} ({batch.status})")
+    else:
+        lines = [
+            json.dumps({
+                "custom_id": f"diet-{uid}",
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": request,
+            }, ensure_ascii=False)
+            for uid, (_, request) in requests_by_user.items()
+        ]
+        upload = client.files.create(
+            file=(f"diet-autogen-{day}.jsonl", "\n".join(lines).encode("utf-8")),
+            purpose="batch",
+        )
+        batch = client.batches.create(
+            input_file_id=upload.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+            metadata={"job": "diet_autogen", "date": str(day)},
+        )
+        print(f"[diet_autogen] batch: submitted {batch.id} with {len(lines)} requests")
+    _progress["batch_id"] = batch.id
+
+    poll_sec = float(os.getenv("DIET_AUTOGEN_BATCH_POLL_SEC", "30"))
+    cancel_wait_sec = float(os.getenv("DIET_AUTOGEN_BATCH_CANCEL_WAIT_SEC", "120"))
+    while batch.status not in _BATCH_DONE:
+        if datetime.now(ALMATY) >= deadline:
+            # Отменяем: в output попадут уже готовые ответы, остальное доделает sync-путь
+            print(f"[diet_autogen] batch: deadline reached, cancelling {batch.id}")
+            client.batches.cancel(batch.id)
+            # cancelling может висеть минутами — не ждём дольше, чем оставлено на sync-путь
+            cancel_until = time.monotonic() + cancel_wait_sec
+            while batch.status not in _BATCH_DONE and time.monotonic() < cancel_until:
+                time.sleep(min(poll_sec, 5))
+                batch = client.batches.retrieve(batch.id)
+            break
+        time.sleep(poll_sec)
+        batch = client.batches.retrieve(batch.id)
+    print(f"[diet_autogen] batch: {batch.id} finished with status {batch.status}")
+
+    staged = set()
+    if not batch.output_file_id:
+        return staged
+
+    for line in client.files.content(batch.output_file_id).text.splitlines():
+        if not line.strip():
+            continue
+        row = json.loads(line)
+        uid = int(row["custom_id"].split("-", 1)[1])
+        if uid not in requests_by_user:
+            continue
+        resp = row.get("response") or {}
+        if resp.get("status_code") != 200:
+            continue
+        try:
+            txt = resp["body"]["choices"][0]["message"]["content"]
+            _upsert_staged(requests_by_user[uid][0], _parse_diet_response(txt), day)
+            db.session.commit()
+            staged.add(uid)
+        except Exception as e:
+            db.session.rollback()
+            print(f"[diet_autogen] batch: FAIL user_id={uid} error={e}")
+    return staged
+
+
+def get_stage_progress() -> dict:
+    """Прогресс последней/текущей генерации (для логов и админки)."""
+    return dict(_progress)
+
+
 def _job_stage_generate():
-    """05:00 — запускаем ЧАНКОВУЮ реальную GPT-генерацию в staged_diet для всех подписчиков."""
+    """
+    05:00 — GPT-генерация в staged_diet для всех подписчиков.
+    GPT-вызовы идут параллельно (DIET_AUTOGEN_CONCURRENCY) через token bucket (DIET_AUTOGEN_RPS)
+    с повтором на 429/5xx; запись в БД — в этом потоке по мере готовности.
+    Чекпоинт — сама строка staged_diet: при перезапуске уже сгенерированные пользователи пропускаются.
+    После DIET_AUTOGEN_DEADLINE новые вызовы не начинаются, чтобы успеть к finalize.
+    DIET_AUTOGEN_MODE=batch — сначала OpenAI Batch API (ждём до DIET_AUTOGEN_BATCH_DEADLINE),
+    синхронно только то, что из батча не пришло. Локальная проверка — fake_openai_batch.py.
+    """
     today = _today_local()
     users = _active_subscribers()
     print(f"[diet_autogen] stage: {len(users)} active subscribers for {today}")
     if not users:
         return
 
-    batch_size = int(os.getenv("DIET_AUTOGEN_BATCH", "20"))
-    pause_sec = int(os.getenv("DIET_AUTOGEN_PAUSE_SEC", "2"))
+    done_ids = {
+        uid for (uid,) in db.session.query(StagedDiet.user_id).filter(
+            StagedDiet.date == today, StagedDiet.user_id.in_([u.id for u in users])
+        )
+    }
+    pending = [u for u in users if u.id not in done_ids]
 
-    for i in range(0, len(users), batch_size):
-        chunk = users[i:i+batch_size]
-        print(f"[diet_autogen] stage: processing users {i+1}-{i+len(chunk)} / {len(users)}")
-        for u in chunk:
+    concurrency = int(os.getenv("DIET_AUTOGEN_CONCURRENCY", "8"))
+    bucket = TokenBucket(
+        rate=float(os.getenv("DIET_AUTOGEN_RPS", "2")),
+        burst=int(os.getenv("DIET_AUTOGEN_BURST", str(concurrency))),
+    )
+    attempts = int(os.getenv("DIET_AUTOGEN_RETRIES", "4"))
+    base_delay = float(os.getenv("DIET_AUTOGEN_BACKOFF_SEC", "2"))
+    deadline = _stage_deadline(today)
+    client = _gpt_client().with_options(max_retries=0)
+
+    _progress.clear()
+    _progress.update({
+        "date": str(today), "total": len(users), "resumed": len(done_ids),
+        "ok": 0, "failed": 0, "deferred": 0,
+        "started_at": datetime.now(ALMATY).isoformat(timespec="seconds"), "finished_at": None,
+    })
+    if done_ids:
+        print(f"[diet_autogen] stage: resuming, {len(done_ids)} users already staged")
+
+    def _call(request):
+        if datetime.now(ALMATY) >= deadline:
+            return None
+        def _once():
+            bucket.acquire()
+            return client.chat.completions.create(**request)
+        resp = _call_with_retry(_once, attempts, base_delay)
+        return resp.choices[0].message.content
+
+    _stage_idle.clear()
+    try:
+        requests_by_user = {}
+        for u in pending:
             try:
                 pref = _ensure_preferences(u)
-                data = _generate_diet_with_gpt(u, pref, today)
-                _upsert_staged(u, data, today)
-                db.session.commit()
-                print(f"[diet_autogen] stage: OK user_id={u.id}")
+                requests_by_user[u.id] = (u, _diet_request(u, pref, today))
             except Exception as e:
                 db.session.rollback()
+                _progress["failed"] += 1
                 print(f"[diet_autogen] stage: FAIL user_id={u.id} error={e}")
-        if i + batch_size < len(users):
-            time.sleep(pause_sec)
+        db.session.commit()
+
+        # Batch API: дешевле и без лимитов на RPS; то, что не пришло из батча, — синхронно ниже
+        if os.getenv("DIET_AUTOGEN_MODE", "sync") == "batch" and requests_by_user:
+            try:
+                staged = _stage_via_batch(client, requests_by_user, today, _batch_deadline(today))
+            except Exception as e:
+                db.session.rollback()
+                staged = set()
+                print(f"[diet_autogen] batch: FAIL error={e}, falling back to sync")
+            _progress["ok"] += len(staged)
+            requests_by_user = {uid: v for uid, v in requests_by_user.items() if uid not in staged}
+            if requests_by_user:
+                print(f"[diet_autogen] batch: {len(requests_by_user)} users fall back to sync generation")
+
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="diet-autogen") as pool:
+            futures = {pool.submit(_call, request): u for u, request in requests_by_user.values()}
+
+            for fut in as_completed(futures):
+                u = futures[fut]
+                try:
+                    txt = fut.result()
+                    if txt is None:
+                        _progress["deferred"] += 1
+                        continue
+                    _upsert_staged(u, _parse_diet_response(txt), today)
+                    db.session.commit()
+                    _progress["ok"] += 1
+                except Exception as e:
+                    db.session.rollback()
+                    _progress["failed"] += 1
+                    print(f"[diet_autogen] stage: FAIL user_id={u.id} error={e}")
+
+                handled = _progress["ok"] + _progress["failed"] + _progress["deferred"]
+                if handled % 20 == 0 or handled == len(pending):
+                    print(f"[diet_autogen] stage: {handled}/{len(pending)} "
+                          f"(ok={_progress['ok']} failed={_progress['failed']} deferred={_progress['deferred']})")
+    finally:
+        _progress["finished_at"] = datetime.now(ALMATY).isoformat(timespec="seconds")
+        _stage_idle.set()
+
+    if _progress["deferred"]:
+        print(f"[diet_autogen] stage: deadline {deadline.strftime('%H:%M')} reached, "
+              f"{_progress['deferred']} users left without a new diet")
 
 
 def _job_finalize_and_notify():
-    """06:00 — переносим из staged в diet и рассылаем уведомления в Telegram."""
+    """06:00 — переносим staged в diet одним пакетом и параллельно рассылаем уведомления в Telegram."""
+    # Если генерация ещё дописывает последние ответы — ждём её, а не промоутим половину
+    wait_sec = int(os.getenv("DIET_AUTOGEN_FINALIZE_WAIT_SEC", "600"))
+    if not _stage_idle.wait(timeout=wait_sec):
+        print(f"[diet_autogen] finalize: stage still running after {wait_sec}s, promoting what is ready")
+
     app = current_app._get_current_object()
-    token = app.config.get("TELEGRAM_BOT_TOKEN") or os.getenv("TELEGRAM_BOT_TOKEN")
+    token = bot_token()
     base_url = (app.config.get("PUBLIC_BASE_URL") or "").rstrip("/")
+    link = f"{base_url}/profile" if base_url else None
 
     today = _today_local()
-    users = _active_subscribers()
-    if not users:
+    try:
+        promoted = _promote_all_staged(today)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"[diet_autogen] finalize: promote FAIL error={e}")
+        return
+    print(f"[diet_autogen] finalize: promoted {len(promoted)} diets")
+    if not promoted or not token:
         return
 
-    for u in users:
-        changed = False
-        try:
-            changed = _promote_staged_to_final(u, today)
-            db.session.commit()
-        except Exception:
-            db.session.rollback()
-            changed = False
+    rows = (
+        db.session.query(Diet, User.telegram_chat_id, User.telegram_notify_enabled,
+                         UserSettings.user_id, UserSettings.telegram_notify_enabled)
+        .join(User, User.id == Diet.user_id)
+        .outerjoin(UserSettings, UserSettings.user_id == User.id)
+        .filter(Diet.date == today, Diet.user_id.in_(promoted), User.telegram_chat_id.isnot(None))
+        .order_by(Diet.id)
+        .all()
+    )
 
-        if not changed:
+    messages, seen = [], set()
+    for fin, chat_id, user_enabled, settings_user_id, settings_enabled in rows:
+        if fin.user_id in seen:
             continue
-
+        seen.add(fin.user_id)
         # уважаем пользовательские настройки уведомлений
-        can_notify = True
-        s: UserSettings | None = getattr(u, "settings", None)
-        if s:
-            can_notify = s.telegram_notify_enabled
-        else:
-            can_notify = u.telegram_notify_enabled
-
-        if token and can_notify and u.telegram_chat_id:
-            # Соберём текст точно как в /generate_diet
-            try:
-                fin = Diet.query.filter_by(user_id=u.id, date=today).first()
-                if not fin:
-                    raise RuntimeError("no final diet")
-
-                b = json.loads(fin.breakfast or "[]")
-                l = json.loads(fin.lunch or "[]")
-                d = json.loads(fin.dinner or "[]")
-                s_ = json.loads(fin.snack or "[]")
-
-                def fmt(title, items):
-                    lines = [f"🍱 {title}:"]
-                    for it in items:
-                        name  = it.get("name","Блюдо")
-                        grams = it.get("grams",0)
-                        kcal  = it.get("kcal",0)
-                        lines.append(f"- {name} ({grams} г, {kcal} ккал)")
-                    return "\n".join(lines)
-
-                msg = "🍽️ Ваша диета на сегодня:\n\n"
-                msg += fmt("Завтрак", b) + "\n\n"
-                msg += fmt("Обед",     l) + "\n\n"
-                msg += fmt("Ужин",     d) + "\n\n"
-                msg += fmt("Перекус",  s_) + "\n\n"
-                if fin.total_kcal is not None: msg += f"🔥 Калории: {int(fin.total_kcal)} ккал\n"
-                if fin.protein    is not None: msg += f"🍗 Белки: {float(fin.protein)} г\n"
-                if fin.fat        is not None: msg += f"🥑 Жиры: {float(fin.fat)} г\n"
-                if fin.carbs      is not None: msg += f"🥔 Углеводы: {float(fin.carbs)} г"
-
-                link = f"{base_url}/profile" if base_url else None
-                _send_tg(token, u.telegram_chat_id, msg, link)
-            except Exception:
-                # если вдруг парсинг не удался — шлём короткое уведомление
-                link = f"{base_url}/profile" if base_url else None
-                _send_tg(token, u.telegram_chat_id, "🥗 Ваша диета на сегодня готова.", link)
+        can_notify = settings_enabled if settings_user_id is not None else user_enabled
+        if not can_notify:
+            continue
+        try:
+            text = _format_diet_message(fin)
+        except Exception:
+            # если вдруг парсинг не удался — шлём короткое уведомление
+            text = "🥗 Ваша диета на сегодня готова."
+        messages.append((chat_id, text, link))
 
+    started = time.monotonic()
+    sent = _send_tg_many(messages)
+    print(f"[diet_autogen] finalize: telegram {sent}/{len(messages)} sent in {time.monotonic() - started:.1f}s")
 
 
 # ==============================
 #   СТАРТ СКЕДУЛЕРА
 # ==============================
 
-def start_diet_autogen_scheduler(app):
+def start_diet_autogen_scheduler(app, paused=False):
     global _SCHED
     if _SCHED:
         return _SCHED
@@ -350,7 +647,7 @@ def start_diet_autogen_scheduler(app):
     _SCHED.add_job(_finalize, 'cron', hour=6, minute=00, id='diet-autogen-finalize')
 
     print("[diet_autogen] cron jobs registered: 05:00 stage, 06:00 finalize (Asia/Almaty)")
-    _SCHED.start()
+    _SCHED.start(paused=paused)
     print("[diet_autogen] BackgroundScheduler started")
     return _SCHED
 
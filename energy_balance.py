@@ -0,0 +1,244 @@
+# Материализованный энергобаланс по дням (таблица daily_energy_balance).
+# Строки пересчитываются в том же соединении, что и запись MealLog / Activity / BodyAnalysis
+# (события маппера, как create_default_settings в models.py), поэтому все места записи покрыты без правок.
+# Чтение — один range scan: прогноз жиросжигания после замера, история дефицита, накопленный дефицит.
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import and_, delete, event, func, insert, inspect, or_, select
+
+from extensions import db
+from models import Activity, BodyAnalysis, DailyEnergyBalance, MealLog, User
+
+KCAL_PER_KG_FAT = 7700
+# BMR для дней до первого замера с метаболизмом
+DEFAULT_BMR = 2000
+
+E = DailyEnergyBalance.__table__
+
+
+# ==============================
+#   ПЕРЕСЧЁТ СТРОК
+# ==============================
+
+def recompute(conn, user_id, start=None):
+    """
+    Пересчитать строки пользователя с даты start (None — всю историю) в соединении conn.
+    Запросы — сгруппированные суммы по дням, поэтому запись за сегодня стоит несколько коротких запросов.
+    Пересчёты одного пользователя сериализуются блокировкой строки user (SELECT ... FOR UPDATE) до конца
+    транзакции: иначе параллельные запись еды и синк активности в READ COMMITTED не видят строк друг друга
+    в DELETE и второй INSERT падает на первичном ключе (user_id, date).
+    """
+    conn.execute(select(User.id).where(User.id == user_id).with_for_update())
+    meal_q = select(MealLog.date, func.sum(MealLog.calories), func.count(MealLog.id)) \
+        .where(MealLog.user_id == user_id).group_by(MealLog.date)
+    act_q = select(Activity.date, func.sum(Activity.active_kcal)) \
+        .where(Activity.user_id == user_id).group_by(Activity.date)
+    an_q = select(BodyAnalysis.timestamp, BodyAnalysis.metabolism) \
+        .where(BodyAnalysis.user_id == user_id).order_by(BodyAnalysis.timestamp)
+    if start is not None:
+        meal_q = meal_q.where(MealLog.date >= start)
+        act_q = act_q.where(Activity.date >= start)
+
+    meals = {d: (consumed or 0, count) for d, consumed, count in conn.execute(meal_q)}
+    acts = {d: active or 0 for d, active in conn.execute(act_q)}
+    analyses = [(ts, metabolism) for ts, metabolism in conn.execute(an_q) if ts is not None]
+
+    # Последний замер каждого дня — якорь прогноза; съеденное до него в этот день
+    anchors = {}
+    for ts, _ in analyses:
+        if start is None or ts.date() >= start:
+            anchors[ts.date()] = ts
+    anchor_consumed = {}
+    for day, ts in anchors.items():
+        anchor_consumed[day] = conn.execute(
+            select(func.coalesce(func.sum(MealLog.calories), 0))
+            .where(MealLog.user_id == user_id, MealLog.date == day, MealLog.created_at < ts)
+        ).scalar()
+
+    cumulative = 0
+    if start is not None:
+        cumulative = conn.execute(
+            select(E.c.cumulative_deficit)
+            .where(E.c.user_id == user_id, E.c.date < start)
+            .order_by(E.c.date.desc())
+            .limit(1)
+        ).scalar() or 0
+
+    rows = []
+    now = datetime.utcnow()
+    for day in sorted(meals.keys() | acts.keys() | anchors.keys()):
+        consumed, meal_count = meals.get(day, (0, 0))
+        active = acts.get(day, 0)
+        bmr = _bmr_on(analyses, day)
+        deficit = max(0, bmr + active - consumed) if meal_count else 0
+        cumulative += deficit
+        rows.append({
+            "user_id": user_id, "date": day, "consumed": consumed, "meal_count": meal_count,
+            "active": active, "bmr": bmr, "deficit": deficit, "cumulative_deficit": cumulative,
+            "anchor_consumed": anchor_consumed.get(day, 0), "updated_at": now,
+        })
+
+    q = delete(E).where(E.c.user_id == user_id)
+    if start is not None:
+        q = q.where(E.c.date >= start)
+    conn.execute(q)
+    if rows:
+        conn.execute(insert(E), rows)
+
+
+def _bmr_on(analyses, day):
+    """Метаболизм последнего замера не позже day (analyses отсортированы по времени)."""
+    bmr = None
+    for ts, metabolism in analyses:
+        if ts.date() > day:
+            break
+        if metabolism:
+            bmr = metabolism
+    return int(bmr or DEFAULT_BMR)
+
+
+def rebuild(user_ids=None, batch_size=500):
+    """Полная пересборка (бэкфилл / ремонт) для user_ids или всех пользователей с едой или активностью."""
+    if user_ids is None:
+        user_ids = set(db.session.execute(select(MealLog.user_id).distinct()).scalars())
+        user_ids |= set(db.session.execute(select(Activity.user_id).distinct()).scalars())
+        user_ids = sorted(user_ids - {None})
+    for i in range(0, len(user_ids), batch_size):
+        conn = db.session.connection()
+        for uid in user_ids[i:i + batch_size]:
+            recompute(conn, uid)
+        db.session.commit()
+    return len(user_ids)
+
+
+def backfill_if_empty():
+    """Первый запуск: таблица пуста, а логи есть — строим целиком."""
+    if db.session.execute(select(E.c.user_id).limit(1)).first() is not None:
+        return 0
+    if db.session.execute(select(MealLog.id).limit(1)).first() is None:
+        return 0
+    count = rebuild()
+    print(f"[energy_balance] backfilled {count} users")
+    return count
+
+
+# --- События маппера: пересчёт в той же транзакции ---
+
+@event.listens_for(MealLog, "after_insert")
+@event.listens_for(MealLog, "after_update")
+@event.listens_for(MealLog, "after_delete")
+@event.listens_for(Activity, "after_insert")
+@event.listens_for(Activity, "after_update")
+@event.listens_for(Activity, "after_delete")
+def _on_log_written(mapper, connection, target):
+    if target.user_id is not None and target.date is not None:
+        recompute(connection, target.user_id, _earliest(target, "date", target.date))
+
+
+@event.listens_for(BodyAnalysis, "after_insert")
+@event.listens_for(BodyAnalysis, "after_update")
+@event.listens_for(BodyAnalysis, "after_delete")
+def _on_analysis_written(mapper, connection, target):
+    # Замер меняет BMR всех дней после него и якорь своего дня
+    if target.user_id is not None and target.timestamp is not None:
+        old = [ts for ts in inspect(target).attrs.timestamp.history.deleted if ts is not None]
+        recompute(connection, target.user_id, min([target.timestamp, *old]).date())
+
+
+def _earliest(target, attr, value):
+    """Дата перенесли (after_update) — пересчёт с более ранней из старой и новой, иначе старый день устареет."""
+    old = [v for v in getattr(inspect(target).attrs, attr).history.deleted if v is not None]
+    return min([value, *old])
+
+
+# active_history: без него у просроченного после commit объекта старое значение даты не загружается
+# и в history.deleted пусто — перенос записи на более позднюю дату оставил бы старый день в таблице
+@event.listens_for(MealLog.date, "set", active_history=True)
+@event.listens_for(Activity.date, "set", active_history=True)
+@event.listens_for(BodyAnalysis.timestamp, "set", active_history=True)
+def _keep_old_date(target, value, oldvalue, initiator):
+    pass
+
+
+# ==============================
+#   ЧТЕНИЕ
+# ==============================
+
+def get_days(user_id, start, end=None):
+    """Строки daily_energy_balance за [start, end] одним range scan → {date: row}."""
+    q = select(DailyEnergyBalance).where(DailyEnergyBalance.user_id == user_id, DailyEnergyBalance.date >= start)
+    if end is not None:
+        q = q.where(DailyEnergyBalance.date <= end)
+    return {row.date: row for row in db.session.execute(q).scalars()}
+
+
+def deficit_since_analysis(user_id, analysis, today=None):
+    """
+    Прогноз после замера analysis по дням от даты замера до today.
+    Дни без записей считаются полным BMR замера; в день замера учитывается только съеденное после него,
+    активность этого дня игнорируется (нет точного времени).
+    Возвращает (накопленный дефицит, список дней dict(date, consumed, base_metabolism, burned_active,
+    total_burned, deficit)).
+    """
+    today = today or date.today()
+    return deficit_from_rows(get_days(user_id, analysis.timestamp.date(), today), analysis, today)
+
+
+def deficit_from_rows(rows, analysis, today):
+    """То же, что deficit_since_analysis, по уже прочитанным строкам {date: row} (могут быть шире диапазона)."""
+    start = analysis.timestamp.date()
+    metabolism = analysis.metabolism or 0
+
+    total, history = 0, []
+    for i in range((today - start).days + 1):
+        day = start + timedelta(days=i)
+        row = rows.get(day)
+        consumed = row.consumed if row else 0
+        burned_active = row.active if row else 0
+        if i == 0:
+            consumed -= row.anchor_consumed if row else 0
+            burned_active = 0
+
+        total_burned = metabolism + burned_active
+        deficit = max(0, total_burned - consumed)
+        total += deficit
+        history.append({
+            "date": day, "consumed": consumed, "base_metabolism": metabolism,
+            "burned_active": burned_active, "total_burned": total_burned, "deficit": deficit,
+        })
+    return total, history
+
+
+def total_deficit(user_id, until=None):
+    """Накопленный дефицит за всю историю (дни с едой, BMR на дату) — последняя строка, один запрос."""
+    q = select(DailyEnergyBalance.cumulative_deficit) \
+        .where(DailyEnergyBalance.user_id == user_id)
+    if until is not None:
+        q = q.where(DailyEnergyBalance.date <= until)
+    return db.session.execute(q.order_by(DailyEnergyBalance.date.desc()).limit(1)).scalar() or 0
+
+
+def deficits_since_analyses(analyses, today=None):
+    """
+    deficit_since_analysis для многих пользователей сразу: analyses — {user_id: замер}.
+    Один запрос по daily_energy_balance (у каждого пользователя — свой диапазон от даты его замера).
+    Возвращает {user_id: накопленный дефицит}.
+    """
+    today = today or date.today()
+    analyses = {uid: a for uid, a in analyses.items() if a is not None and a.timestamp is not None}
+    if not analyses:
+        return {}
+
+    ranges = [
+        and_(DailyEnergyBalance.user_id == uid, DailyEnergyBalance.date >= a.timestamp.date())
+        for uid, a in analyses.items()
+    ]
+    q = select(DailyEnergyBalance).where(or_(*ranges), DailyEnergyBalance.date <= today)
+    rows_by_user = {uid: {} for uid in analyses}
+    for row in db.session.execute(q).scalars():
+        rows_by_user[row.user_id][row.date] = row
+
+    return {
+        uid: deficit_from_rows(rows_by_user[uid], a, today)[0]
+        for uid, a in analyses.items()
+    }
@@ -0,0 +1,265 @@
+# Локальный фейковый OpenAI (Files + Batch API + chat.completions) для проверки DIET_AUTOGEN_MODE=batch
+# без сети и без затрат. Поднять сервер и направить на него автогенерацию:
+#   python fake_openai_batch.py --port 8765 --complete-after 2 --fail-users 3,5
+#   OPENAI_BASE_URL=http://127.0.0.1:8765/v1 OPENAI_API_KEY=fake DIET_AUTOGEN_MODE=batch python job_runner.py
+# Батч проходит validating → in_progress → completed за --complete-after опросов; строки пользователей
+# из --fail-users возвращаются с 500 (их должен догенерировать sync-путь); --stall — батч сам не завершается,
+# а отмена висит в cancelling (проверка DIET_AUTOGEN_BATCH_DEADLINE и ограниченного ожидания отмены).
+#   python fake_openai_batch.py --check — прогон _job_stage_generate против фейка на временной SQLite.
+import argparse
+import email
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FAKE_DIET = {
+    "breakfast": [{"name": "Овсянка", "grams": 200, "kcal": 300, "recipe": "Сварить"}],
+    "lunch": [{"name": "Курица с рисом", "grams": 350, "kcal": 550, "recipe": "Запечь"}],
+    "dinner": [{"name": "Рыба с овощами", "grams": 300, "kcal": 400, "recipe": "На пару"}],
+    "snack": [{"name": "Йогурт", "grams": 150, "kcal": 120, "recipe": ""}],
+    "total_kcal": 1370, "protein": 110, "fat": 45, "carbs": 130,
+}
+
+
+class FakeOpenAI:
+    """Состояние фейка: загруженные файлы, батчи и счётчики вызовов (для проверок)."""
+
+    def __init__(self, complete_after=2, fail_users=(), stall=False):
+        self.complete_after = complete_after
+        self.fail_users = set(fail_users)
+        self.stall = stall
+        self.files = {}    # id → (filename, bytes)
+        self.batches = {}  # id → dict батча
+        self.polls = {}    # id батча → число retrieve
+        self.sync_calls = 0
+        self.lock = threading.Lock()
+
+    # --- объекты ответа ---
+
+    def _completion(self):
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex[:12]}", "object": "chat.completion", "created": int(time.time()),
+            "model": "fake", "choices": [{"index": 0, "finish_reason": "stop", "message": {
+                "role": "assistant", "content": json.dumps(FAKE_DIET, ensure_ascii=False)}}],
+        }
+
+    def _finish(self, batch, status):
+        """Собрать output из входного JSONL (пользователи из fail_users — с 500)."""
+        lines = []
+        _, raw = self.files[batch["input_file_id"]]
+        for line in raw.decode("utf-8").splitlines():
+            if not line.strip():
+                continue
+            req = json.loads(line)
+            uid = int(req["custom_id"].split("-", 1)[1])
+            if uid in self.fail_users:
+                resp = {"status_code": 500, "body": {"error": {"message": "fake failure"}}}
+            else:
+                resp = {"status_code": 200, "body": self._completion()}
+            lines.append(json.dumps({"id": f"req-{uid}", "custom_id": req["custom_id"], "response": resp}))
+        file_id = f"file-{uuid.uuid4().hex[:12]}"
+        self.files[file_id] = ("output.jsonl", "\n".join(lines).encode("utf-8"))
+        batch.update(status=status, output_file_id=file_id)
+
+    # --- эндпоинты ---
+
+    def create_file(self, filename, content):
+        file_id = f"file-{uuid.uuid4().hex[:12]}"
+        with self.lock:
+            self.files[file_id] = (filename, content)
+        return {"id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()),
+                "filename": filename, "purpose": "batch", "status": "processed"}
+
+    def create_batch(self, body):
+        batch_id = f"batch_{uuid.uuid4().hex[:12]}"
+        batch = {"id": batch_id, "object": "batch", "endpoint": body["endpoint"], "status": "validating",
+                 "input_file_id": body["input_file_id"], "completion_window": body["completion_window"],
+                 "created_at": int(time.time()), "output_file_id": None, "metadata": body.get("metadata")}
+        with self.lock:
+            self.batches[batch_id] = batch
+            self.polls[batch_id] = 0
+        return batch
+
+    def retrieve_batch(self, batch_id):
+        with self.lock:
+            batch = self.batches[batch_id]
+            self.polls[batch_id] += 1
+            if batch["status"] in ("validating", "in_progress") and not self.stall:
+                if self.polls[batch_id] >= self.complete_after:
+                    self._finish(batch, "completed")
+                else:
+                    batch["status"] = "in_progress"
+            return batch
+
+    def cancel_batch(self, batch_id):
+        with self.lock:
+            batch = self.batches[batch_id]
+            if batch["status"] not in ("completed", "failed", "expired", "cancelled"):
+                if self.stall:
+                    batch["status"] = "cancelling"  # и так и остаётся
+                else:
+                    self._finish(batch, "cancelled")
+            return batch
+
+    def chat_completion(self):
+        with self.lock:
+            self.sync_calls += 1
+        return self._completion()
+
+
+def make_handler(fake):
+    class Handler(BaseHTTPRequestHandler):
+        def _json(self, payload, status=200):
+            raw = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(raw)))
+            self.end_headers()
+            self.wfile.write(raw)
+
+        def _body(self):
+            return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+        def do_GET(self):
+            path = self.path.split("?", 1)[0].rstrip("/")
+            if path == "/v1/batches":
+                with fake.lock:
+                    data = sorted(fake.batches.values(), key=lambda b: -b["created_at"])
+                return self._json({"object": "list", "data": data, "has_more": False})
+            if path.startswith("/v1/batches/"):
+                batch_id = path.rsplit("/", 1)[1]
+                if batch_id not in fake.batches:
+                    return self._json({"error": {"message": "not found"}}, 404)
+                return self._json(fake.retrieve_batch(batch_id))
+            if path.startswith("/v1/files/") and path.endswith("/content"):
+                file_id = path.split("/")[3]
+                if file_id not in fake.files:
+                    return self._json({"error": {"message": "not found"}}, 404)
+                raw = fake.files[file_id][1]
+                self.send_response(200)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(len(raw)))
+                self.end_headers()
+                return self.wfile.write(raw)
+            return self._json({"error": {"message": f"unknown path {path}"}}, 404)
+
+        def do_POST(self):
+            path = self.path.split("?", 1)[0].rstrip("/")
+            body = self._body()
+            if path == "/v1/files":
+                # multipart/form-data разбираем стандартным email-парсером
+                msg = email.message_from_bytes(
+                    b"Content-Type: " + self.headers["Content-Type"].encode("latin-1") + b"\r\n\r\n" + body)
+                for part in msg.get_payload():
+                    if part.get_param("name", header="content-disposition") == "file":
+                        return self._json(fake.create_file(part.get_filename(), part.get_payload(decode=True)))
+                return self._json({"error": {"message": "file is required"}}, 400)
+            if path == "/v1/batches":
+                return self._json(fake.create_batch(json.loads(body)))
+            if path.startswith("/v1/batches/") and path.endswith("/cancel"):
+                return self._json(fake.cancel_batch(path.split("/")[3]))
+            if path == "/v1/chat/completions":
+                return self._json(fake.chat_completion())
+            return self._json({"error": {"message": f"unknown path {path}"}}, 404)
+
+        def log_message(self, *_):
+            pass
+
+    return Handler
+
+
+def serve(fake, port=0):
+    """Поднять фейк в фоновом потоке → (server, base_url для OPENAI_BASE_URL)."""
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(fake))
+    threading.Thread(target=server.serve_forever, name="fake-openai", daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}/v1"
+
+
+# ==============================
+#   ПРОВЕРКА АВТОГЕНЕРАЦИИ
+# ==============================
+
+def _run_stage(fake, users=6, **env):
+    """_job_stage_generate на временной SQLite против фейка → (staged user_ids, все user_ids, прогресс)."""
+    from datetime import timedelta
+
+    from flask import Flask
+
+    server, base_url = serve(fake)
+    db_path = os.path.join(tempfile.mkdtemp(prefix="diet-autogen-check-"), "check.db")
+    os.environ.update({"OPENAI_BASE_URL": base_url, "OPENAI_API_KEY": "fake", "DIET_AUTOGEN_MODE": "batch",
+                       "DIET_AUTOGEN_BATCH_POLL_SEC": "0.05", "DIET_AUTOGEN_RPS": "100", **env})
+    try:
+        import diet_autogen
+        from extensions import db
+        from models import StagedDiet, Subscription, User
+
+        app = Flask(__name__)
+        app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{db_path}"
+        db.init_app(app)
+        with app.app_context():
+            db.create_all()
+            today = diet_autogen._today_local()
+            for i in range(users):
+                u = User(email=f"check-{i}@check.local", password="!", name=f"Check {i}")
+                db.session.add(u)
+                db.session.flush()
+                db.session.add(Subscription(user_id=u.id, status="active",
+                                            start_date=today - timedelta(days=1), end_date=None))
+            db.session.commit()
+            diet_autogen._job_stage_generate()
+            staged = {uid for (uid,) in db.session.query(StagedDiet.user_id).filter(StagedDiet.date == today)}
+            user_ids = {uid for (uid,) in db.session.query(User.id)}
+            return staged, user_ids, diet_autogen.get_stage_progress()
+    finally:
+        server.shutdown()
+
+
+def check():
+    """Два сценария: батч успел (кроме fail_users) и батч завис до отсечки — всё догенерировано синхронно."""
+    fake = FakeOpenAI(complete_after=2, fail_users={2, 5})
+    staged, user_ids, progress = _run_stage(fake, DIET_AUTOGEN_DEADLINE="23:59", DIET_AUTOGEN_BATCH_DEADLINE="23:59")
+    assert staged == user_ids, f"not staged: {user_ids - staged}"
+    assert fake.sync_calls == 2, f"sync fallback calls: {fake.sync_calls} != 2"
+    print(f"[fake_openai_batch] completed batch + sync fallback for failed rows: ok {progress}")
+
+    fake = FakeOpenAI(stall=True)
+    started = time.monotonic()
+    staged, user_ids, progress = _run_stage(fake, DIET_AUTOGEN_DEADLINE="23:59", DIET_AUTOGEN_BATCH_DEADLINE="00:00",
+                                            DIET_AUTOGEN_BATCH_CANCEL_WAIT_SEC="0.5")
+    assert staged == user_ids, f"not staged: {user_ids - staged}"
+    assert fake.sync_calls == len(user_ids), f"sync fallback calls: {fake.sync_calls} != {len(user_ids)}"
+    assert progress["deferred"] == 0, progress
+    print(f"[fake_openai_batch] stalled batch cancelled at cutoff, all users via sync in "
+          f"{time.monotonic() - started:.1f}s: ok {progress}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Фейковый OpenAI Batch API для diet_autogen")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--complete-after", type=int, default=2, help="сколько опросов до completed")
+    parser.add_argument("--fail-users", default="", help="id пользователей через запятую — их строки с 500")
+    parser.add_argument("--stall", action="store_true", help="батч не завершается, отмена висит в cancelling")
+    parser.add_argument("--check", action="store_true", help="прогнать _job_stage_generate на временной SQLite")
+    args = parser.parse_args()
+
+    if args.check:
+        check()
+        return
+
+    fail_users = {int(x) for x in args.fail_users.split(",") if x.strip()}
+    server, base_url = serve(FakeOpenAI(args.complete_after, fail_users, args.stall), args.port)
+    print(f"[fake_openai_batch] listening: OPENAI_BASE_URL={base_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
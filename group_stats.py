@@ -0,0 +1,133 @@
+# Статистика участников группы для тренера (group_detail): прогресс жиросжигания и неактивность.
+# Считается фиксированным числом сгруппированных запросов независимо от размера группы:
+#   1) участники + аватары (joinedload),
+#   2) последний замер каждого участника (ROW_NUMBER() OVER (PARTITION BY user_id)),
+#   3) дефицит после замера — один запрос к daily_energy_balance на всех,
+#   4) дата последней еды / активности — один UNION ALL с GROUP BY.
+# Бенчмарк с большой группой и проверкой бюджета запросов — bench_group_stats.py.
+from datetime import date
+
+from sqlalchemy import and_, func, or_, select, union_all
+from sqlalchemy.orm import joinedload
+
+from energy_balance import KCAL_PER_KG_FAT, deficits_since_analyses
+from extensions import db
+from models import Activity, BodyAnalysis, GroupMember, MealLog, User
+
+# Бюджет запросов на статистику группы — проверяет bench_group_stats.py
+GROUP_STATS_QUERY_BUDGET = 4
+INACTIVE_AFTER_DAYS = 3
+
+
+# ==============================
+#   СТАТИСТИКА УЧАСТНИКОВ
+# ==============================
+
+def group_member_stats(group, admin_email=None, today=None):
+    """
+    Статистика участников группы и её тренера (если он не участник и не admin_email) для шаблона group_detail:
+    список dict(user, fat_loss_progress, is_trainer_in_group, is_inactive, days_inactive),
+    отсортированный: тренер → неактивные → по имени.
+    """
+    return member_stats(group.id, group.trainer_id, admin_email, today)
+
+
+def member_stats(group_id, trainer_id, admin_email=None, today=None):
+    """То же по id группы и тренера — без обращения к объекту группы (не тратит запрос на его refresh)."""
+    today = today or date.today()
+
+    # --- 1. Участники с аватарами (и тренер, даже если он не участник) ---
+    rows = db.session.execute(
+        select(User, GroupMember.id)
+        .outerjoin(GroupMember, and_(GroupMember.user_id == User.id, GroupMember.group_id == group_id))
+        .where(or_(GroupMember.id.is_not(None), User.id == trainer_id))
+        .options(joinedload(User.avatar))
+    ).unique().all()
+    members = [u for u, membership_id in rows if membership_id is not None or u.email != admin_email]
+    if not members:
+        return []
+    user_ids = [u.id for u in members]
+
+    # --- 2. Последний замер каждого ---
+    latest = latest_analyses(user_ids)
+
+    # --- 3. Дефицит после замера — только тем, кому есть что сжигать ---
+    with_goal = {
+        u.id: latest[u.id] for u in members
+        if u.id in latest and u.fat_mass_goal and latest[u.id].fat_mass
+        and latest[u.id].fat_mass > u.fat_mass_goal
+    }
+    deficits = deficits_since_analyses(with_goal, today)
+
+    # --- 4. Последняя активность ---
+    last_active = last_active_dates(user_ids)
+
+    stats = []
+    for u in members:
+        analysis = with_goal.get(u.id)
+        fat_loss_progress = None
+        if analysis is not None:
+            fat_loss_progress = _fat_loss_progress(u, analysis, deficits.get(u.id, 0))
+
+        is_inactive, days_inactive = False, 0
+        last_active_date = last_active.get(u.id)
+        if last_active_date:
+            days_inactive = (today - last_active_date).days
+            is_inactive = days_inactive >= INACTIVE_AFTER_DAYS
+        elif not u.is_trainer:  # Вообще нет записей и это не тренер
+            is_inactive, days_inactive = True, 999
+
+        stats.append({
+            'user': u,
+            'fat_loss_progress': fat_loss_progress,
+            'is_trainer_in_group': (u.id == trainer_id),
+            'is_inactive': is_inactive,
+            'days_inactive': days_inactive,
+        })
+
+    # Тренер → неактивные (чтобы были на виду) → активные
+    stats.sort(key=lambda x: (not x['is_trainer_in_group'], not x['is_inactive'], (x['user'].name or '').lower()))
+    return stats
+
+
+def latest_analyses(user_ids):
+    """Последний замер каждого пользователя одним запросом → {user_id: BodyAnalysis}."""
+    if not user_ids:
+        return {}
+    rn = func.row_number().over(
+        partition_by=BodyAnalysis.user_id,
+        order_by=(BodyAnalysis.timestamp.desc(), BodyAnalysis.id.desc()),
+    ).label("rn")
+    ranked = select(BodyAnalysis.id, rn).where(BodyAnalysis.user_id.in_(user_ids)).subquery()
+    q = select(BodyAnalysis).join(ranked, ranked.c.id == BodyAnalysis.id).where(ranked.c.rn == 1)
+    return {a.user_id: a for a in db.session.execute(q).scalars()}
+
+
+def last_active_dates(user_ids):
+    """Дата последней записи еды или активности каждого пользователя → {user_id: date}."""
+    if not user_ids:
+        return {}
+    per_source = union_all(
+        select(MealLog.user_id.label("user_id"), func.max(MealLog.date).label("day"))
+        .where(MealLog.user_id.in_(user_ids)).group_by(MealLog.user_id),
+        select(Activity.user_id.label("user_id"), func.max(Activity.date).label("day"))
+        .where(Activity.user_id.in_(user_ids)).group_by(Activity.user_id),
+    ).subquery()
+    q = select(per_source.c.user_id, func.max(per_source.c.day)).group_by(per_source.c.user_id)
+    return {uid: day for uid, day in db.session.execute(q) if day is not None}
+
+
+def _fat_loss_progress(user, analysis, total_accumulated_deficit):
+    total_fat_to_lose_kg = analysis.fat_mass - user.fat_mass_goal
+    estimated_fat_burned_kg = min(total_accumulated_deficit / KCAL_PER_KG_FAT, total_fat_to_lose_kg)
+
+    percentage = 0
+    if total_fat_to_lose_kg > 0:
+        percentage = (estimated_fat_burned_kg / total_fat_to_lose_kg) * 100
+
+    return {
+        'percentage': min(100, max(0, percentage)),
+        'initial_kg': analysis.fat_mass,
+        'goal_kg': user.fat_mass_goal,
+        'current_kg': analysis.fat_mass - estimated_fat_burned_kg
+    }
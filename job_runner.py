@@ -0,0 +1,185 @@
+# Раннер фоновых задач с выбором лидера.
+# Каждый процесс (gunicorn-воркер или отдельный `python job_runner.py`) поднимает шедулеры на паузе:
+# задачи можно регистрировать, но выполняет их только держатель аренды в таблице scheduler_lease.
+# Если лидер умер, через JOB_RUNNER_LEASE_TTL_SEC аренду забирает другой процесс.
+# SCHEDULERS_MODE=off — процесс не участвует в выборах (web при отдельном воркере).
+import atexit
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import or_, update
+from sqlalchemy.exc import IntegrityError
+
+from extensions import db
+from models import SchedulerLease
+
+LEASE_NAME = "background-jobs"
+LEASE_TTL_SEC = int(os.getenv("JOB_RUNNER_LEASE_TTL_SEC", "60"))
+
+_holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+_schedulers = {}
+_is_leader = False
+_thread = None
+
+
+# ==============================
+#   АРЕНДА
+# ==============================
+
+def _try_acquire_lease():
+    """Взять или продлить аренду. True — этот процесс лидер."""
+    now = datetime.utcnow()
+    expires_at = now + timedelta(seconds=LEASE_TTL_SEC)
+
+    res = db.session.execute(
+        update(SchedulerLease)
+        .where(
+            SchedulerLease.name == LEASE_NAME,
+            or_(SchedulerLease.holder == _holder, SchedulerLease.expires_at < now),
+        )
+        .values(holder=_holder, expires_at=expires_at)
+    )
+    if res.rowcount:
+        db.session.commit()
+        return True
+
+    if db.session.get(SchedulerLease, LEASE_NAME) is not None:
+        db.session.rollback()
+        return False
+
+    # Строки ещё нет — первый, кто вставит, становится лидером
+    try:
+        db.session.add(SchedulerLease(name=LEASE_NAME, holder=_holder, expires_at=expires_at, acquired_at=now))
+        db.session.commit()
+        return True
+    except IntegrityError:
+        db.session.rollback()
+        return False
+
+
+def _release_lease(app):
+    """При штатной остановке отдаём аренду сразу, не дожидаясь TTL."""
+    if not _is_leader:
+        return
+    try:
+        with app.app_context():
+            db.session.execute(
+                update(SchedulerLease)
+                .where(SchedulerLease.name == LEASE_NAME, SchedulerLease.holder == _holder)
+                .values(expires_at=datetime.utcnow())
+            )
+            db.session.commit()
+    except Exception as e:
+        print(f"[job_runner] lease release failed: {e}")
+
+
+# ==============================
+#   ЛИДЕРСТВО
+# ==============================
+
+def _become_leader():
+    global _is_leader
+    _is_leader = True
+    for sched in _schedulers.values():
+        sched.resume()
+    print(f"[job_runner] {_holder} is now the leader, schedulers resumed: {', '.join(_schedulers)}")
+
+
+def _step_down():
+    global _is_leader
+    _is_leader = False
+    for sched in _schedulers.values():
+        sched.pause()
+    print(f"[job_runner] {_holder} lost the lease, schedulers paused")
+
+
+def _lease_loop(app):
+    renew_every = max(1, LEASE_TTL_SEC // 3)
+    while True:
+        try:
+            with app.app_context():
+                leader = _try_acquire_lease()
+        except Exception as e:
+            print(f"[job_runner] lease check failed: {e}")
+            leader = False
+        finally:
+            with app.app_context():
+                db.session.remove()
+
+        if leader and not _is_leader:
+            _become_leader()
+        elif not leader and _is_leader:
+            _step_down()
+        elif leader:
+            # Задачи в персистентных сторах могли добавить другие процессы — перечитываем сторы
+            for sched in _schedulers.values():
+                sched.wakeup()
+
+        time.sleep(renew_every)
+
+
+def get_runner_status():
+    """Состояние раннера для админки."""
+    status = {"holder": _holder, "is_leader": _is_leader, "schedulers": sorted(_schedulers), "lease": None}
+    try:
+        lease = db.session.get(SchedulerLease, LEASE_NAME)
+        if lease:
+            status["lease"] = {"holder": lease.holder, "expires_at": lease.expires_at.isoformat(timespec="seconds")}
+    except Exception:
+        db.session.rollback()
+    return status
+
+
+def start_job_runner(app):
+    """
+    Поднять все шедулеры на паузе и запустить выборы лидера (один раз на процесс).
+    """
+    global _thread
+    if _thread:
+        return
+
+    from analytics_rollup import start_analytics_rollup_scheduler
+    from broadcast import start_broadcast_worker
+    from diet_autogen import start_diet_autogen_scheduler
+    from meal_reminders import start_meal_scheduler
+    from outbox import start_outbox_worker
+    from streak_bp import start_streak_scheduler
+    from training_notifier import start_training_notifier
+
+    starters = [
+        ("meal_reminders", start_meal_scheduler),
+        ("diet_autogen", start_diet_autogen_scheduler),
+        ("streak", start_streak_scheduler),
+        ("outbox", start_outbox_worker),
+        ("broadcast", start_broadcast_worker),
+        ("analytics_rollup", start_analytics_rollup_scheduler),
+    ]
+    if os.getenv("ENABLE_TRAINING_NOTIFIER", "1") == "1":
+        starters.append(("training_notifier", start_training_notifier))
+
+    for name, start in starters:
+        try:
+            _schedulers[name] = start(app, paused=True)
+        except Exception as e:
+            print(f"[job_runner] {name} scheduler error: {e}")
+
+    if os.getenv("SCHEDULERS_MODE", "leader") == "off":
+        print("[job_runner] SCHEDULERS_MODE=off: this process only registers jobs")
+        return
+
+    _thread = threading.Thread(target=_lease_loop, args=(app,), daemon=True)
+    _thread.start()
+    atexit.register(_release_lease, app)
+
+
+if __name__ == "__main__":
+    # Отдельный процесс-воркер (Procfile: scheduler). Импорт app поднимает шедулеры и выборы.
+    os.environ["SCHEDULERS_MODE"] = "leader"
+    import app as _web  # noqa: F401
+
+    while True:
+        time.sleep(3600)
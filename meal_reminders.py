@@ -1,147 +1,344 @@
+import json
 import os
-import requests
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
-from collections import defaultdict
 
+from apscheduler.jobstores.base import JobLookupError
+from apscheduler.jobstores.memory import MemoryJobStore
+from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
 from apscheduler.schedulers.background import BackgroundScheduler
-from flask import current_app
+from apscheduler.triggers.cron import CronTrigger
+from sqlalchemy import and_, delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
 
 from extensions import db
-from models import User, UserSettings, MealReminderLog
+from models import User, UserSettings, MealReminderLog, MealReminderSchedule
+from notification_service import send_fcm_multicast
 
-# Фиксированные времена (по времени сервера, Asia/Almaty)
+# Времена по умолчанию — в часовом поясе пользователя (UserSettings.meal_timezone).
+# Свои времена пользователь задаёт в UserSettings.meal_times ({"breakfast": "08:30", ...}).
 MEAL_SCHEDULE = {
     "breakfast": ("🍳 Завтрак", "08:00"),
     "lunch": ("🍲 Обед", "15:32"),
     "dinner": ("🍝 Ужин", "18:00"),
 }
+DEFAULT_TZ = "Asia/Almaty"
 
-_scheduler = None
+# Сколько получателей за один запрос / один multicast (лимит FCM — 500 токенов)
+BATCH_SIZE = int(os.getenv("MEAL_REMINDERS_BATCH_SIZE", "500"))
+# Напоминание, опоздавшее больше чем на N минут (простой/рестарт), не шлём — только переносим на завтра
+MISSED_GRACE_MIN = int(os.getenv("MEAL_REMINDERS_GRACE_MIN", "30"))
 
+# Персистентный стор: cron-слоты может добавить любой процесс (после смены настроек пользователем)
+JOBSTORE = "meals"
+SLOT_JOB_PREFIX = "meal-slot-"
 
-# --- НОВАЯ ЛОГИКА _tick() ---
+_scheduler = None
+_app = None
 
-def _tick():
-    """
-    Запускается каждую минуту по времени сервера (Asia/Almaty).
-    Проверяет, совпадает ли текущее время сервера с расписанием.
-    Если да - отправляет PUSH всем пользователям, у кого включены
-    уведомления и кто еще не получал его СЕГОДНЯ (по дате сервера).
-    """
 
-    # --- 1. Получаем текущее время и дату СЕРВЕРА (Almaty) ---
+# ==============================
+#   ИНДЕКС РАСПИСАНИЯ
+# ==============================
+
+def parse_meal_times(raw) -> dict:
+    """UserSettings.meal_times (JSON) → {meal_key: "HH:MM"} с дефолтами из MEAL_SCHEDULE."""
+    times = {key: hhmm for key, (_, hhmm) in MEAL_SCHEDULE.items()}
+    if raw:
+        try:
+            custom = json.loads(raw) if isinstance(raw, str) else raw
+            for key, hhmm in (custom or {}).items():
+                hhmm = normalize_hhmm(hhmm)
+                if key in times and hhmm:
+                    times[key] = hhmm
+        except (TypeError, ValueError, AttributeError):
+            pass
+    return times
+
+
+def normalize_hhmm(value):
+    """Время приёма пищи в каноническом виде ("8:30" → "08:30") или None; храним и сравниваем только его."""
     try:
-        # Убедимся, что работаем в Asia/Almaty, как и планировщик
-        tz_almaty = ZoneInfo("Asia/Almaty")
-        now_almaty = datetime.now(tz_almaty)
-        current_hhmm = now_almaty.strftime("%H:%M")
-        current_date = now_almaty.date()
-    except Exception as e:
-        print(f"[meal_scheduler] ERROR: Failed to get Almaty time: {e}")
-        return
+        return datetime.strptime(value, "%H:%M").strftime("%H:%M")
+    except (TypeError, ValueError):
+        return None
 
-    print(f"[meal_scheduler] _tick() RUNNING at {current_hhmm} (Almaty Time)")
 
-    # --- 2. Проверяем, совпадает ли время с расписанием ---
-    meal_to_send = None
-    for key, (title, scheduled_hhmm) in MEAL_SCHEDULE.items():
-        if current_hhmm == scheduled_hhmm:
-            meal_to_send = (key, title)
-            break
+def _tz(name):
+    try:
+        return ZoneInfo(name or DEFAULT_TZ)
+    except Exception:
+        return ZoneInfo(DEFAULT_TZ)
 
-    # Если сейчас не время отправки (например, 14:10) - выходим
-    if not meal_to_send:
-        print(f"[meal_scheduler] No schedule match for {current_hhmm}. Exiting.")
-        return
 
-    meal_key, title = meal_to_send
-    print(f"[meal_scheduler] MATCH FOUND: Sending '{meal_key}' for {current_date}")
+def _next_due(tz_name, hhmm: str, after_utc: datetime):
+    """Ближайший момент hhmm в поясе пользователя строго после after_utc → (UTC naive, локальная дата)."""
+    tz = _tz(tz_name)
+    local_now = after_utc.replace(tzinfo=timezone.utc).astimezone(tz)
+    at = datetime.strptime(hhmm, "%H:%M").time()
+    local_due = datetime.combine(local_now.date(), at, tzinfo=tz)
+    if local_due <= local_now:
+        local_due = datetime.combine(local_now.date() + timedelta(days=1), at, tzinfo=tz)
+    return local_due.astimezone(timezone.utc).replace(tzinfo=None), local_due.date()
 
-    # --- 3. Импорт PUSH-функции ---
-    try:
-        from app import _send_mobile_push
-    except ImportError:
-        print("ERROR: Could not import _send_mobile_push. Push notifications will fail.")
-        _send_mobile_push = None
-        return
 
-    # --- 4. Получаем ВСЕХ пользователей, кому можно отправлять ---
-    users_query = (
-        User.query
-        .join(UserSettings, UserSettings.user_id == User.id)
-        .filter(
-            UserSettings.notify_meals.is_(True),
-            User.fcm_device_token.isnot(None)  # Убедимся, что у них есть токен
-        )
-        .all()
-    )
+def _schedule_rows(user_id, tz_name, meal_times_raw, now_utc):
+    rows = []
+    for meal_key, hhmm in parse_meal_times(meal_times_raw).items():
+        due_at, local_date = _next_due(tz_name, hhmm, now_utc)
+        rows.append({"user_id": user_id, "meal_type": meal_key, "due_at": due_at, "local_date": local_date})
+    return rows
 
-    if not users_query:
-        print("[meal_scheduler] No users found with notify_meals=True and FCM token.")
-        return
 
-    print(f"[meal_scheduler] Found {len(users_query)} total eligible users.")
+def reindex_users(user_ids=None):
+    """
+    Пересчитать индекс meal_reminder_schedule: для user_ids (или для всех, пачками).
+    Пользователи с выключенным notify_meals из индекса удаляются. Коммит — на вызывающем.
+    """
+    now = datetime.utcnow()
+    last_id = 0
+    while True:
+        q = (
+            select(UserSettings.user_id, UserSettings.meal_timezone, UserSettings.meal_times,
+                   UserSettings.notify_meals)
+            .where(UserSettings.user_id > last_id)
+            .order_by(UserSettings.user_id)
+            .limit(BATCH_SIZE)
+        )
+        if user_ids is not None:
+            q = q.where(UserSettings.user_id.in_(user_ids))
+        settings = db.session.execute(q).all()
+        if not settings:
+            break
+        last_id = settings[-1][0]
 
-    # --- 5. Получаем ID тех, кто УЖЕ получил это уведомление СЕГОДНЯ ---
-    # (Мы используем current_date - дату сервера)
-    user_ids_already_sent = db.session.query(MealReminderLog.user_id).filter(
-        MealReminderLog.meal_type == meal_key,
-        MealReminderLog.date_sent == current_date
-    ).all()
+        ids = [s[0] for s in settings]
+        db.session.execute(
+            delete(MealReminderSchedule).where(MealReminderSchedule.user_id.in_(ids)),
+            execution_options={"synchronize_session": False},
+        )
+        rows = [
+            row
+            for uid, tz_name, meal_times, notify_meals in settings if notify_meals
+            for row in _schedule_rows(uid, tz_name, meal_times, now)
+        ]
+        if rows:
+            db.session.execute(insert(MealReminderSchedule), rows)
+        if user_ids is not None:
+            break
 
-    # Превращаем список кортежей [(33,), (34,)] в set {33, 34} для быстрой проверки
-    sent_user_id_set = {uid[0] for uid in user_ids_already_sent}
 
-    if sent_user_id_set:
-        print(f"[meal_scheduler] Found {len(sent_user_id_set)} users who already received '{meal_key}' today.")
+def reindex_missing():
+    """Добавить в индекс тех, у кого есть настройки, но нет строк (новые пользователи)."""
+    missing = db.session.execute(
+        select(UserSettings.user_id)
+        .outerjoin(MealReminderSchedule, MealReminderSchedule.user_id == UserSettings.user_id)
+        .where(UserSettings.notify_meals.is_(True), MealReminderSchedule.user_id.is_(None))
+    ).scalars().all()
+    for i in range(0, len(missing), BATCH_SIZE):
+        reindex_users(missing[i:i + BATCH_SIZE])
+    return len(missing)
 
-    # --- 6. Фильтруем и отправляем ---
-    logs_to_add = []
 
-    # Оставляем только тех, кто не в 'sent_user_id_set'
-    final_batch_to_send = [
-        user for user in users_query
-        if user.id not in sent_user_id_set
-    ]
+def on_settings_changed(user_ids):
+    """
+    Вызывается после коммита смены meal_timezone / meal_times / notify_meals.
+    Пересчитывает индекс и добавляет cron-слоты под новые времена (лишние уберёт суточная сверка).
+    """
+    reindex_users(user_ids)
+    db.session.commit()
+    sync_meal_jobs(user_ids)
 
-    if not final_batch_to_send:
-        print("[meal_scheduler] All eligible users have already received the notification. Nothing to send.")
-        return
 
-    print(f"[meal_scheduler] Sending notifications to {len(final_batch_to_send)} users...")
+# ==============================
+#   ОТПРАВКА НАСТУПИВШИХ КОРЗИН
+# ==============================
 
-    for user in final_batch_to_send:
-        sent = False
-        fcm_token = getattr(user, "fcm_device_token", None)
+def _tick(now_utc=None):
+    """
+    Обрабатывает все строки индекса с due_at <= now: шлёт напоминания тем, у кого есть токен
+    и ещё нет лога за эту локальную дату, затем переносит строки на следующий день.
+    Опоздавшие больше чем на MISSED_GRACE_MIN минут не шлются, только переносятся.
+    """
+    now = now_utc or datetime.utcnow()
+    grace_from = now - timedelta(minutes=MISSED_GRACE_MIN)
+    added = reindex_missing()
+    if added:
+        db.session.commit()
+
+    sent_total = failed_total = skipped = 0
+    while True:
+        S = MealReminderSchedule
+        batch = db.session.execute(
+            select(S.user_id, S.meal_type, S.due_at, S.local_date, User.fcm_device_token,
+                   UserSettings.notify_meals, UserSettings.meal_timezone, UserSettings.meal_times,
+                   MealReminderLog.id)
+            .join(User, User.id == S.user_id)
+            .join(UserSettings, UserSettings.user_id == S.user_id)
+            .outerjoin(MealReminderLog, and_(
+                MealReminderLog.user_id == S.user_id,
+                MealReminderLog.meal_type == S.meal_type,
+                MealReminderLog.date_sent == S.local_date,
+            ))
+            .where(S.due_at <= now)
+            .order_by(S.due_at, S.user_id)
+            .limit(BATCH_SIZE)
+        ).all()
+        if not batch:
+            break
 
-        if fcm_token and _send_mobile_push:
-            sent = _send_mobile_push(
-                fcm_token=fcm_token,
+        # --- 1. Кому слать: по одному multicast на тип приёма пищи ---
+        by_meal = {}
+        for uid, meal_key, due_at, local_date, token, notify_meals, _, _, log_id in batch:
+            if meal_key in MEAL_SCHEDULE and notify_meals and token and log_id is None and due_at >= grace_from:
+                by_meal.setdefault(meal_key, []).append((uid, token, local_date))
+            else:
+                skipped += 1
+
+        logs = []
+        for meal_key, recipients in by_meal.items():
+            title = MEAL_SCHEDULE[meal_key][0]
+            results = send_fcm_multicast(
+                [{"user_id": uid, "token": token} for uid, token, _ in recipients],
                 title=title,
                 body="Нажмите, чтобы зафиксировать его.",
-                data={"type": "meal_reminder", "meal_key": meal_key}
+                data={"type": "meal_reminder", "meal_key": meal_key},
             )
-
-        if sent:
-            logs_to_add.append(MealReminderLog(
-                user_id=user.id,
-                meal_type=meal_key,
-                date_sent=current_date  # Логгируем по дате сервера
-            ))
-
-    # --- 7. Сохраняем все логи ОДНОЙ транзакцией ---
-    if logs_to_add:
+            for (uid, _, local_date), r in zip(recipients, results):
+                if r["ok"]:
+                    logs.append({"user_id": uid, "meal_type": meal_key, "date_sent": local_date})
+                else:
+                    failed_total += 1
+
+        # --- 2. Логи отправленных и перенос строк индекса на следующий раз ---
+        # Строку, которую не перенести (приём пищи убран из MEAL_SCHEDULE, битые настройки), удаляем
+        # из индекса — иначе она навсегда остаётся наступившей и блокирует всю корзину
+        advanced, broken = [], []
+        for uid, meal_key, _, _, _, _, tz_name, meal_times, _ in batch:
+            try:
+                due_at, local_date = _next_due(tz_name, parse_meal_times(meal_times)[meal_key], now)
+            except Exception as e:
+                print(f"[meal_scheduler] ERROR: cannot reschedule {meal_key} for user {uid}: {e!r}")
+                broken.append((uid, meal_key))
+                continue
+            advanced.append({"user_id": uid, "meal_type": meal_key, "due_at": due_at, "local_date": local_date})
         try:
-            db.session.add_all(logs_to_add)
+            if logs:
+                _log_sent(logs)
+            if advanced:
+                db.session.execute(update(MealReminderSchedule), advanced)
+            for uid, meal_key in broken:
+                db.session.execute(
+                    delete(MealReminderSchedule)
+                    .where(MealReminderSchedule.user_id == uid, MealReminderSchedule.meal_type == meal_key),
+                    execution_options={"synchronize_session": False},
+                )
             db.session.commit()
-            print(f"[meal_scheduler] Successfully sent and logged {len(logs_to_add)} notifications.")
-        except Exception:
+            sent_total += len(logs)
+        except Exception as e:
             db.session.rollback()
-            print("[meal_scheduler] ERROR: Failed to save logs to database.")
+            print(f"[meal_scheduler] ERROR: Failed to save logs / advance schedule: {e}")
+            break
 
+    if sent_total or failed_total:
+        print(f"[meal_scheduler] Sent and logged {sent_total} notifications, "
+              f"{failed_total} failed, {skipped} skipped.")
+    return {"sent": sent_total, "failed": failed_total, "skipped": skipped}
+
+
+def _log_sent(rows: list):
+    """Bulk upsert в meal_reminder_log: параллельный тик/ручной запуск не упадёт на уникальном ключе."""
+    if db.engine.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    db.session.execute(
+        dialect_insert(MealReminderLog)
+        .values(rows)
+        .on_conflict_do_nothing(index_elements=["user_id", "meal_type", "date_sent"])
+    )
+
+
+# ==============================
+#   CRON-СЛОТЫ
+# ==============================
+
+def run_due_reminders():
+    """
+    Задача cron-слота: обработать наступившие строки индекса.
+    Хранится в персистентном сторе, поэтому ссылка на функцию должна быть модульной.
+    """
+    with _app.app_context():
+        try:
+            _tick()
+        finally:
+            db.session.remove()
 
-# --- ПУБЛИЧНЫЕ ФУНКЦИИ (без изменений) ---
+
+def _slot_job_id(tz_name: str, hhmm: str) -> str:
+    return f"{SLOT_JOB_PREFIX}{tz_name}-{hhmm}"
+
+
+def _slots_for(settings_rows) -> set:
+    """(meal_timezone, meal_times) → множество слотов (пояс, "HH:MM")."""
+    return {
+        (_tz(tz_name).key, hhmm)
+        for tz_name, meal_times in settings_rows
+        for hhmm in parse_meal_times(meal_times).values()
+    }
+
+
+def _desired_slots(user_ids=None) -> set:
+    """Источник расписания — настройки в БД (пояс + свои времена) поверх MEAL_SCHEDULE."""
+    q = select(UserSettings.meal_timezone, UserSettings.meal_times).where(UserSettings.notify_meals.is_(True))
+    if user_ids is not None:
+        q = q.where(UserSettings.user_id.in_(user_ids))
+    return _slots_for(db.session.execute(q.distinct()).all())
+
+
+def _add_slot_job(tz_name: str, hhmm: str):
+    hh, mm = map(int, hhmm.split(":"))
+    _scheduler.add_job(
+        run_due_reminders, CronTrigger(hour=hh, minute=mm, timezone=ZoneInfo(tz_name)),
+        id=_slot_job_id(tz_name, hhmm), jobstore=JOBSTORE, replace_existing=True,
+    )
+
+
+def sync_meal_jobs(user_ids=None):
+    """
+    Привести cron-задачи к расписанию: по задаче на каждый (пояс, время), который кому-то нужен.
+    user_ids — только добавить недостающие слоты этих пользователей (после смены настроек);
+    без аргумента — полная сверка, лишние слоты удаляются.
+    """
+    if not _scheduler:
+        return
+    desired = _desired_slots(user_ids)
+    existing = {
+        job.id: job for job in _scheduler.get_jobs(jobstore=JOBSTORE)
+        if job.id.startswith(SLOT_JOB_PREFIX)
+    }
+    added = removed = 0
+    for tz_name, hhmm in desired:
+        if _slot_job_id(tz_name, hhmm) not in existing:
+            _add_slot_job(tz_name, hhmm)
+            added += 1
+    if user_ids is None:
+        wanted = {_slot_job_id(tz_name, hhmm) for tz_name, hhmm in desired}
+        for job_id in existing.keys() - wanted:
+            _remove_job(job_id)
+            removed += 1
+    if added or removed:
+        print(f"[meal_scheduler] cron slots synced: +{added} -{removed}")
+
+
+def _remove_job(job_id):
+    try:
+        _scheduler.remove_job(job_id, jobstore=JOBSTORE)
+    except JobLookupError:
+        pass
+
+
+# --- ПУБЛИЧНЫЕ ФУНКЦИИ ---
 
 def get_scheduler():
     """Вернуть текущий инстанс APScheduler (или None)."""
@@ -159,28 +356,60 @@ def resume_job(job_id: str):
 
 
 def run_tick_now(app):
-    """Принудительно вызвать тик рассылки напоминаний (в Flask-контексте)."""
+    """Принудительно обработать наступившие строки индекса (в Flask-контексте)."""
     with app.app_context():
         _tick()
 
 
-def start_meal_scheduler(app):
-    """Создать и запустить шедулер (если ещё не создан). Вернуть инстанс."""
-    global _scheduler
+def start_meal_scheduler(app, paused=False):
+    """Создать и запустить шедулер (если ещё не создан). Вернуть инстанс.
+    Вместо поминутного опроса — cron-задача на каждый (пояс, время) из настроек пользователей;
+    набор задач пересобирается при смене настроек и раз в сутки.
+    paused=True — задачи не выполняются, пока раннер не сделает resume() (см. job_runner)."""
+    global _scheduler, _app
     if _scheduler:
         return _scheduler
+    _app = app
 
-    _scheduler = BackgroundScheduler(timezone="Asia/Almaty")
+    with app.app_context():
+        jobstores = {
+            "default": MemoryJobStore(),
+            JOBSTORE: SQLAlchemyJobStore(engine=db.engine, tablename="apscheduler_meal_jobs"),
+        }
+
+    _scheduler = BackgroundScheduler(
+        timezone="Asia/Almaty",
+        jobstores=jobstores,
+        job_defaults={"coalesce": True, "misfire_grace_time": MISSED_GRACE_MIN * 60},
+    )
 
-    def _job():
-        # print("[meal_scheduler] JOB FIRING...") # (Убираем лишний лог)
-        # даём Flask-контекст внутри джобы
+    def _resync_daily():
         with app.app_context():
-            _tick()
+            try:
+                # Сначала отправляем наступившее, затем пересобираем индекс (подхватит смену MEAL_SCHEDULE)
+                _tick()
+                reindex_users()
+                db.session.commit()
+                sync_meal_jobs()
+            finally:
+                db.session.remove()
+
+    # Страховка: раз в сутки полная пересборка индекса и cron-слотов
+    _scheduler.add_job(_resync_daily, "cron", hour=3, minute=0, id="meal-reminders-resync",
+                       replace_existing=True)
+    _scheduler.start(paused=paused)
 
-    # регистрируем периодическую задачу и стартуем шедулер
-    # Интервал в 1 минуту - это ПРАВИЛЬНО.
-    _scheduler.add_job(_job, "interval", minutes=1, id="meal-reminders", replace_existing=True)
-    _scheduler.start()
-    print("[meal_scheduler] BackgroundScheduler started (Server Timezone: Asia/Almaty).")
-    return _scheduler
\ No newline at end of file
+    with app.app_context():
+        try:
+            # Первый запуск: индекс пуст — строим целиком
+            if db.session.execute(select(MealReminderSchedule.user_id).limit(1)).first() is None:
+                reindex_users()
+                db.session.commit()
+            sync_meal_jobs()
+        except IntegrityError:
+            # индекс параллельно строит другой процесс
+            db.session.rollback()
+        finally:
+            db.session.remove()
+    print("[meal_scheduler] BackgroundScheduler started (per-user timezones, cron slot per meal time).")
+    return _scheduler
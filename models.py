@@ -18,6 +18,9 @@ class User(db.Model):
     renewal_reminder_last_shown_on = db.Column(db.Date)
     renewal_telegram_sent = db.Column(db.Boolean, default=False, server_default=expression.false())
     fcm_device_token = db.Column(db.String(255), nullable=True, unique=True, index=True)
+    # Подряд идущие временные ошибки FCM по текущему токену (сбрасывается при успешной отправке)
+    fcm_failure_count = db.Column(db.Integer, default=0, nullable=False, server_default='0')
+    fcm_last_failure_at = db.Column(db.DateTime, nullable=True)
     # Глобальные флаги уведомлений (держим для обратной совместимости)
     telegram_notify_enabled = db.Column(db.Boolean, default=True, server_default=expression.true())
     notify_trainings = db.Column(db.Boolean, default=True, server_default=expression.true())
@@ -58,8 +61,12 @@ class User(db.Model):
     squad_fitness_level = db.Column(db.String(20), nullable=True)  # 'newbie', 'pro'
     # ------------------------------------
 
-    # Кэш стрика (пересчитывается на основе реальных записей MealLog)
+    # Стрик питания: ведётся инкрементально (streak_bp.on_meal_logged), ремонт — recalculate_streak
     current_streak = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    longest_streak = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    last_logged_date = db.Column(db.Date, nullable=True)
+    # Версия снимков мобильных экранов (ETag), увеличивается при изменении данных пользователя (snapshot_cache)
+    snapshot_version = db.Column(db.Integer, default=0, server_default='0', nullable=False)
     # отношения
     subscription = db.relationship(
         'Subscription',
@@ -398,6 +405,28 @@ class Activity(db.Model):
     )
 
 
+class DailyEnergyBalance(db.Model):
+    """
+    Материализованный энергобаланс по дням (ведёт energy_balance.py при записи еды / активности / замеров).
+    Строка есть только для дней с едой, активностью или замером.
+    """
+    __tablename__ = "daily_energy_balance"
+
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    date = db.Column(db.Date, primary_key=True)
+    consumed = db.Column(db.Integer, nullable=False, default=0)
+    meal_count = db.Column(db.Integer, nullable=False, default=0)
+    active = db.Column(db.Integer, nullable=False, default=0)
+    bmr = db.Column(db.Integer, nullable=False, default=0)  # метаболизм последнего замера на эту дату
+    # max(0, bmr + active - consumed) для дней с едой, иначе 0
+    deficit = db.Column(db.Integer, nullable=False, default=0)
+    # Сумма deficit по всем строкам пользователя до этой даты включительно
+    cumulative_deficit = db.Column(db.Integer, nullable=False, default=0)
+    # Съедено в этот день до последнего замера этого дня (для прогноза «после замера»)
+    anchor_consumed = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
 class Diet(db.Model):
     __tablename__ = "diet"
 
@@ -561,6 +590,8 @@ class UserSettings(db.Model):
     meal_timezone = db.Column(
         db.String(64), default="Asia/Almaty", server_default="Asia/Almaty", nullable=False
     )
+    # Свои времена напоминаний: JSON {"breakfast": "08:30", ...}; нет ключа — время по умолчанию
+    meal_times = db.Column(db.Text, nullable=True)
 
     user = db.relationship("User", backref=db.backref("settings", uselist=False))
 
@@ -578,6 +609,20 @@ class MealReminderLog(db.Model):
     )
 
 
+class MealReminderSchedule(db.Model):
+    """
+    Индекс расписания напоминаний о еде: ближайший момент (UTC) для пары пользователь × приём пищи.
+    Будят шедулер cron-слоты — по задаче на каждую пару (пояс, ЧЧ:ММ) в персистентном jobstore "meals";
+    слот забирает из индекса наступившие строки (due_at <= now), а не опрашивает всех каждую минуту.
+    """
+    __tablename__ = "meal_reminder_schedule"
+
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"), primary_key=True)
+    meal_type = db.Column(db.String(16), primary_key=True)
+    due_at = db.Column(db.DateTime, nullable=False, index=True)  # UTC
+    local_date = db.Column(db.Date, nullable=False)  # дата по поясу пользователя — ключ MealReminderLog
+
+
 # ------------------ DIET AUTOGEN PREFS / STAGING ------------------
 
 class DietPreference(db.Model):
@@ -697,6 +742,19 @@ class UserAchievement(db.Model):
     __table_args__ = (db.UniqueConstraint('user_id', 'slug', name='uq_user_achievement'),)
 
 
+class AchievementProgress(db.Model):
+    """Кэш открытых ачивок пользователя для движка achievements_engine."""
+    __tablename__ = 'achievement_progress'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    unlocked = db.Column(db.Text, nullable=False, default='', server_default='')  # 'first_meal,streak_5'
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    @property
+    def unlocked_slugs(self):
+        return set(filter(None, (self.unlocked or '').split(',')))
+
+
 class EmailVerification(db.Model):
     __tablename__ = "email_verification"
     email = db.Column(db.String(120), primary_key=True)
@@ -767,6 +825,109 @@ class AnalyticsEvent(db.Model):
     user = db.relationship('User', backref=db.backref('analytics_events', lazy=True))
 
 
+class AnalyticsDailyRollup(db.Model):
+    """
+    Дневные агрегаты analytics_events по типу события (день — по created_at, UTC).
+    Ведёт компактор analytics_rollup.py; админская аналитика читает только отсюда.
+    """
+    __tablename__ = "analytics_daily_rollup"
+
+    event_type = db.Column(db.String(50), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    event_count = db.Column(db.Integer, nullable=False, default=0)
+    distinct_users = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (db.Index('ix_analytics_rollup_day', 'day'),)
+
+
+class AnalyticsFirstEvent(db.Model):
+    """Первый день, когда пользователь совершил событие данного типа (для воронок по уникальным)."""
+    __tablename__ = "analytics_first_event"
+
+    event_type = db.Column(db.String(50), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    first_day = db.Column(db.Date, nullable=False, index=True)
+
+
+# ------------------ BACKGROUND JOBS ------------------
+
+class SchedulerLease(db.Model):
+    """Аренда лидерства фоновых шедулеров: только держатель аренды выполняет задачи."""
+    __tablename__ = "scheduler_lease"
+
+    name = db.Column(db.String(64), primary_key=True)
+    holder = db.Column(db.String(128), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+    acquired_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class NotificationOutbox(db.Model):
+    """
+    Очередь исходящих пушей / Telegram-сообщений.
+    Запрос только вставляет строку, доставляют воркеры outbox (повторы, лимиты, склейка дублей).
+    """
+    __tablename__ = "notification_outbox"
+
+    id = db.Column(db.Integer, primary_key=True)
+    channel = db.Column(db.String(16), nullable=False)  # 'fcm' | 'telegram'
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, index=True)
+    title = db.Column(db.String(255), nullable=False)
+    body = db.Column(db.Text, nullable=True)
+    data_json = db.Column(db.Text, nullable=True)
+
+    # pending -> sending -> sent | dead (повторять бессмысленно) | failed (кончились попытки)
+    status = db.Column(db.String(16), nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    # Для pending — когда можно слать; для sending — до какого момента строка «захвачена» воркером
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (db.Index('ix_outbox_status_next', 'status', 'next_attempt_at'),)
+
+
+class BroadcastJob(db.Model):
+    """Рассылка из админки: выполняется фоновым воркером, прогресс и курсор хранятся здесь (можно продолжить после рестарта)."""
+    __tablename__ = "broadcast_jobs"
+
+    id = db.Column(db.Integer, primary_key=True)
+    text = db.Column(db.Text, nullable=False)
+    only_active = db.Column(db.Boolean, nullable=False, default=False)
+
+    # queued -> running -> done | cancelled
+    status = db.Column(db.String(16), nullable=False, default='queued', index=True)
+    total = db.Column(db.Integer, nullable=False, default=0)
+    sent = db.Column(db.Integer, nullable=False, default=0)
+    failed = db.Column(db.Integer, nullable=False, default=0)
+    # Последний обработанный User.id (keyset-курсор)
+    cursor_user_id = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.Text, nullable=True)
+
+    created_by = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='SET NULL'), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    heartbeat_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+
+class PushTokenHealth(db.Model):
+    """
+    Счётчики отправок пушей и удалённых мёртвых токенов (строка на канал, сейчас только 'fcm').
+    Общие для всех процессов: шлёт в основном шедулер, а смотрит админка в веб-процессе.
+    """
+    __tablename__ = "push_token_health"
+
+    channel = db.Column(db.String(16), primary_key=True)
+    sent = db.Column(db.Integer, nullable=False, default=0)
+    failed = db.Column(db.Integer, nullable=False, default=0)
+    transient = db.Column(db.Integer, nullable=False, default=0)
+    pruned = db.Column(db.Integer, nullable=False, default=0)
+    last_pruned_at = db.Column(db.DateTime, nullable=True)
+    updated_at = db.Column(db.DateTime, nullable=True)
+
+
 @event.listens_for(User, "after_insert")
 def create_default_settings(mapper, connection, target):
     """
@@ -1,60 +1,329 @@
 import json
 import logging
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
-from firebase_admin import messaging
+from firebase_admin import exceptions as firebase_exceptions, messaging
+from flask import current_app
+from sqlalchemy import insert, select, update
 from extensions import db
-from models import User, Notification
+from models import User, Notification, NotificationOutbox, PushTokenHealth
 
 logger = logging.getLogger(__name__)
 
+# send_each принимает не больше 500 сообщений за вызов
+FCM_BATCH_SIZE = 500
+
+# Пуши уходят в фоне, чтобы запрос/тик не ждал FCM
+_push_pool = ThreadPoolExecutor(
+    max_workers=int(os.getenv("FCM_PUSH_WORKERS", "2")),
+    thread_name_prefix="fcm-push",
+)
+
 
 def send_user_notification(user_id: int, title: str, body: str, type: str = 'info', data: dict = None):
     """
     1. Сохраняет уведомление в БД.
-    2. Отправляет Push-уведомление через FCM (если у пользователя есть токен).
+    2. Ставит Push-уведомление в outbox (доставят воркеры outbox.py).
     """
     try:
-        # 1. Сохранение в БД
-        new_notif = Notification(
-            user_id=user_id,
-            title=title,
-            body=body,
-            type=type,
-            data_json=json.dumps(data) if data else None,
-            created_at=datetime.utcnow()
-        )
-        db.session.add(new_notif)
-        db.session.commit()
-
-        # 2. Отправка FCM (Push)
-        # Получаем пользователя для токена
-        user = db.session.get(User, user_id)
-        if user and user.fcm_device_token:
-            send_fcm_push(user.fcm_device_token, title, body, data)
-
+        queue_user_notifications([{
+            "user_id": user_id, "title": title, "body": body, "type": type, "data": data,
+        }])
         return True
     except Exception as e:
+        db.session.rollback()
         logger.error(f"Error sending notification to user {user_id}: {e}")
         # Не падать если ошибка сохранения, главное попытаться отправить пуш
         return False
 
 
+def queue_user_notifications(items: list, channels=("fcm",), commit: bool = True) -> int:
+    """
+    Для обработчиков запросов: Notification и строки outbox вставляются двумя INSERT,
+    сами пуши / Telegram отправляют воркеры outbox — время ответа не зависит от числа получателей.
+    items — список dict(user_id, title, body[, type, data]); channels — 'fcm' и/или 'telegram'.
+    Возвращает число поставленных в очередь сообщений.
+    """
+    if not items:
+        return 0
+
+    _insert_notifications(items)
+    now = datetime.utcnow()
+    rows = [
+        {
+            "channel": channel,
+            "user_id": it["user_id"],
+            "title": it["title"],
+            "body": it["body"],
+            "data_json": json.dumps(it["data"]) if it.get("data") else None,
+            "status": "pending",
+            "attempts": 0,
+            "next_attempt_at": now,
+            "created_at": now,
+        }
+        for it in items
+        for channel in channels
+    ]
+    db.session.execute(insert(NotificationOutbox), rows)
+    if commit:
+        db.session.commit()
+    return len(rows)
+
+
+def send_bulk_notifications(items: list, commit: bool = True) -> Future:
+    """
+    Пачечный send_user_notification для многих получателей (фоновые задачи).
+    items — список dict(user_id, title, body[, type, data, token]); если token не передан,
+    токены берутся из User одним запросом.
+    1. Все Notification вставляются одним INSERT.
+    2. Пуши уходят в фоне через send_each пачками по 500.
+    Возвращает Future со списком результатов по токенам (см. send_fcm_batch).
+    commit=False — вставка остаётся в текущей транзакции, коммитит вызывающий.
+    """
+    if not items:
+        return _done([])
+
+    _insert_notifications(items)
+
+    missing = {it["user_id"] for it in items if "token" not in it}
+    tokens = {}
+    if missing:
+        tokens = dict(db.session.execute(
+            select(User.id, User.fcm_device_token).where(User.id.in_(missing))
+        ).all())
+
+    if commit:
+        db.session.commit()
+
+    pushes = []
+    for it in items:
+        token = it["token"] if "token" in it else tokens.get(it["user_id"])
+        if token:
+            pushes.append({
+                "user_id": it["user_id"], "token": token,
+                "title": it["title"], "body": it["body"], "data": it.get("data"),
+            })
+    return send_fcm_batch_async(pushes)
+
+
+def _insert_notifications(items: list):
+    now = datetime.utcnow()
+    db.session.execute(insert(Notification), [
+        {
+            "user_id": it["user_id"],
+            "title": it["title"],
+            "body": it["body"],
+            "type": it.get("type") or "info",
+            "data_json": json.dumps(it["data"]) if it.get("data") else None,
+            "created_at": now,
+        }
+        for it in items
+    ])
+
+
+def send_fcm_batch_async(pushes: list) -> Future:
+    """
+    send_fcm_batch в фоновом пуле; результаты сразу учитываются в record_push_results.
+    Future → список результатов по токенам.
+    """
+    if not pushes:
+        return _done([])
+    app = current_app._get_current_object()
+    return _push_pool.submit(_send_and_record, app, pushes)
+
+
+def _send_and_record(app, pushes: list) -> list:
+    results = send_fcm_batch(pushes)
+    try:
+        with app.app_context():
+            record_push_results(results)
+    except Exception as e:
+        logger.error(f"FCM token health update failed: {e}")
+    return results
+
+
+def send_fcm_batch(pushes: list) -> list:
+    """
+    Синхронная отправка пачки пушей через messaging.send_each (по FCM_BATCH_SIZE за вызов).
+    pushes — список dict(token, title, body[, data, user_id]).
+    Возвращает список dict(user_id, token, ok, message_id, error) в том же порядке;
+    error — исключение FCM (например messaging.UnregisteredError), чтобы вызывающий мог на него отреагировать.
+    """
+    results = []
+    for i in range(0, len(pushes), FCM_BATCH_SIZE):
+        chunk = pushes[i:i + FCM_BATCH_SIZE]
+        try:
+            batch = messaging.send_each([
+                _build_message(p["token"], p["title"], p["body"], p.get("data")) for p in chunk
+            ])
+            responses = [(r.success, r.message_id, r.exception) for r in batch.responses]
+        except Exception as e:
+            logger.error(f"FCM batch error: {e}")
+            responses = [(False, None, e)] * len(chunk)
+
+        for p, (ok, message_id, error) in zip(chunk, responses):
+            results.append({
+                "user_id": p.get("user_id"), "token": p["token"],
+                "ok": ok, "message_id": message_id, "error": error,
+            })
+
+    failed = sum(1 for r in results if not r["ok"])
+    if failed:
+        logger.warning(f"FCM batch: {failed}/{len(results)} pushes failed")
+    return results
+
+
+def send_fcm_multicast(pushes: list, title: str, body: str, data: dict = None) -> list:
+    """
+    Одно и то же сообщение многим устройствам: send_each_for_multicast по FCM_BATCH_SIZE токенов.
+    pushes — список dict(token[, user_id]). Синхронно; результаты сразу учитываются в record_push_results.
+    Возвращает список dict(user_id, token, ok, message_id, error) в том же порядке.
+    """
+    str_data = {k: str(v) for k, v in (data or {}).items()}
+    results = []
+    for i in range(0, len(pushes), FCM_BATCH_SIZE):
+        chunk = pushes[i:i + FCM_BATCH_SIZE]
+        try:
+            batch = messaging.send_each_for_multicast(messaging.MulticastMessage(
+                tokens=[p["token"] for p in chunk],
+                notification=messaging.Notification(title=title, body=body),
+                data=str_data,
+            ))
+            responses = [(r.success, r.message_id, r.exception) for r in batch.responses]
+        except Exception as e:
+            logger.error(f"FCM multicast error: {e}")
+            responses = [(False, None, e)] * len(chunk)
+
+        for p, (ok, message_id, error) in zip(chunk, responses):
+            results.append({
+                "user_id": p.get("user_id"), "token": p["token"],
+                "ok": ok, "message_id": message_id, "error": error,
+            })
+
+    try:
+        record_push_results(results)
+    except Exception as e:
+        logger.error(f"FCM token health update failed: {e}")
+    return results
+
+
 def send_fcm_push(token: str, title: str, body: str, data: dict = None):
     """Отправка только пуша (вспомогательная функция)"""
+    results = send_fcm_batch([{"token": token, "title": title, "body": body, "data": data}])
     try:
-        # FCM принимает данные только в формате строк
-        str_data = {k: str(v) for k, v in (data or {}).items()}
-
-        message = messaging.Message(
-            notification=messaging.Notification(
-                title=title,
-                body=body,
-            ),
-            data=str_data,
-            token=token,
-        )
-        response = messaging.send(message)
-        return True
+        record_push_results(results)
     except Exception as e:
-        logger.error(f"FCM error: {e}")
-        return False
\ No newline at end of file
+        logger.error(f"FCM token health update failed: {e}")
+    return results[0]["ok"]
+
+
+# ==============================
+#   ЗДОРОВЬЕ ТОКЕНОВ
+# ==============================
+
+def is_dead_token_error(error) -> bool:
+    """Токен больше никогда не сработает: приложение удалено / токен чужой или битый."""
+    if isinstance(error, (messaging.UnregisteredError, messaging.SenderIdMismatchError)):
+        return True
+    return (
+        isinstance(error, firebase_exceptions.InvalidArgumentError)
+        and "registration token" in str(error).lower()
+    )
+
+
+def record_push_results(results: list) -> int:
+    """
+    Разбирает результаты send_fcm_batch:
+      - мёртвые токены (Unregistered / невалидный токен) обнуляются у пользователей;
+      - временные ошибки FCM увеличивают User.fcm_failure_count;
+      - успешная отправка сбрасывает счётчик.
+    Ошибки не от FCM (SDK не инициализирован и т.п.) токены не трогают.
+    Пишет в своей транзакции на отдельном соединении (db.engine.begin()), а не в db.session:
+    вызывается из send_fcm_push / send_fcm_multicast посреди чужих единиц работы, коммитить их нельзя.
+    Счётчики копятся в push_token_health — их видит админка любого процесса. Возвращает число удалённых токенов.
+    """
+    dead, transient, ok = set(), set(), set()
+    for r in results:
+        if r["ok"]:
+            ok.add(r["token"])
+        elif is_dead_token_error(r["error"]):
+            dead.add(r["token"])
+        elif isinstance(r["error"], firebase_exceptions.FirebaseError):
+            transient.add(r["token"])
+    if not results:
+        return 0
+
+    now = datetime.utcnow()
+    pruned = 0
+    with db.engine.begin() as conn:
+        if dead:
+            pruned = conn.execute(
+                update(User)
+                .where(User.fcm_device_token.in_(dead))
+                .values(fcm_device_token=None, fcm_failure_count=0)
+            ).rowcount
+        if transient:
+            conn.execute(
+                update(User)
+                .where(User.fcm_device_token.in_(transient))
+                .values(fcm_failure_count=User.fcm_failure_count + 1, fcm_last_failure_at=now)
+            )
+        if ok:
+            conn.execute(
+                update(User)
+                .where(User.fcm_device_token.in_(ok), User.fcm_failure_count > 0)
+                .values(fcm_failure_count=0)
+            )
+        _bump_health(conn, now, sent=len(ok), failed=len(results) - len(ok), transient=len(transient), pruned=pruned)
+    if pruned:
+        logger.info(f"FCM: pruned {pruned} dead device tokens")
+    return pruned
+
+
+def _bump_health(conn, now, channel="fcm", **deltas):
+    """Атомарно прибавить счётчики push_token_health (строка канала создаётся при первой отправке)."""
+    if db.engine.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    conn.execute(
+        dialect_insert(PushTokenHealth)
+        .values(channel=channel, sent=0, failed=0, transient=0, pruned=0)
+        .on_conflict_do_nothing(index_elements=["channel"])
+    )
+    values = {key: getattr(PushTokenHealth, key) + value for key, value in deltas.items() if value}
+    values["updated_at"] = now
+    if deltas.get("pruned"):
+        values["last_pruned_at"] = now
+    conn.execute(update(PushTokenHealth).where(PushTokenHealth.channel == channel).values(**values))
+
+
+def get_token_health(channel="fcm") -> dict:
+    """Счётчики отправок и удалённых токенов за всё время (по всем процессам)."""
+    row = db.session.get(PushTokenHealth, channel)
+    if row is None:
+        return {"sent": 0, "failed": 0, "transient": 0, "pruned": 0, "last_pruned_at": None}
+    return {
+        "sent": row.sent, "failed": row.failed, "transient": row.transient, "pruned": row.pruned,
+        "last_pruned_at": row.last_pruned_at.isoformat(timespec="seconds") if row.last_pruned_at else None,
+    }
+
+
+def _build_message(token: str, title: str, body: str, data: dict = None) -> messaging.Message:
+    # FCM принимает данные только в формате строк
+    str_data = {k: str(v) for k, v in (data or {}).items()}
+    return messaging.Message(
+        notification=messaging.Notification(
+            title=title,
+            body=body,
+        ),
+        data=str_data,
+        token=token,
+    )
+
+
+def _done(result) -> Future:
+    fut = Future()
+    fut.set_result(result)
+    return fut
@@ -0,0 +1,223 @@
+# Доставка очереди notification_outbox.
+# Обработчики запросов только вставляют строки (notification_service.queue_user_notifications),
+# а здесь задача шедулера каждые OUTBOX_POLL_SEC секунд забирает пачку, склеивает дубли,
+# шлёт FCM через send_each и Telegram через пул потоков — с лимитом скорости и повторами.
+# Шедулер поднимается через job_runner, поэтому очередь разбирает только лидер.
+import json
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from apscheduler.schedulers.background import BackgroundScheduler
+from sqlalchemy import and_, delete, func, or_, select, update
+
+from extensions import db
+from models import NotificationOutbox, User
+from notification_service import is_dead_token_error, record_push_results, send_fcm_batch
+from rate_limit import TokenBucket
+from telegram_client import make_session, send_message
+
+BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "500"))
+MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+BACKOFF_SEC = float(os.getenv("OUTBOX_BACKOFF_SEC", "5"))
+# Сколько строка считается «захваченной» воркером (после падения процесса её подберут снова)
+LOCK_SEC = int(os.getenv("OUTBOX_LOCK_SEC", "120"))
+RETENTION_DAYS = int(os.getenv("OUTBOX_RETENTION_DAYS", "7"))
+
+_scheduler = None
+_fcm_bucket = TokenBucket(rate=float(os.getenv("OUTBOX_FCM_RPS", "500")), burst=BATCH_SIZE)
+_TG_CONCURRENCY = int(os.getenv("OUTBOX_TG_CONCURRENCY", "8"))
+_tg_pool = ThreadPoolExecutor(max_workers=_TG_CONCURRENCY, thread_name_prefix="outbox-tg")
+_tg_session = make_session(_TG_CONCURRENCY)
+
+
+# ==============================
+#   ЗАХВАТ ПАЧКИ
+# ==============================
+
+def _claim(limit: int):
+    """Помечает до limit готовых строк как sending и возвращает их вместе с адресатами."""
+    now = datetime.utcnow()
+    O = NotificationOutbox
+    ids = [
+        oid for (oid,) in db.session.execute(
+            select(O.id)
+            .where(or_(
+                and_(O.status == "pending", O.next_attempt_at <= now),
+                and_(O.status == "sending", O.next_attempt_at < now),
+            ))
+            .order_by(O.id)
+            .limit(limit)
+        )
+    ]
+    if not ids:
+        db.session.rollback()
+        return []
+
+    db.session.execute(
+        update(O)
+        .where(O.id.in_(ids), O.status.in_(("pending", "sending")))
+        .values(status="sending", next_attempt_at=now + timedelta(seconds=LOCK_SEC)),
+        execution_options={"synchronize_session": False},
+    )
+    rows = db.session.execute(
+        select(O.id, O.channel, O.title, O.body, O.data_json, O.attempts,
+               User.fcm_device_token, User.telegram_chat_id)
+        .join(User, User.id == O.user_id)
+        .where(O.id.in_(ids))
+    ).all()
+    db.session.commit()
+    return rows
+
+
+# ==============================
+#   ДОСТАВКА
+# ==============================
+
+def _deliver(rows) -> dict:
+    """
+    Отправляет захваченные строки. Одинаковые сообщения одному адресату склеиваются в одно.
+    Возвращает {outbox_id: (ok, retry_after, error)}.
+    """
+    outcome = {}
+    groups = {}
+    for oid, channel, title, body, data_json, attempts, token, chat_id in rows:
+        target = token if channel == "fcm" else chat_id
+        if not target:
+            outcome[oid] = (False, None, "no fcm token" if channel == "fcm" else "no telegram chat")
+            continue
+        groups.setdefault((channel, target, title, body, data_json), []).append(oid)
+
+    # Telegram — в пуле потоков, параллельно с FCM
+    tg_futures = {
+        key: _tg_pool.submit(send_message, _tg_session, key[1],
+                             f"{key[2]}\n\n{key[3]}" if key[3] else key[2])
+        for key in groups if key[0] == "telegram"
+    }
+
+    fcm_keys = [key for key in groups if key[0] == "fcm"]
+    for i in range(0, len(fcm_keys), BATCH_SIZE):
+        chunk = fcm_keys[i:i + BATCH_SIZE]
+        _fcm_bucket.acquire(len(chunk))
+        results = send_fcm_batch([
+            {"token": key[1], "title": key[2], "body": key[3],
+             "data": json.loads(key[4]) if key[4] else None}
+            for key in chunk
+        ])
+        record_push_results(results)
+        for key, r in zip(chunk, results):
+            if r["ok"]:
+                res = (True, None, None)
+            else:
+                res = (False, None if is_dead_token_error(r["error"]) else 0.0, str(r["error"]))
+            for oid in groups[key]:
+                outcome[oid] = res
+
+    for key, fut in tg_futures.items():
+        for oid in groups[key]:
+            outcome[oid] = fut.result()
+    return outcome
+
+
+def _save_outcome(rows, outcome: dict):
+    now = datetime.utcnow()
+    attempts_by_id = {r[0]: r[5] for r in rows}
+    updates = []
+    for oid, (ok, retry_after, error) in outcome.items():
+        attempts = attempts_by_id[oid] + 1
+        if ok:
+            updates.append({"id": oid, "status": "sent", "attempts": attempts, "sent_at": now, "last_error": None})
+        elif retry_after is None:
+            updates.append({"id": oid, "status": "dead", "attempts": attempts, "last_error": error})
+        elif attempts >= MAX_ATTEMPTS:
+            updates.append({"id": oid, "status": "failed", "attempts": attempts, "last_error": error})
+        else:
+            delay = max(retry_after, BACKOFF_SEC * (2 ** (attempts - 1)) + random.uniform(0, BACKOFF_SEC))
+            updates.append({
+                "id": oid, "status": "pending", "attempts": attempts, "last_error": error,
+                "next_attempt_at": now + timedelta(seconds=delay),
+            })
+    if updates:
+        db.session.execute(update(NotificationOutbox), updates)
+    db.session.commit()
+
+
+def drain_outbox(max_seconds: float = 50) -> dict:
+    """Разбирает очередь пачками, пока она не опустеет или не выйдет время. Возвращает счётчики."""
+    started = time.monotonic()
+    stats = {"sent": 0, "retry": 0, "dead": 0}
+    while time.monotonic() - started < max_seconds:
+        rows = _claim(BATCH_SIZE)
+        if not rows:
+            break
+        outcome = _deliver(rows)
+        _save_outcome(rows, outcome)
+        for ok, retry_after, _ in outcome.values():
+            stats["sent" if ok else ("dead" if retry_after is None else "retry")] += 1
+    if any(stats.values()):
+        print(f"[outbox] sent={stats['sent']} retry={stats['retry']} dead={stats['dead']} "
+              f"in {time.monotonic() - started:.1f}s")
+    return stats
+
+
+def purge_outbox():
+    """Удаляет доставленные и окончательно неудачные строки старше OUTBOX_RETENTION_DAYS."""
+    cutoff = datetime.utcnow() - timedelta(days=RETENTION_DAYS)
+    res = db.session.execute(
+        delete(NotificationOutbox)
+        .where(NotificationOutbox.status.in_(("sent", "dead", "failed")), NotificationOutbox.created_at < cutoff),
+        execution_options={"synchronize_session": False},
+    )
+    db.session.commit()
+    print(f"[outbox] purged {res.rowcount} old rows")
+
+
+def get_outbox_stats() -> dict:
+    """Количество строк по статусам (для админки)."""
+    try:
+        return dict(db.session.execute(
+            select(NotificationOutbox.status, func.count()).group_by(NotificationOutbox.status)
+        ).all())
+    except Exception:
+        db.session.rollback()
+        return {}
+
+
+# ==============================
+#   СТАРТ
+# ==============================
+
+def get_scheduler():
+    return _scheduler
+
+
+def start_outbox_worker(app, paused=False):
+    global _scheduler
+    if _scheduler:
+        return _scheduler
+
+    poll_sec = float(os.getenv("OUTBOX_POLL_SEC", "1"))
+
+    def _drain():
+        with app.app_context():
+            try:
+                drain_outbox()
+            except Exception as e:
+                db.session.rollback()
+                print(f"[outbox] drain failed: {e}")
+            finally:
+                db.session.remove()
+
+    def _purge():
+        with app.app_context():
+            purge_outbox()
+
+    _scheduler = BackgroundScheduler(timezone="Asia/Almaty")
+    _scheduler.add_job(_drain, "interval", seconds=poll_sec, id="outbox-drain",
+                       max_instances=1, coalesce=True)
+    _scheduler.add_job(_purge, "cron", hour=3, minute=30, id="outbox-purge")
+    _scheduler.start(paused=paused)
+    print(f"[outbox] worker started: every {poll_sec}s, batch {BATCH_SIZE}")
+    return _scheduler
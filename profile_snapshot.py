@@ -0,0 +1,186 @@
+# Снимок главного экрана мобильного приложения (/api/app/profile_data).
+# Всё собирается фиксированным числом запросов независимо от истории пользователя:
+#   1) User + аватар + подписка (joinedload),
+#   2) замеры: последний, стартовый и все после стартового — одним запросом,
+#   3) последняя диета,
+#   4) daily_energy_balance одним range scan — и «сердечки» за 7 дней, и прогноз после замера.
+import json
+from datetime import date, timedelta
+
+from sqlalchemy import or_, select
+from sqlalchemy.orm import joinedload
+
+from energy_balance import KCAL_PER_KG_FAT, deficit_from_rows, get_days
+from extensions import db
+from models import BodyAnalysis, Diet, User
+
+# Бюджет запросов на снимок — проверяет регрессионный бенчмарк bench_profile_snapshot.py
+PROFILE_SNAPSHOT_QUERY_BUDGET = 4
+HEART_STRIP_DAYS = 7
+
+
+def build_profile_snapshot(user_id, today=None):
+    """Данные главного экрана (поле data ответа /api/app/profile_data) или None, если пользователя нет."""
+    today = today or date.today()
+
+    # --- 1. Пользователь с аватаром и подпиской ---
+    user = db.session.get(User, user_id, options=[joinedload(User.avatar), joinedload(User.subscription)])
+    if user is None:
+        return None
+
+    # --- 2. Замеры: стартовый и всё после него (без стартового — только последний) ---
+    analyses = _load_analyses(user)
+    latest_analysis = analyses[-1] if analyses else None
+    initial_analysis = next((a for a in analyses if a.id == user.initial_body_analysis_id), None)
+
+    # --- 3. Диета ---
+    diet_obj = db.session.execute(
+        select(Diet).where(Diet.user_id == user.id).order_by(Diet.date.desc()).limit(1)
+    ).scalars().first()
+
+    # --- 4. Энергобаланс: окно «сердечек» + дни после последнего замера ---
+    strip_start = today - timedelta(days=HEART_STRIP_DAYS - 1)
+    scan_start = strip_start
+    if latest_analysis and latest_analysis.timestamp:
+        scan_start = min(scan_start, latest_analysis.timestamp.date())
+    days = get_days(user.id, scan_start, today)
+
+    # Слева направо: [День-6, ..., Сегодня]
+    last_7_days_status = [
+        bool(days.get(strip_start + timedelta(days=i)) and days[strip_start + timedelta(days=i)].meal_count)
+        for i in range(HEART_STRIP_DAYS)
+    ]
+
+    user_data = {
+        "id": user.id,
+        "name": user.name,
+        "email": user.email,
+        "has_subscription": bool(getattr(user, 'has_subscription', False)),
+        "is_trainer": bool(getattr(user, 'is_trainer', False)),
+        "avatar_filename": user.avatar.filename if user.avatar else None,
+        "current_streak": getattr(user, "current_streak", 0),
+        "last_7_days_status": last_7_days_status,
+        "show_welcome_popup": bool(getattr(user, 'show_welcome_popup', False)),
+    }
+
+    fat_loss_progress_data, progress_checkpoints = _fat_loss_progress(
+        user, initial_analysis, latest_analysis, analyses, days, today
+    )
+
+    return {
+        "user": user_data,
+        "diet": _diet_data(diet_obj),
+        "fat_loss_progress": fat_loss_progress_data,
+        "progress_checkpoints": progress_checkpoints,
+        "latest_analysis": _analysis_data(latest_analysis),
+    }
+
+
+def _load_analyses(user):
+    """Замеры по возрастанию времени: от стартового (включительно) до последнего."""
+    q = select(BodyAnalysis).where(BodyAnalysis.user_id == user.id)
+    if user.initial_body_analysis_id:
+        initial_ts = select(BodyAnalysis.timestamp) \
+            .where(BodyAnalysis.id == user.initial_body_analysis_id).scalar_subquery()
+        # Стартовый замер удалён — отдаём всю историю, последний всё равно нужен
+        q = q.where(or_(BodyAnalysis.timestamp >= initial_ts, initial_ts.is_(None)))
+        return list(db.session.execute(q.order_by(BodyAnalysis.timestamp.asc())).scalars())
+    latest = db.session.execute(q.order_by(BodyAnalysis.timestamp.desc()).limit(1)).scalars().first()
+    return [latest] if latest else []
+
+
+def _diet_data(diet_obj):
+    if not diet_obj:
+        return None
+    try:
+        return {
+            "id": diet_obj.id,
+            "total_kcal": diet_obj.total_kcal,
+            "protein": diet_obj.protein,
+            "fat": diet_obj.fat,
+            "carbs": diet_obj.carbs,
+            "meals": {
+                "breakfast": json.loads(diet_obj.breakfast or "[]"),
+                "lunch": json.loads(diet_obj.lunch or "[]"),
+                "dinner": json.loads(diet_obj.dinner or "[]"),
+                "snack": json.loads(diet_obj.snack or "[]"),
+            }
+        }
+    except Exception:
+        return None  # Ошибка парсинга JSON
+
+
+def _analysis_data(latest_analysis):
+    if not latest_analysis:
+        return None
+    calculated_fat_percentage = 0.0
+    try:
+        if latest_analysis.weight and latest_analysis.weight > 0 and latest_analysis.fat_mass:
+            calculated_fat_percentage = (latest_analysis.fat_mass / latest_analysis.weight) * 100
+    except Exception:
+        pass
+
+    return {
+        'timestamp': latest_analysis.timestamp.isoformat() if latest_analysis.timestamp else None,
+        'height': latest_analysis.height,
+        'weight_kg': latest_analysis.weight,
+        'muscle_mass_kg': latest_analysis.muscle_mass,
+        'body_fat_percentage': calculated_fat_percentage,
+        'body_water': latest_analysis.body_water,
+        'protein_percentage': latest_analysis.protein_percentage,
+        'skeletal_muscle_mass': latest_analysis.skeletal_muscle_mass,
+        'visceral_fat_level': latest_analysis.visceral_fat_rating,
+        'metabolism': latest_analysis.metabolism,
+        'waist_hip_ratio': latest_analysis.waist_hip_ratio,
+        'body_age': latest_analysis.body_age,
+        'fat_mass_kg': latest_analysis.fat_mass,
+        'bmi': latest_analysis.bmi,
+        'fat_free_body_weight': latest_analysis.fat_free_body_weight
+    }
+
+
+def _fat_loss_progress(user, initial_analysis, latest_analysis, analyses, days, today):
+    """Прогресс жиросжигания с прогнозом после последнего замера и чекпоинты по замерам."""
+    if not (initial_analysis and latest_analysis and latest_analysis.fat_mass and user.fat_mass_goal
+            and initial_analysis.fat_mass is not None and initial_analysis.fat_mass > user.fat_mass_goal):
+        return None, []
+
+    fat_loss_progress_data = None
+    try:
+        initial_fat_mass = float(initial_analysis.fat_mass)
+        goal_fat_mass = user.fat_mass_goal
+
+        # Прогноз: дефицит после последнего замера → текущая масса жира
+        total_accumulated_deficit, _ = deficit_from_rows(days, latest_analysis, today)
+        current_fat_mass = latest_analysis.fat_mass - total_accumulated_deficit / KCAL_PER_KG_FAT
+
+        total_fat_to_lose_kg = initial_fat_mass - goal_fat_mass
+        fat_lost_so_far_kg = initial_fat_mass - current_fat_mass
+
+        percentage = 0
+        if total_fat_to_lose_kg > 0:
+            percentage = (fat_lost_so_far_kg / total_fat_to_lose_kg) * 100
+
+        fat_loss_progress_data = {
+            'percentage': min(100, max(0, percentage)),
+            'burned_kg': fat_lost_so_far_kg,
+            'total_to_lose_kg': total_fat_to_lose_kg,
+            'initial_kg': initial_fat_mass,
+            'goal_kg': goal_fat_mass,
+            'current_kg': current_fat_mass  # Прогнозируемое значение
+        }
+    except Exception as e:
+        print(f"Error calculating fat loss: {e}")
+
+    progress_checkpoints = []
+    if fat_loss_progress_data and fat_loss_progress_data['total_to_lose_kg'] > 0:
+        initial_fat = fat_loss_progress_data['initial_kg']
+        total_to_lose = fat_loss_progress_data['total_to_lose_kg']
+        for i, analysis in enumerate(analyses):
+            current_fat_at_point = analysis.fat_mass or initial_fat
+            percentage_at_point = ((initial_fat - current_fat_at_point) / total_to_lose) * 100
+            progress_checkpoints.append({
+                "number": i + 1,
+                "percentage": min(100, max(0, percentage_at_point))
+            })
+    return fat_loss_progress_data, progress_checkpoints
@@ -0,0 +1,58 @@
+# Общее для бенчмарков бюджета запросов (bench_*.py): счётчик SQL-запросов и изолированное приложение.
+# Бенчмарки — отдельные скрипты, а не проверки внутри сервисов: счётчик вешается на весь engine и
+# в многопоточном сервере посчитал бы и чужие запросы. По умолчанию всё идёт во временную SQLite,
+# чтобы фикстуры не попали в рабочую БД; --database-url — явный прогон на копии настоящей.
+import argparse
+import os
+import tempfile
+from contextlib import contextmanager
+
+from flask import Flask
+from sqlalchemy import event
+
+from extensions import db
+
+
+@contextmanager
+def count_queries():
+    """Считает SQL-запросы внутри блока: with count_queries() as q: ...; q["count"]."""
+    counter = {"count": 0}
+
+    def _before(*_):
+        counter["count"] += 1
+
+    engine = db.engine
+    event.listen(engine, "before_cursor_execute", _before)
+    try:
+        yield counter
+    finally:
+        event.remove(engine, "before_cursor_execute", _before)
+
+
+def bench_parser(description):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--database-url", help="БД для прогона (по умолчанию — временная SQLite)")
+    parser.add_argument("--runs", type=int, default=5)
+    return parser
+
+
+def bench_app(database_url=None):
+    """Flask-приложение только с БД (без шедулеров и роутов app.py); схема создаётся при необходимости."""
+    if not database_url:
+        path = os.path.join(tempfile.mkdtemp(prefix="query-budget-"), "bench.db")
+        database_url = f"sqlite:///{path}"
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = database_url
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+def check_budget(label, queries, budget):
+    """Бюджет превышен → сообщение и код выхода 1 (для CI / ручного прогона)."""
+    if queries > budget:
+        print(f"[query_budget] FAIL {label}: {queries} queries > budget {budget}")
+        raise SystemExit(1)
+    print(f"[query_budget] ok {label}: {queries} queries (budget {budget})")
@@ -0,0 +1,37 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """Простой потокобезопасный token bucket: не больше rate запросов в секунду (с запасом burst)."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = max(rate, 0.01)
+        self.capacity = max(burst, 1)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, n: int = 1):
+        """Ждёт, пока наберётся n токенов (n больше burst обрезается до burst)."""
+        n = min(max(n, 1), self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.updated:
+                    # действует пауза после pause()
+                    wait = self.updated - now
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= n:
+                        self.tokens -= n
+                        return
+                    wait = (n - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        """Сервер попросил подождать (429 retry_after): обнуляем запас, новые токены пойдут через seconds."""
+        with self.lock:
+            self.tokens = min(self.tokens, 0.0)
+            self.updated = max(self.updated, time.monotonic() + seconds)
@@ -0,0 +1,97 @@
+# Кэш снимков мобильных экранов (/api/app/profile_data, /api/app/meals/today) с ETag.
+# Версия снимка — User.snapshot_version: её увеличивают события маппера MealLog / Activity / BodyAnalysis /
+# Diet / Subscription / User в той же транзакции, поэтому инвалидация видна всем процессам.
+# Сам JSON кэшируется в памяти процесса по ключу (экран, пользователь) и сверяется с ETag.
+import threading
+from collections import OrderedDict
+from datetime import date
+
+from flask import current_app, request
+from sqlalchemy import event, update
+
+from extensions import db
+from models import Activity, BodyAnalysis, Diet, MealLog, Subscription, User
+
+CACHE_MAX_ENTRIES = 5000
+
+_lock = threading.Lock()
+_cache = OrderedDict()  # (kind, user_id) → (etag, body)
+
+U = User.__table__
+
+
+# ==============================
+#   ИНВАЛИДАЦИЯ
+# ==============================
+
+def bump_versions(user_ids, conn=None):
+    """Явная инвалидация снимков (для массовых UPDATE/INSERT мимо ORM). Коммит — на вызывающем."""
+    user_ids = [uid for uid in set(user_ids) if uid is not None]
+    if not user_ids:
+        return
+    stmt = update(U).where(U.c.id.in_(user_ids)).values(snapshot_version=U.c.snapshot_version + 1)
+    if conn is not None:
+        conn.execute(stmt)
+    else:
+        db.session.execute(stmt, execution_options={"synchronize_session": False})
+
+
+@event.listens_for(MealLog, "after_insert")
+@event.listens_for(MealLog, "after_update")
+@event.listens_for(MealLog, "after_delete")
+@event.listens_for(Activity, "after_insert")
+@event.listens_for(Activity, "after_update")
+@event.listens_for(Activity, "after_delete")
+@event.listens_for(BodyAnalysis, "after_insert")
+@event.listens_for(BodyAnalysis, "after_update")
+@event.listens_for(BodyAnalysis, "after_delete")
+@event.listens_for(Diet, "after_insert")
+@event.listens_for(Diet, "after_update")
+@event.listens_for(Diet, "after_delete")
+@event.listens_for(Subscription, "after_insert")
+@event.listens_for(Subscription, "after_update")
+@event.listens_for(Subscription, "after_delete")
+def _on_user_data_written(mapper, connection, target):
+    bump_versions([target.user_id], conn=connection)
+
+
+@event.listens_for(User, "after_update")
+def _on_user_written(mapper, connection, target):
+    bump_versions([target.id], conn=connection)
+
+
+# ==============================
+#   ОТВЕТ С ETAG
+# ==============================
+
+def snapshot_response(kind, user, build):
+    """
+    JSON-ответ экрана kind для user с ETag = версия снимка + текущая дата (экраны зависят от «сегодня»).
+    If-None-Match совпал → 304 без сборки и сериализации; версия не менялась → тело из кэша процесса;
+    иначе build() собирает payload, он сериализуется и кладётся в кэш.
+    """
+    etag = f"{kind}-{user.id}-{user.snapshot_version or 0}-{date.today().isoformat()}"
+
+    if request.if_none_match.contains(etag):
+        resp = current_app.response_class(status=304)
+    else:
+        key = (kind, user.id)
+        with _lock:
+            cached = _cache.get(key)
+            if cached and cached[0] == etag:
+                _cache.move_to_end(key)
+        if cached and cached[0] == etag:
+            body = cached[1]
+        else:
+            body = current_app.json.dumps(build())
+            with _lock:
+                _cache[key] = (etag, body)
+                _cache.move_to_end(key)
+                while len(_cache) > CACHE_MAX_ENTRIES:
+                    _cache.popitem(last=False)
+        resp = current_app.response_class(body, mimetype="application/json")
+
+    resp.set_etag(etag)
+    # Клиент хранит ответ, но каждый раз сверяется с сервером
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
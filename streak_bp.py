@@ -1,154 +1,241 @@
-import threading
-import time
 import os
-from datetime import date, datetime, timedelta
+from datetime import date, datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+from apscheduler.schedulers.background import BackgroundScheduler
 from flask import Blueprint
-from sqlalchemy import func
+from sqlalchemy import and_, func, or_, select, update
 from extensions import db
-from models import User, MealLog
-from firebase_admin import messaging
+from meal_reminders import DEFAULT_TZ
+from models import User, UserSettings, MealLog
+from notification_service import record_push_results, send_fcm_batch
 import firebase_admin
 
 streak_bp = Blueprint('streak_bp', __name__)
 
+# Локальный час вечернего предупреждения о риске потери стрика
+STREAK_ALERT_HOUR = int(os.getenv("STREAK_ALERT_HOUR", "18"))
+CHECK_EVERY_MIN = 15
 
-# --- ЧЕСТНЫЙ ПЕРЕСЧЕТ СТРИКА ---
+_scheduler = None
 
-def recalculate_streak(user):
+
+# --- ИНКРЕМЕНТАЛЬНЫЙ СТРИК ---
+# Состояние хранится в User: last_logged_date, current_streak, longest_streak.
+# При записи/удалении еды меняется за O(1), сгоревшие стрики обнуляет ночной rollover_streaks().
+
+def on_meal_logged(user, day=None) -> bool:
     """
-    Смотрит в таблицу MealLog, ищет непрерывную последовательность дней.
-    Не использует счетчик +1. Считает реальные даты.
+    Вызывать при сохранении MealLog за day (по умолчанию сегодня).
+    Повторная запись за тот же день стрик не меняет. Возвращает True, если стрик вырос.
+    Коммит — на вызывающем.
     """
-    # 1. Достаем уникальные даты, когда пользователь ел, в обратном порядке
-    # (DISTINCT date ORDER BY date DESC)
-    logs = db.session.query(MealLog.date) \
-        .filter_by(user_id=user.id) \
-        .group_by(MealLog.date) \
-        .order_by(MealLog.date.desc()) \
-        .limit(365) \
-        .all()
+    day = day or date.today()
+    last = user.last_logged_date
+    if last is not None and day <= last:
+        return False
 
-    # Превращаем в список объектов date: [2023-10-25, 2023-10-24, 2023-10-22...]
-    dates = [row.date for row in logs]
+    if last == day - timedelta(days=1):
+        user.current_streak = (user.current_streak or 0) + 1
+    else:
+        user.current_streak = 1
+    user.last_logged_date = day
+    user.longest_streak = max(user.longest_streak or 0, user.current_streak)
+    return True
 
-    if not dates:
-        user.current_streak = 0
-        return
 
-    today = date.today()
-    yesterday = today - timedelta(days=1)
+def on_meal_deleted(user, day=None):
+    """
+    Вызывать после удаления MealLog за day. Если это была последняя запись дня,
+    день выпадает из стрика. longest_streak не уменьшаем — точное значение восстановит recalculate_streak.
+    Коммит — на вызывающем.
+    """
+    day = day or date.today()
+    if user.last_logged_date != day:
+        return
+    db.session.flush()
+    still_logged = db.session.query(MealLog.id).filter_by(user_id=user.id, date=day).first() is not None
+    if still_logged:
+        return
 
-    streak = 0
+    user.current_streak = max((user.current_streak or 0) - 1, 0)
+    # Предыдущий день цепочки известен только пока стрик жив; иначе следующая запись начнёт с 1
+    user.last_logged_date = day - timedelta(days=1) if user.current_streak else None
 
-    # Логика: Стрик жив, если последняя запись была Сегодня или Вчера.
-    # Если последняя запись была позавчера - стрик уже 0 (сгорел).
 
-    latest_log = dates[0]
+def rollover_streaks(today=None) -> int:
+    """
+    Ночной проход: обнулить стрики тех, кто не ел ни вчера, ни сегодня, одним UPDATE.
+    Возвращает число обнулённых.
+    """
+    today = today or date.today()
+    yesterday = today - timedelta(days=1)
+    res = db.session.execute(
+        update(User)
+        .where(
+            User.current_streak > 0,
+            or_(User.last_logged_date.is_(None), User.last_logged_date < yesterday),
+        )
+        .values(current_streak=0, snapshot_version=User.snapshot_version + 1),
+        execution_options={"synchronize_session": False},
+    )
+    db.session.commit()
+    return res.rowcount
 
-    if latest_log < yesterday:
-        # Стрик прервался
-        user.current_streak = 0
-        return
 
-    # Начинаем проверку цепочки
-    # Если есть запись за сегодня, начинаем отсчет с сегодня.
-    # Если нет за сегодня, но есть за вчера - начинаем со вчера.
+# --- ЧЕСТНЫЙ ПЕРЕСЧЕТ СТРИКА (РЕМОНТ) ---
 
-    check_date = today if (latest_log == today) else yesterday
+def recalculate_streak(user):
+    """
+    Инструмент ремонта: восстанавливает last_logged_date / current_streak / longest_streak
+    по реальным датам MealLog. В горячем пути не вызывается — там on_meal_logged / on_meal_deleted.
+    """
+    # Уникальные даты, когда пользователь ел, по возрастанию (DISTINCT date ORDER BY date)
+    dates = [
+        row.date for row in
+        db.session.query(MealLog.date)
+        .filter_by(user_id=user.id)
+        .group_by(MealLog.date)
+        .order_by(MealLog.date)
+        .all()
+    ]
 
-    # Проходим по датам и смотрим, нет ли разрывов
+    longest = run = 0
+    prev = None
     for d in dates:
-        if d == check_date:
-            streak += 1
-            check_date -= timedelta(days=1)  # Идем на день назад
-        else:
-            # Нашли разрыв (например, в базе 20-е число, а мы ждали 21-е)
-            break
-
-    user.current_streak = streak
+        run = run + 1 if prev is not None and d == prev + timedelta(days=1) else 1
+        longest = max(longest, run)
+        prev = d
+
+    # Стрик жив, если последняя запись была сегодня или вчера
+    yesterday = date.today() - timedelta(days=1)
+    user.last_logged_date = prev
+    user.current_streak = run if prev is not None and prev >= yesterday else 0
+    user.longest_streak = longest
     # db.session.commit() — делает вызывающая функция
 
 
+def repair_streaks(user_ids=None, batch_size=500) -> int:
+    """Пересчитать стрики всем (или user_ids) через recalculate_streak, коммит пачками. Возвращает число пользователей."""
+    q = db.session.query(User.id).order_by(User.id)
+    if user_ids is not None:
+        q = q.filter(User.id.in_(user_ids))
+    ids = [row.id for row in q]
+    for i in range(0, len(ids), batch_size):
+        for user in User.query.filter(User.id.in_(ids[i:i + batch_size])):
+            recalculate_streak(user)
+        db.session.commit()
+    return len(ids)
+
+
 # --- УВЕДОМЛЕНИЯ О РИСКЕ ПОТЕРИ ---
 
-def _send_push(token, title, body):
-    if not token or not firebase_admin._apps:
-        return
+def _local_now(tz_name, now_utc):
     try:
-        msg = messaging.Message(
-            notification=messaging.Notification(title=title, body=body),
-            token=token
-        )
-        messaging.send(msg)
-    except Exception as e:
-        print(f"[Streak] Push error: {e}")
+        tz = ZoneInfo(tz_name or DEFAULT_TZ)
+    except Exception:
+        tz = ZoneInfo(DEFAULT_TZ)
+    return now_utc.replace(tzinfo=timezone.utc).astimezone(tz)
 
 
-def _streak_checker_worker(app):
+def check_streak_risk(now_utc=None) -> int:
+    """
+    Вечерняя проверка (один проход, внутри app_context), запускается каждые 15 минут.
+    Берёт часовые пояса, где сейчас STREAK_ALERT_HOUR:00–:14, и одним запросом находит тех, кто
+    ел вчера (по своему поясу), сегодня ещё нет, стрик > 0 и notify_meals включён.
+    Пуши уходят пачкой. Возвращает число отправленных предупреждений.
+    """
+    now_utc = now_utc or datetime.utcnow()
+    tz_col = func.coalesce(UserSettings.meal_timezone, DEFAULT_TZ)
+
+    # 1. Пояса, где сейчас час проверки → их «вчера»
+    tz_names = db.session.execute(select(tz_col).distinct()).scalars().all()
+    if DEFAULT_TZ not in tz_names:
+        tz_names.append(DEFAULT_TZ)  # пользователи без UserSettings
+    due = {}
+    for tz_name in tz_names:
+        local = _local_now(tz_name, now_utc)
+        if local.hour == STREAK_ALERT_HOUR and local.minute < CHECK_EVERY_MIN:
+            due.setdefault(local.date() - timedelta(days=1), []).append(tz_name)
+    if not due:
+        return 0
+
+    print(f"[Streak] Запуск вечерней проверки для поясов: {', '.join(sorted(sum(due.values(), [])))}")
+
+    # 2. Один запрос: last_logged_date == вчера означает «вчера ел, сегодня ещё нет»
+    rows = db.session.execute(
+        select(User.id, User.fcm_device_token, User.current_streak)
+        .outerjoin(UserSettings, UserSettings.user_id == User.id)
+        .where(
+            User.fcm_device_token.isnot(None),
+            User.current_streak > 0,
+            func.coalesce(UserSettings.notify_meals, True).is_(True),
+            or_(*[
+                and_(tz_col.in_(names), User.last_logged_date == yesterday)
+                for yesterday, names in due.items()
+            ]),
+        )
+    ).all()
+    if not rows:
+        print("[Streak] Отправлено 0 предупреждений.")
+        return 0
+    if not firebase_admin._apps:
+        print(f"[Streak] Firebase не инициализирован, пропускаем {len(rows)} предупреждений.")
+        return 0
+
+    # 3. Пачка пушей (send_each по 500) + учёт мёртвых токенов
+    results = send_fcm_batch([
+        {
+            "user_id": uid, "token": token,
+            "title": "😱 Стрик под угрозой!",
+            "body": f"Вы не отметили еду сегодня! Ваш стрик из {streak} дней сгорит в полночь 🔥",
+            "data": {"type": "streak_risk"},
+        }
+        for uid, token, streak in rows
+    ])
+    record_push_results(results)
+
+    sent = sum(1 for r in results if r["ok"])
+    print(f"[Streak] Отправлено {sent} предупреждений ({len(results) - sent} ошибок).")
+    return sent
+
+
+def start_streak_scheduler(app, paused=False):
     """
-    Фоновый процесс.
-    Каждый вечер проверяет, загрузил ли пользователь еду СЕГОДНЯ.
-    Если нет, но у него есть накопленный стрик (за вчера) — шлёт алерт.
+    Создать и запустить шедулер стриков (если ещё не создан). Вернуть инстанс.
+    paused=True — задачи не выполняются, пока раннер не сделает resume() (см. job_runner).
     """
-    with app.app_context():
-        while True:
-            now = datetime.now()
-
-            # Время проверки: 20:00 (или любое другое вечернее время)
-            if now.hour == 18 and 0 <= now.minute < 5:
-                print("[Streak] Запуск вечерней проверки...")
-                today = date.today()
-
-                # 1. Берем пользователей, у которых есть FCM токен
-                users = User.query.filter(User.fcm_device_token.isnot(None)).all()
-
-                count = 0
-                for u in users:
-                    # Проверяем настройки уведомлений
-                    settings = getattr(u, 'settings', None)
-                    if settings and not settings.notify_meals:
-                        continue
-
-                    # 2. Проверяем, ел ли он СЕГОДНЯ
-                    # (Просто запрос в базу: есть ли MealLog за today)
-                    has_meal_today = db.session.query(MealLog.id).filter_by(
-                        user_id=u.id,
-                        date=today
-                    ).first() is not None
-
-                    if has_meal_today:
-                        continue  # Всё ок, он уже молодец
-
-                    # 3. Если сегодня не ел, проверяем, есть ли у него стрик, который можно потерять.
-                    # Мы доверяем полю u.current_streak, так как оно обновлялось при последней активности.
-                    # Но на всякий случай можно перепроверить "есть ли запись за вчера".
-
-                    yesterday = today - timedelta(days=1)
-                    has_meal_yesterday = db.session.query(MealLog.id).filter_by(
-                        user_id=u.id,
-                        date=yesterday
-                    ).first() is not None
-
-                    if has_meal_yesterday:
-                        # У него есть стрик, который держится на вчерашнем дне.
-                        # Если не загрузит сегодня — стрик сгорит.
-
-                        # Пересчитываем на всякий случай, чтобы цифра была точной
-                        recalculate_streak(u)
-                        if u.current_streak > 0:
-                            msg = f"Вы не отметили еду сегодня! Ваш стрик из {u.current_streak} дней сгорит в полночь 🔥"
-                            _send_push(u.fcm_device_token, "😱 Стрик под угрозой!", msg)
-                            count += 1
-                            # Коммитим пересчет
-                            db.session.commit()
-
-                print(f"[Streak] Отправлено {count} предупреждений.")
-                time.sleep(60 * 10)  # Спим 10 минут, чтобы не спамить в этот же час
-
-            time.sleep(60)
-
-
-def start_streak_scheduler(app):
-    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
-        t = threading.Thread(target=_streak_checker_worker, args=(app,), daemon=True)
-        t.start()
\ No newline at end of file
+    global _scheduler
+    if _scheduler:
+        return _scheduler
+
+    _scheduler = BackgroundScheduler(
+        job_defaults={"coalesce": True, "misfire_grace_time": CHECK_EVERY_MIN * 60},
+    )
+
+    def _job():
+        with app.app_context():
+            try:
+                check_streak_risk()
+            except Exception as e:
+                db.session.rollback()
+                print(f"[Streak] Ошибка проверки: {e}")
+            finally:
+                db.session.remove()
+
+    def _rollover():
+        with app.app_context():
+            try:
+                reset = rollover_streaks()
+                print(f"[Streak] Ночной rollover: обнулено {reset} стриков.")
+            except Exception as e:
+                db.session.rollback()
+                print(f"[Streak] Ошибка rollover: {e}")
+            finally:
+                db.session.remove()
+
+    # Шаг 15 минут покрывает пояса со смещением :30 / :45; окно STREAK_ALERT_HOUR:00–:14 бывает раз в сутки
+    _scheduler.add_job(_job, "cron", minute=f"*/{CHECK_EVERY_MIN}", id="streak-checker", replace_existing=True)
+    # Сразу после полуночи (даты MealLog — по серверному date.today())
+    _scheduler.add_job(_rollover, "cron", hour=0, minute=5, id="streak-rollover", replace_existing=True)
+    _scheduler.start(paused=paused)
+    return _scheduler
@@ -0,0 +1,55 @@
+# Общий отправитель Telegram для фоновых рассылок: пул соединений + учёт 429 retry_after.
+# Лимит Telegram (~30 сообщений в секунду) — на бота, а не на рассылку, поэтому bucket один на процесс
+# и общий для всех отправителей (finalize диет, рассылка из админки, outbox): 429 у одного тормозит всех.
+import os
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from rate_limit import TokenBucket
+
+bot_bucket = TokenBucket(rate=float(os.getenv("TELEGRAM_BOT_RPS", "25")),
+                         burst=int(os.getenv("TELEGRAM_BOT_BURST", "10")))
+
+
+def bot_token():
+    return os.getenv("TELEGRAM_BOT_TOKEN") or os.getenv("TELEGRAM_TOKEN")
+
+
+def make_session(pool_size: int = 10) -> requests.Session:
+    """Session с keep-alive пулом на pool_size соединений (по одному на поток-отправитель)."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    return session
+
+
+def send_message(session, chat_id, text: str, timeout: float = 10, **fields):
+    """
+    Один sendMessage. Возвращает (ok, retry_after, error):
+    retry_after — через сколько секунд имеет смысл повторить (429/5xx/сеть),
+    None — повторять бессмысленно (бот заблокирован, неверный chat_id, нет токена).
+    Скорость ограничена общим bot_bucket; на 429 он ставится на паузу, чтобы остальные потоки тоже подождали.
+    """
+    token = bot_token()
+    if not token:
+        return False, None, "TELEGRAM_BOT_TOKEN is not set"
+    bot_bucket.acquire()
+    try:
+        r = session.post(
+            f"https://api.telegram.org/bot{token}/sendMessage",
+            json={"chat_id": chat_id, "text": text, "disable_web_page_preview": True, **fields},
+            timeout=timeout,
+        )
+    except Exception as e:
+        return False, 0.0, str(e)
+    if r.ok:
+        return True, None, None
+    if r.status_code == 429:
+        try:
+            retry_after = float(r.json().get("parameters", {}).get("retry_after", 1))
+        except ValueError:
+            retry_after = 1.0
+        bot_bucket.pause(retry_after)
+        return False, retry_after, "429 Too Many Requests"
+    return False, (0.0 if r.status_code >= 500 else None), f"{r.status_code} {r.text[:200]}"
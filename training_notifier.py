@@ -0,0 +1,476 @@
+import os
+import time
+from datetime import datetime, timedelta, time as dt_time
+from zoneinfo import ZoneInfo
+
+from apscheduler.jobstores.base import JobLookupError
+from apscheduler.jobstores.memory import MemoryJobStore
+from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+from apscheduler.schedulers.background import BackgroundScheduler
+from sqlalchemy import func, or_, union
+from sqlalchemy.orm import aliased
+
+from extensions import db
+from models import (
+    User, UserSettings, Subscription, Training, TrainingSignup, GroupMember, Group,
+    BodyAnalysis, SquadScoreLog
+)
+from notification_service import send_bulk_notifications
+
+ALMATY = ZoneInfo("Asia/Almaty")
+# Персистентный стор для точечных задач T-1h / T-0
+JOBSTORE = "trainings"
+# Окно догона: задача, пропущенная из-за рестарта/простоя, выполнится, если опоздала не больше чем на N секунд
+CATCHUP_SEC = int(os.getenv("TRAINING_NOTIFIER_CATCHUP_SEC", "900"))
+
+_scheduler = None
+_app = None
+
+# Статистика последних запусков фаз (для логов / админки)
+_last_tick_stats = {}
+
+# Тексты уведомлений по фазам тренировок: (групповая, публичная)
+_TRAINING_PHASES = {
+    "1h": {
+        "group_flag": "group_notified_1h",
+        "signup_flag": "notified_1h",
+        "group": lambda t, trainer: (
+            "⏰ Скоро тренировка!",
+            f"Команда собирается через час: «{t.title}». Не опаздывайте!",
+            "reminder",
+        ),
+        "public": lambda t, trainer: (
+            "⏰ Напоминание о тренировке!",
+            f"Через 1 час: «{t.title or 'Онлайн-тренировка'}» с "
+            f"{trainer or 'тренером'} в {t.start_time.strftime('%H:%M')}.",
+            "reminder",
+        ),
+    },
+    "start": {
+        "group_flag": "group_notified_start",
+        "signup_flag": "notified_start",
+        "group": lambda t, trainer: (
+            "🚀 Тренировка началась!",
+            f"Заходите в видео-чат: «{t.title}».",
+            "info",
+        ),
+        "public": lambda t, trainer: (
+            "🏁 Тренировка начинается!",
+            f"«{t.title or 'Онлайн-тренировка'}» началась. Тренер: {trainer or 'тренер'}.",
+            "info",
+        ),
+    },
+}
+
+
+# ==============================
+#   ФАЗЫ ТИКА
+# ==============================
+
+def _phase_expire_subscriptions(now):
+    """Деактивируем просроченные подписки (end_date < today) одним UPDATE."""
+    updated = db.session.query(Subscription).filter(
+        Subscription.status == 'active',
+        Subscription.end_date.isnot(None),
+        Subscription.end_date < now.date()
+    ).update({"status": "inactive"}, synchronize_session=False)
+    db.session.commit()
+    return {"rows": updated, "sent": 0}
+
+
+def _phase_trainings(kind, training_ids):
+    """
+    Уведомления T-1h / T-0 по конкретным тренировкам (по id, без сканирования по времени).
+    Групповые: все участники группы + тренер, одним запросом через UNION.
+    Публичные: записавшиеся, у кого ещё не стоит флаг.
+    """
+    spec = _TRAINING_PHASES[kind]
+    Trainer = aliased(User)
+    group_flag = getattr(Training, spec["group_flag"])
+    signup_flag = getattr(TrainingSignup, spec["signup_flag"])
+
+    trainings = (
+        db.session.query(Training, Trainer.name)
+        .outerjoin(Trainer, Trainer.id == Training.trainer_id)
+        .filter(Training.id.in_(training_ids))
+        .all()
+    )
+    if not trainings:
+        return {"rows": 0, "sent": 0}
+
+    by_id = {t.id: (t, trainer_name) for t, trainer_name in trainings}
+    group_ids = [t.id for t, _ in trainings if t.group_id is not None and not getattr(t, spec["group_flag"])]
+    public_ids = [t.id for t, _ in trainings if t.group_id is None]
+
+    group_items, public_items = [], []
+    rows_total = 0
+
+    # --- Групповые: участники ∪ тренер ---
+    if group_ids:
+        members = (
+            db.session.query(Training.id.label("training_id"), GroupMember.user_id.label("user_id"))
+            .join(GroupMember, GroupMember.group_id == Training.group_id)
+            .filter(Training.id.in_(group_ids))
+        )
+        trainers = (
+            db.session.query(Training.id.label("training_id"), Training.trainer_id.label("user_id"))
+            .filter(Training.id.in_(group_ids))
+        )
+        recipients = union(members, trainers).subquery()
+
+        rows = (
+            db.session.query(recipients.c.training_id, User.id, User.fcm_device_token)
+            .join(User, User.id == recipients.c.user_id)
+            .outerjoin(UserSettings, UserSettings.user_id == User.id)
+            .filter(func.coalesce(UserSettings.notify_trainings, User.notify_trainings).is_(True))
+            .all()
+        )
+        rows_total += len(rows)
+        for training_id, uid, token in rows:
+            t, trainer_name = by_id[training_id]
+            title, body, ntype = spec["group"](t, trainer_name)
+            group_items.append({
+                "user_id": uid, "token": token, "title": title, "body": body, "type": ntype,
+                "data": {"training_id": str(t.id), "route": "/squad"},
+            })
+
+        db.session.query(Training).filter(Training.id.in_(group_ids)) \
+            .update({group_flag: True}, synchronize_session=False)
+
+    # --- Публичные: по записям ---
+    if public_ids:
+        rows = (
+            db.session.query(
+                TrainingSignup.id, TrainingSignup.training_id, User.id, User.fcm_device_token,
+                User.telegram_notify_enabled, User.notify_trainings
+            )
+            .join(User, User.id == TrainingSignup.user_id)
+            .filter(TrainingSignup.training_id.in_(public_ids), signup_flag.is_(False))
+            .all()
+        )
+        rows_total += len(rows)
+        done_signup_ids = []
+        for signup_id, training_id, uid, token, tg_enabled, notify_trainings in rows:
+            # Старые общие настройки: выключены — помечаем, чтобы не спамить
+            if tg_enabled is False or notify_trainings is False:
+                done_signup_ids.append(signup_id)
+                continue
+            t, trainer_name = by_id[training_id]
+            title, body, ntype = spec["public"](t, trainer_name)
+            public_items.append({
+                "user_id": uid, "token": token, "title": title, "body": body, "type": ntype,
+                "data": {"training_id": str(t.id), "route": "/calendar"},
+                "signup_id": signup_id,
+            })
+
+        send_bulk_notifications(public_items, commit=False)
+        done_signup_ids += [it["signup_id"] for it in public_items]
+
+        if done_signup_ids:
+            db.session.query(TrainingSignup).filter(TrainingSignup.id.in_(done_signup_ids)) \
+                .update({signup_flag: True}, synchronize_session=False)
+
+    send_bulk_notifications(group_items, commit=False)
+    sent = len(group_items) + len(public_items)
+    db.session.commit()
+    return {"rows": rows_total, "sent": sent}
+
+
+def _phase_renewal(now):
+    """За 5 дней до конца подписки — одно уведомление (флаг renewal_telegram_sent)."""
+    rows = (
+        db.session.query(User.id, User.fcm_device_token)
+        .join(Subscription, Subscription.user_id == User.id)
+        .outerjoin(UserSettings, UserSettings.user_id == User.id)
+        .filter(
+            Subscription.status == 'active',
+            Subscription.end_date == now.date() + timedelta(days=5),
+            or_(User.renewal_telegram_sent.is_(None), User.renewal_telegram_sent.is_(False)),
+            User.fcm_device_token.isnot(None),
+            func.coalesce(UserSettings.notify_subscription, User.notify_subscription).is_(True),
+        )
+        .all()
+    )
+    items = [
+        {
+            "user_id": uid, "token": token,
+            "title": "⏳ Подписка истекает",
+            "body": "Осталось 5 дней. Не теряйте доступ к тренировкам — продлите сейчас.",
+            "type": "warning", "data": {"route": "/purchase"},
+        }
+        for uid, token in rows
+    ]
+    send_bulk_notifications(items, commit=False)
+    sent_uids = {it["user_id"] for it in items}
+    if sent_uids:
+        db.session.query(User).filter(User.id.in_(sent_uids)) \
+            .update({User.renewal_telegram_sent: True}, synchronize_session=False)
+    db.session.commit()
+    return {"rows": len(rows), "sent": len(sent_uids)}
+
+
+def _phase_measurement(now):
+    """10:00 — напоминание сделать замер, если последний анализ старше 14 дней."""
+    now_naive = now.replace(tzinfo=None)
+    two_weeks_ago = now.date() - timedelta(days=14)
+
+    latest = (
+        db.session.query(BodyAnalysis.user_id, func.max(BodyAnalysis.timestamp).label("last_ts"))
+        .group_by(BodyAnalysis.user_id)
+        .subquery()
+    )
+    rows = (
+        db.session.query(User.id, User.name, User.fcm_device_token)
+        .join(latest, latest.c.user_id == User.id)
+        .join(UserSettings, UserSettings.user_id == User.id)
+        .filter(
+            User.fcm_device_token.isnot(None),
+            UserSettings.notify_meals.is_(True),
+            latest.c.last_ts < datetime.combine(two_weeks_ago + timedelta(days=1), dt_time.min),
+            or_(
+                User.last_measurement_reminder_sent_at.is_(None),
+                User.last_measurement_reminder_sent_at <= now_naive - timedelta(days=14),
+            ),
+        )
+        .all()
+    )
+    items = [
+        {
+            "user_id": uid, "token": token,
+            "title": "⏰ Пора сделать замер!",
+            "body": f"Привет, {name}! Прошло 2 недели с последнего замера. Пора обновить данные.",
+            "type": "info", "data": {"route": "/profile"},
+        }
+        for uid, name, token in rows
+    ]
+    send_bulk_notifications(items, commit=False)
+    sent_uids = {it["user_id"] for it in items}
+    if sent_uids:
+        db.session.query(User).filter(User.id.in_(sent_uids)) \
+            .update({User.last_measurement_reminder_sent_at: now_naive}, synchronize_session=False)
+    db.session.commit()
+    return {"rows": len(rows), "sent": len(sent_uids)}
+
+
+def _phase_weekly_results(now):
+    """Понедельник 09:00 — итоги недели по всем отрядам одним сгруппированным запросом."""
+    today = now.date()
+    start_of_last_week = today - timedelta(days=7)
+    end_of_last_week = today - timedelta(days=1)
+
+    total = func.sum(SquadScoreLog.points).label("total")
+    rows = (
+        db.session.query(Group.id, Group.name, User.id, User.fcm_device_token, total)
+        .join(SquadScoreLog, SquadScoreLog.group_id == Group.id)
+        .join(User, User.id == SquadScoreLog.user_id)
+        .filter(
+            func.date(SquadScoreLog.created_at) >= start_of_last_week,
+            func.date(SquadScoreLog.created_at) <= end_of_last_week,
+        )
+        .group_by(Group.id, Group.name, User.id, User.fcm_device_token)
+        .order_by(Group.id, total.desc())
+        .all()
+    )
+
+    medals = {1: "🥇", 2: "🥈", 3: "🥉"}
+    items = []
+    place, current_group = 0, None
+    for group_id, group_name, uid, token, score in rows:
+        place = place + 1 if group_id == current_group else 1
+        current_group = group_id
+        if place <= 3:
+            title = f"Итоги недели: {place} место! {medals.get(place, '')}"
+            body = f"Так держать! Вы набрали {score} баллов и заняли {place} место в отряде {group_name}."
+            ntype = "success"
+        else:
+            title = "Итоги недели подведены 📊"
+            body = f"Посмотрите результаты битвы в отряде {group_name}!"
+            ntype = "info"
+        items.append({
+            "user_id": uid, "token": token, "title": title, "body": body, "type": ntype,
+            "data": {"route": "/squad", "args": "stories"},
+        })
+
+    send_bulk_notifications(items, commit=False)
+    sent = len({it["user_id"] for it in items})
+    db.session.commit()
+    return {"rows": len(rows), "sent": sent}
+
+
+# ==============================
+#   ЗАПУСК ФАЗ
+# ==============================
+
+def get_last_tick_stats():
+    """Тайминги и количество строк по фазам последних запусков (по имени фазы)."""
+    return dict(_last_tick_stats)
+
+
+def run_notifier_tick(phases, now=None):
+    """
+    Выполнить набор фаз (внутри app_context) с замером времени.
+    phases — список имён из _DAILY_PHASES; ошибка фазы не роняет остальные.
+    """
+    now = now or datetime.now(ALMATY)
+    return _run_phases(now, [(name, lambda fn=_DAILY_PHASES[name]: fn(now)) for name in phases])
+
+
+def _run_phases(now, phases):
+    stats = {}
+    for name, fn in phases:
+        started = time.perf_counter()
+        try:
+            result = fn()
+        except Exception as e:
+            db.session.rollback()
+            print(f"[notifier] phase {name} failed: {e}")
+            result = {"rows": 0, "sent": 0, "error": str(e)}
+        result["ms"] = round((time.perf_counter() - started) * 1000, 1)
+        result["at"] = now.isoformat(timespec="minutes")
+        stats[name] = result
+        _last_tick_stats[name] = result
+
+    summary = " ".join(f"{k}={v['rows']}/{v['sent']}/{v['ms']}ms" for k, v in stats.items())
+    print(f"[notifier] {now.strftime('%H:%M')} rows/sent: {summary}")
+    return stats
+
+
+_DAILY_PHASES = {
+    "expire": _phase_expire_subscriptions,
+    "renewal": _phase_renewal,
+    "measurement": _phase_measurement,
+    "weekly_results": _phase_weekly_results,
+}
+
+
+# ==============================
+#   ТОЧЕЧНЫЕ ДЖОБЫ ТРЕНИРОВОК
+# ==============================
+
+def _job_id(training_id, kind):
+    return f"training-{training_id}-{kind}"
+
+
+def notify_training(training_id, kind):
+    """
+    One-off задача T-1h / T-0 для одной тренировки.
+    Хранится в персистентном сторе, поэтому ссылка на функцию должна быть модульной.
+    """
+    with _app.app_context():
+        try:
+            _run_phases(datetime.now(ALMATY), [
+                (f"training_{kind}", lambda: _phase_trainings(kind, [training_id])),
+            ])
+        finally:
+            db.session.remove()
+
+
+def schedule_training_notifications(training):
+    """
+    (Пере)регистрировать задачи T-1h и T-0 для тренировки.
+    Вызывается после коммита в create_training / update_training / create_group_training.
+    Моменты, которые уже прошли, не регистрируем (иначе «через час» пришло бы позже).
+    """
+    if not _scheduler:
+        return
+    start_at = datetime.combine(training.date, training.start_time, tzinfo=ALMATY)
+    now = datetime.now(ALMATY)
+    for kind, run_at in (("1h", start_at - timedelta(hours=1)), ("start", start_at)):
+        job_id = _job_id(training.id, kind)
+        try:
+            if run_at <= now:
+                _remove_job(job_id)
+                continue
+            _scheduler.add_job(
+                notify_training, "date", run_date=run_at, args=[training.id, kind],
+                id=job_id, jobstore=JOBSTORE, replace_existing=True,
+            )
+        except Exception as e:
+            print(f"[notifier] failed to schedule {job_id}: {e}")
+
+
+def unschedule_training_notifications(training_id):
+    """Снять задачи удалённой тренировки."""
+    if not _scheduler:
+        return
+    for kind in _TRAINING_PHASES:
+        _remove_job(_job_id(training_id, kind))
+
+
+def _remove_job(job_id):
+    try:
+        _scheduler.remove_job(job_id, jobstore=JOBSTORE)
+    except JobLookupError:
+        pass
+
+
+def sync_training_jobs():
+    """
+    Дорегистрировать задачи для всех предстоящих тренировок (range scan по индексу date).
+    Нужен на старте: тренировки, созданные до деплоя или пока шедулер не работал.
+    """
+    today = datetime.now(ALMATY).date()
+    trainings = Training.query.filter(Training.date >= today).all()
+    for t in trainings:
+        schedule_training_notifications(t)
+    print(f"[notifier] synced jobs for {len(trainings)} upcoming trainings")
+
+
+# ==============================
+#   СТАРТ СКЕДУЛЕРА
+# ==============================
+
+def get_scheduler():
+    """Вернуть текущий инстанс APScheduler (или None)."""
+    return _scheduler
+
+
+def start_training_notifier(app, paused=False):
+    """
+    Создать и запустить шедулер уведомлений (если ещё не создан). Вернуть инстанс.
+    Тренировки — точечные date-задачи в персистентном сторе (с окном догона misfire_grace_time),
+    остальные фазы — cron. paused=True — только регистрация задач (см. job_runner).
+    """
+    global _scheduler, _app
+    if _scheduler:
+        return _scheduler
+    _app = app
+
+    with app.app_context():
+        jobstores = {
+            "default": MemoryJobStore(),
+            JOBSTORE: SQLAlchemyJobStore(engine=db.engine, tablename="apscheduler_training_jobs"),
+        }
+
+    _scheduler = BackgroundScheduler(
+        timezone="Asia/Almaty",
+        jobstores=jobstores,
+        job_defaults={"coalesce": True, "misfire_grace_time": CATCHUP_SEC},
+    )
+
+    def _daily(phases):
+        def _job():
+            with app.app_context():
+                try:
+                    run_notifier_tick(phases)
+                finally:
+                    db.session.remove()
+        return _job
+
+    # 00:01 — гасим просроченные подписки
+    _scheduler.add_job(_daily(["expire"]), 'cron', hour=0, minute=1, id='notifier-expire', replace_existing=True)
+    # 10:00 — продление (за 5 дней) и напоминание о замере
+    _scheduler.add_job(_daily(["renewal", "measurement"]), 'cron', hour=10, minute=0,
+                       id='notifier-daily', replace_existing=True)
+    # Пн 09:00 — итоги недели по отрядам
+    _scheduler.add_job(_daily(["weekly_results"]), 'cron', day_of_week='mon', hour=9, minute=0,
+                       id='notifier-weekly', replace_existing=True)
+
+    _scheduler.start(paused=paused)
+    with app.app_context():
+        try:
+            sync_training_jobs()
+        finally:
+            db.session.remove()
+    print("[notifier] BackgroundScheduler started (Server Timezone: Asia/Almaty).")
+    return _scheduler